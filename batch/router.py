@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+from typing import List
+from urllib.parse import urlsplit
+
+from fastapi import APIRouter, Request
+from starlette import status
+from starlette.exceptions import HTTPException
+
+from batch.schemas import SubRequestPydantic, SubResponsePydantic
+from config import BATCH_MAX_REQUESTS
+from core.limiter import route_limit, OVERLOADED
+from core.logger import get_logger
+from core.metrics import metrics
+from core.middleware import find_route
+from core.responses import json_response
+from users.auth import verify_token, verified_tokens
+
+
+"""Пакетные запросы: несколько GET-запросов к роутерам приложения одним HTTP-запросом. Запросы пакета выполняются
+внутри процесса одновременно через asyncio.gather, минуя middleware: дедлайн и учёт SQL-запросов действуют
+на весь пакет, а токен проверяется один раз. Место в лимите конкурентности занимает каждый запрос пакета,
+поэтому пакет из N запросов нагружает воркер так же, как N отдельных запросов"""
+
+
+batch_logger = get_logger('batch_logger')
+
+batch_router = APIRouter(prefix='/batch', tags=['batch'])
+
+API_PREFIX = '/api/v1/'
+# Пакет не может содержать другой пакет, а поток событий никогда не завершается
+FORBIDDEN_PREFIXES = ('/api/v1/batch', '/api/v1/events')
+
+
+def sub_response(status_code: int, body: bytes) -> bytes:
+    """Элемент ответа пакета. Тело ответа уже сериализовано, поэтому вставляется в ответ пакета как есть"""
+    return b'{"status_code":%d,"body":%s}' % (status_code, body)
+
+
+async def call_router(request: Request, scope: dict) -> tuple[int, bytes]:
+    """Выполняет запрос scope через роутер приложения и возвращает код ответа и его JSON-тело"""
+    started = {}
+    chunks = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            started.update(message)
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    try:
+        await request.app.router(scope, receive, send)
+    except HTTPException as exc:
+        # Ошибки роутера (404 для неизвестного пути, 405) возникают вне обработчиков исключений маршрутов
+        return exc.status_code, json.dumps({'detail': exc.detail}).encode()
+    except Exception as exc:
+        batch_logger.exception('Batch sub-request %s %s failed: %r', scope['method'], scope['path'], exc)
+        return 500, b'{"detail":"Internal Server Error"}'
+
+    body = b''.join(chunks)
+    headers = dict(started.get('headers', []))
+    if not body:
+        body = b'null'
+    elif not headers.get(b'content-type', b'').startswith(b'application/json'):
+        body = json.dumps(body.decode()).encode()
+    return started.get('status', 500), body
+
+
+async def dispatch(request: Request, sub_request: SubRequestPydantic) -> bytes:
+    """Выполняет один запрос пакета и возвращает элемент ответа в виде JSON. Запрос занимает место в лимите
+    конкурентности своего класса маршрутов, как отдельный запрос, а сверх лимита получает 503"""
+    url = urlsplit(sub_request.path)
+    scope = {
+        **request.scope,
+        'method': sub_request.method,
+        'path': url.path,
+        'raw_path': url.path.encode(),
+        'query_string': url.query.encode(),
+        # Заголовки пакета, в том числе Authorization, кроме заголовков его тела
+        'headers': [(name, value) for name, value in request.scope['headers']
+                    if name not in (b'content-length', b'content-type')],
+        'path_params': {},
+    }
+
+    limit = route_limit(sub_request.method, find_route(Request(scope)))
+    if limit is None:
+        return sub_response(*await call_router(request, scope))
+    if not limit.try_acquire():
+        return sub_response(503, json.dumps({'detail': OVERLOADED}).encode())
+
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        status_code, body = await call_router(request, scope)
+    finally:
+        limit.release((time.perf_counter() - started) * 1000, status_code >= 500)
+    return sub_response(status_code, body)
+
+
+@batch_router.post('/', response_model=List[SubResponsePydantic])
+async def run_batch(request: Request, data: List[SubRequestPydantic]):
+
+    """Эта функция выполняет несколько GET-запросов к API одним HTTP-запросом, например запросы, которые
+    приложение делает при запуске. Тело запроса:
+    [
+        {"method": "GET", "path": "/api/v1/users/me"},
+        {"method": "GET", "path": "/api/v1/examples/?offset=0&limit=20"}
+    ]
+    Запросы выполняются одновременно, заголовок Authorization пакета передаётся каждому из них, а токен
+    проверяется один раз: с недействительным токеном весь пакет получает 401. В одном пакете может быть
+    не больше BATCH_MAX_REQUESTS запросов. Ответы возвращаются в порядке запросов в формате:
+    [
+        {
+            "status_code": 200,
+            "body": {...}
+        }
+    ]"""
+
+    if not data:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Batch must not be empty')
+    if len(data) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f'No more than {BATCH_MAX_REQUESTS} requests per batch')
+    for sub_request in data:
+        path = urlsplit(sub_request.path).path
+        if not path.startswith(API_PREFIX) or path.startswith(FORBIDDEN_PREFIXES):
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f'Path {sub_request.path} can not be requested in a batch')
+
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if token:
+        payload = verify_token(token)
+        if payload is None or scheme.lower() != 'bearer':
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid token')
+        verified_tokens.set({token: payload})  # Запросы пакета получают копию контекста с проверенным токеном
+
+    metrics.observe('batch_size', len(data))
+    results = await asyncio.gather(*(dispatch(request, sub_request) for sub_request in data))
+    return json_response(b'[' + b','.join(results) + b']')
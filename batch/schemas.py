@@ -0,0 +1,15 @@
+from typing import Any, Literal
+
+from pydantic import BaseModel
+
+
+class SubRequestPydantic(BaseModel):
+    """Схема одного запроса в пакете: метод и путь с query-параметрами, например /api/v1/examples/?limit=20"""
+    method: Literal['GET'] = 'GET'
+    path: str
+
+
+class SubResponsePydantic(BaseModel):
+    """Схема ответа на один запрос пакета: код ответа и его JSON-тело"""
+    status_code: int
+    body: Any = None
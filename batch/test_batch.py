@@ -0,0 +1,67 @@
+import pytest
+from asgi_lifespan import LifespanManager
+from httpx import AsyncClient, ASGITransport
+
+from core.limiter import limiter
+from main import app
+
+
+"""Файл с тестами"""
+
+
+@pytest.fixture(scope="module")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="module")
+async def client():
+    async with LifespanManager(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://localhost:10000/api/v1") as c:
+            yield c
+
+
+@pytest.mark.anyio
+async def test_batch(client: AsyncClient):
+    get_user_jwt_token = await client.post('/users/login', json={
+        "username": "string",
+        "password": "string"
+    })
+    assert get_user_jwt_token.status_code == 200
+    user_jwt_token = get_user_jwt_token.json().get('access_token')
+    user_jwt_type = get_user_jwt_token.json().get('token_type')
+
+    response = await client.post('/batch/', json=[
+        {"path": "/api/v1/users/me"},
+        {"path": "/api/v1/examples/?offset=0&limit=1"},
+        {"path": "/api/v1/examples/-1"}
+    ], headers={'Authorization': f'{user_jwt_type.capitalize()} {user_jwt_token}'})
+    assert response.status_code == 200
+    profile, examples, missing = response.json()  # Ответы в порядке запросов
+    assert profile['status_code'] == 200
+    assert profile['body']['username'] == 'string'
+    assert examples['status_code'] == 200
+    assert len(examples['body']) == 1
+    assert missing['status_code'] == 404
+
+    fail_response = await client.post('/batch/', json=[{"path": "/api/v1/users/me"}],
+                                      headers={'Authorization': 'Bearer invalid'})
+    assert fail_response.status_code == 401
+    fail_response = await client.post('/batch/', json=[{"path": "/api/v1/batch/"}])
+    assert fail_response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_batch_load_shedding(client: AsyncClient):
+    busy = {limit: int(limit.limit) - 1 - limit.in_flight for limit in limiter.limits.values()}
+    for limit, count in busy.items():  # В каждом классе маршрутов свободно одно место
+        limit.in_flight += count
+    try:
+        response = await client.post('/batch/', json=[{"path": "/api/v1/examples/2"}] * 3)
+        assert response.status_code == 200
+        # Каждый запрос пакета занимает своё место: единственное свободное получает только один из них
+        assert sorted(item['status_code'] for item in response.json()) == [200, 503, 503]
+        assert all(limit.in_flight == int(limit.limit) - 1 for limit in busy)  # Места освобождены
+    finally:
+        for limit, count in busy.items():
+            limit.in_flight -= count
@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+"""Нагрузочный бенчмарк всех маршрутов API. Приложение из main.py запускается локально на SQLite (или на БД из
+--db-url) с кешами в памяти (CACHE_BACKEND=memory) вместо Redis. Запросы идут либо напрямую в ASGI-приложение,
+либо через настоящий сервер uvicorn. Для каждого маршрута считаются RPS и задержки p50/p95/p99 с кешем (hit)
+и без кеша (miss), результат выводится в JSON, чтобы сравнивать прогоны между коммитами. В режиме miss запросы
+идут по одному (effective_concurrency=1), поэтому его RPS сравним только с другими прогонами miss.
+
+Запуск из корня репозитория:
+    python -m benchmarks.http_bench --requests 500 --concurrency 10 --output bench.json
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='HTTP load benchmark for RestAPI-FastAPI')
+    parser.add_argument('--requests', type=int, default=300, help='Запросов на маршрут в каждом режиме')
+    parser.add_argument('--concurrency', type=int, default=10, help='Одновременных запросов')
+    parser.add_argument('--transport', choices=['asgi', 'uvicorn', 'both'], default='both')
+    parser.add_argument('--cache', choices=['memory', 'null'], default='memory',
+                        help='Бэкенд кеша вместо Redis: memory или null для замера БД без кеша')
+    parser.add_argument('--db-url', default=None, help='БД для прогона, по умолчанию временный файл SQLite')
+    parser.add_argument('--examples', type=int, default=200, help='Сколько объектов Example создать')
+    parser.add_argument('--load-shedding', action='store_true',
+                        help='Включить адаптивные лимиты конкурентности, отклонённые запросы считаются ошибками')
+    parser.add_argument('--routes', default='', help='Через запятую: запускать только маршруты с такими именами')
+    parser.add_argument('--output', default='-', help='Файл для JSON-результата, "-" - stdout')
+    return parser.parse_args()
+
+
+ARGS = parse_args() if __name__ == '__main__' else None
+
+if ARGS is not None:
+    """Окружение задаётся до импорта приложения, так как config.py читает его при импорте"""
+    bench_dir = tempfile.mkdtemp(prefix='restapi-bench-')
+    os.environ['DB_URL'] = ARGS.db_url or f'sqlite://{bench_dir}/bench.db'
+    os.environ['STARTUP_MODE'] = 'generate'
+    os.environ['CACHE_BACKEND'] = ARGS.cache
+    os.environ['LOAD_SHEDDING'] = '1' if ARGS.load_shedding else '0'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+from asgi_lifespan import LifespanManager  # noqa: E402
+
+
+def get_caches():
+    """Кеши всех роутеров и кеш запросов, которые очищаются в режиме miss"""
+    from examples.cache import cache as examples_cache
+    from categories.cache import cache as categories_cache
+    from users.cache import cache as users_cache
+    from core.querycache import query_cache
+
+    return [examples_cache, categories_cache, users_cache, query_cache.cache]
+
+
+SPARE_CHUNK = 500  # Строк в одном INSERT при создании запасных объектов
+
+
+async def create_rows(model, rows: list) -> list[int]:
+    """Создаёт строки частями по SPARE_CHUNK, чтобы не упереться в предел параметров одного запроса"""
+    from core.writes import insert_returning
+
+    ids = []
+    for start in range(0, len(rows), SPARE_CHUNK):
+        ids += await insert_returning(model, rows[start:start + SPARE_CHUNK])
+    return ids
+
+
+async def seed(examples_count: int, spare: int = 0) -> dict:
+    """Создаёт данные для прогона и возвращает их идентификаторы. spare - сколько запасных объектов создать
+    для маршрутов, которые расходуют по объекту на запрос: удаление, подтверждение почты и повторная отправка
+    письма. Письма при прогоне не отправляются, чтобы замер не зависел от SMTP"""
+    from categories.models import Category
+    from examples.models import ExampleModel
+    from users import router as users_router
+    from users.auth import pwd_context, create_access_token
+    from users.confirmations import issue_code
+    from users.models import User
+
+    users_router.send_email = lambda *args: None
+    stamp = time.time_ns()
+    category = await Category.create(title=f'bench {stamp}')
+    examples = [ExampleModel(title=f'Example {i}', age=1 + i % 50, price=1 + i % 100, description='x' * 200,
+                             category_id=category.id) for i in range(examples_count)]
+    await ExampleModel.bulk_create(examples)
+    example_ids = await ExampleModel.filter(category_id=category.id).values_list('id', flat=True)
+
+    username = f'bench_{stamp}'
+    password = pwd_context.hash('bench')
+    admin = await User.create(username=username, email=f'{username}@example.com', password=password,
+                              is_superuser=True, confirm_code='bench')
+
+    def spare_users(kind: str) -> list[dict]:
+        return [{'username': f'{kind}_{stamp}_{i}', 'email': f'{kind}_{stamp}_{i}@example.com', 'password': password}
+                for i in range(spare)]
+
+    spare_example_ids = await create_rows(ExampleModel, [
+        {'title': f'Spare {i}', 'price': 1, 'description': 'spare', 'category_id': category.id} for i in range(spare)])
+    spare_category_ids = await create_rows(Category, [{'title': f'spare {stamp} {i}'} for i in range(spare)])
+    spare_user_ids = await create_rows(User, spare_users('delete'))
+    resend_users = spare_users('resend')
+    await create_rows(User, resend_users)
+    confirm_codes = [await issue_code(user_id) for user_id in await create_rows(User, spare_users('confirm'))]
+    return {'category_id': category.id, 'example_ids': list(example_ids), 'user_id': admin.id,
+            'username': username, 'password': 'bench', 'spare_example_ids': spare_example_ids,
+            'spare_category_ids': spare_category_ids, 'spare_user_ids': spare_user_ids, 'confirm_codes': confirm_codes,
+            'resend_tokens': [create_access_token({'sub': user['username']}) for user in resend_users]}
+
+
+"""Маршруты, которые не замеряются: поток событий SSE и WebSocket держат соединение открытым, а не отвечают
+на запрос, поэтому RPS и задержки для них не имеют смысла"""
+EXCLUDED_ROUTES = {'GET /events/stream', 'WS /events/ws'}
+
+
+def take(pool: list):
+    """Генератор, который выдаёт каждый объект пула один раз. Когда пул закончился, выдаёт 0,
+    и запрос к несуществующему объекту считается ошибкой"""
+    items = iter(pool)
+    return lambda: next(items, 0)
+
+
+def build_routes(data: dict, token: str) -> list:
+    """Описания маршрутов: имя, метод, генератор пути, тело запроса, заголовки, кешируется ли он и сколько
+    разных путей он перебирает (distinct). В режиме hit до замера запрашивается каждый из этих путей"""
+    example_ids = data['example_ids']
+    read_ids, write_ids = itertools.cycle(example_ids), itertools.cycle(example_ids)
+    example_body = {'title': 'Bench', 'age': 1, 'price': 1, 'description': 'bench',
+                    'category_id': data['category_id']}
+    titles = (f'bench {time.time_ns()} {i}' for i in itertools.count())
+    registrations = (f'register_{time.time_ns()}_{i}' for i in itertools.count())
+    spare_example, spare_category = take(data['spare_example_ids']), take(data['spare_category_ids'])
+    spare_user, confirm_code = take(data['spare_user_ids']), take(data['confirm_codes'])
+    resend_token = take(data['resend_tokens'])
+    auth = {'Authorization': f'Bearer {token}'}
+    batch_ids = ','.join(map(str, example_ids[:20]))
+    category_id = data['category_id']
+
+    def register():
+        name = next(registrations)
+        return {'username': name, 'password': 'bench', 'email': f'{name}@example.com'}
+
+    return [
+        {'name': 'GET /', 'method': 'GET', 'path': lambda: '/', 'cached': False},
+        {'name': 'GET /ready', 'method': 'GET', 'path': lambda: '/ready', 'cached': False},
+        {'name': 'GET /metrics', 'method': 'GET', 'path': lambda: '/metrics', 'cached': False},
+        {'name': 'GET /examples/', 'method': 'GET', 'path': lambda: '/examples/', 'cached': True},
+        {'name': 'GET /examples/batch', 'method': 'GET', 'path': lambda: f'/examples/batch?ids={batch_ids}',
+         'cached': True},
+        {'name': 'GET /examples/{id}', 'method': 'GET', 'path': lambda: f'/examples/{next(read_ids)}',
+         'cached': True, 'distinct': len(example_ids)},
+        {'name': 'POST /examples/', 'method': 'POST', 'path': lambda: '/examples/', 'headers': auth,
+         'json': lambda: example_body, 'cached': False},
+        {'name': 'POST /examples/bulk', 'method': 'POST', 'path': lambda: '/examples/bulk', 'headers': auth,
+         'json': lambda: [example_body] * 10, 'cached': False},
+        {'name': 'PUT /examples/{id}', 'method': 'PUT', 'path': lambda: f'/examples/{next(write_ids)}',
+         'headers': auth, 'json': lambda: example_body, 'cached': False},
+        {'name': 'DELETE /examples/{id}', 'method': 'DELETE', 'path': lambda: f'/examples/{spare_example()}',
+         'headers': auth, 'cached': False},
+        {'name': 'GET /categories/', 'method': 'GET', 'path': lambda: '/categories/', 'cached': True},
+        {'name': 'GET /categories/batch', 'method': 'GET', 'path': lambda: f'/categories/batch?ids={category_id}',
+         'cached': True},
+        {'name': 'GET /categories/stats', 'method': 'GET', 'path': lambda: '/categories/stats', 'cached': False},
+        {'name': 'GET /categories/{id}/stats', 'method': 'GET', 'path': lambda: f'/categories/{category_id}/stats',
+         'cached': False},
+        {'name': 'GET /categories/{id}', 'method': 'GET', 'path': lambda: f'/categories/{category_id}',
+         'cached': True},
+        {'name': 'POST /categories/', 'method': 'POST', 'path': lambda: '/categories/', 'headers': auth,
+         'json': lambda: {'title': next(titles)}, 'cached': False},
+        {'name': 'PUT /categories/{id}', 'method': 'PUT', 'path': lambda: f'/categories/{category_id}',
+         'headers': auth, 'json': lambda: {'title': next(titles)}, 'cached': False},
+        {'name': 'DELETE /categories/{id}', 'method': 'DELETE', 'path': lambda: f'/categories/{spare_category()}',
+         'headers': auth, 'cached': False},
+        {'name': 'POST /users/register', 'method': 'POST', 'path': lambda: '/users/register', 'json': register,
+         'cached': False},
+        {'name': 'POST /users/confirm-email/{id}', 'method': 'POST',
+         'path': lambda: f'/users/confirm-email/{confirm_code()}', 'cached': False},
+        {'name': 'POST /users/resend-confirmation', 'method': 'POST', 'path': lambda: '/users/resend-confirmation',
+         'headers': lambda: {'Authorization': f'Bearer {resend_token()}'}, 'cached': False},
+        {'name': 'POST /users/login', 'method': 'POST', 'path': lambda: '/users/login', 'cached': False,
+         'json': lambda: {'username': data['username'], 'password': data['password']}},
+        {'name': 'GET /users/me', 'method': 'GET', 'path': lambda: '/users/me', 'headers': auth, 'cached': True},
+        {'name': 'GET /users/', 'method': 'GET', 'path': lambda: '/users/', 'cached': True},
+        {'name': 'GET /users/batch', 'method': 'GET', 'path': lambda: f'/users/batch?ids={data["user_id"]}',
+         'cached': True},
+        {'name': 'GET /users/available', 'method': 'GET',
+         'path': lambda: f'/users/available?username={next(registrations)}', 'cached': False},
+        {'name': 'GET /users/{id}', 'method': 'GET', 'path': lambda: f'/users/{data["user_id"]}', 'cached': True},
+        {'name': 'PUT /users/{id}', 'method': 'PUT', 'path': lambda: f'/users/{data["user_id"]}', 'headers': auth,
+         'json': lambda: {'username': data['username']}, 'cached': False},
+        {'name': 'DELETE /users/{id}', 'method': 'DELETE', 'path': lambda: f'/users/{spare_user()}', 'headers': auth,
+         'cached': False},
+        {'name': 'POST /batch/', 'method': 'POST', 'path': lambda: '/batch/', 'headers': auth, 'cached': True,
+         'json': lambda: [{'path': '/api/v1/users/me'}, {'path': '/api/v1/examples/'},
+                          {'path': f'/api/v1/categories/{category_id}'}]},
+    ]
+
+
+SLOW_ROUTES = {'POST /users/login', 'POST /users/register'}  # Хеширование пароля: запросов в 10 раз меньше
+
+
+def percentile(latencies: list, point: int) -> float:
+    if len(latencies) < 2:
+        return latencies[0] if latencies else 0.0
+    return statistics.quantiles(latencies, n=100, method='inclusive')[point - 1]
+
+
+async def run_route(client: httpx.AsyncClient, route: dict, caches: list, mode: str, total: int,
+                    concurrency: int) -> dict:
+    """Прогоняет total запросов к маршруту. В режиме miss кеши очищаются перед каждым запросом,
+    и очистка не входит в замер. Очистка и запрос в этом режиме идут по одному, поэтому его RPS получен
+    без конкурентности и в результате отмечен effective_concurrency=1"""
+    latencies = []
+    errors = 0
+    counter = itertools.count()
+    lock = asyncio.Lock()
+
+    async def one_request():
+        nonlocal errors
+        headers = route.get('headers')
+        kwargs = {'headers': headers() if callable(headers) else headers}
+        if 'json' in route:
+            kwargs['json'] = route['json']()
+        started = time.perf_counter()
+        response = await client.request(route['method'], route['path'](), **kwargs)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 400:
+            errors += 1
+
+    async def worker():
+        while next(counter) < total:
+            if mode == 'miss':
+                async with lock:  # Очистка и запрос идут по одному, чтобы другой запрос не прогрел кеш
+                    for cache in caches:
+                        await cache.clear()
+                    await one_request()
+            else:
+                await one_request()
+
+    if mode == 'hit':
+        for _ in range(route.get('distinct', 1)):  # Прогрев кеша по каждому пути маршрута
+            await one_request()
+        latencies.clear()
+        errors = 0
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'route': route['name'],
+        'cache': mode,
+        'requests': len(latencies),
+        'errors': errors,
+        'effective_concurrency': 1 if mode == 'miss' else concurrency,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+async def run_suite(client: httpx.AsyncClient, routes: list, caches: list, transport: str) -> list:
+    results = []
+    for route in routes:
+        for mode in (('hit', 'miss') if route['cached'] else ('none',)):
+            total = ARGS.requests if route['name'] not in SLOW_ROUTES else max(ARGS.requests // 10, 1)
+            result = await run_route(client, route, caches, mode, total, ARGS.concurrency)
+            result['transport'] = transport
+            results.append(result)
+            print(f'{transport:8} {result["route"]:34} {mode:5} {result["rps"]:>10} rps '
+                  f'x{result["effective_concurrency"]} p50={result["p50_ms"]}ms p95={result["p95_ms"]}ms '
+                  f'p99={result["p99_ms"]}ms errors={result["errors"]}', file=sys.stderr)
+    return results
+
+
+async def serve_uvicorn(app):
+    """Запускает uvicorn в текущем event loop на свободном порту и возвращает сервер и его адрес"""
+    config = uvicorn.Config(app, host='127.0.0.1', port=0, lifespan='off', log_level='warning', access_log=False)
+    server = uvicorn.Server(config)
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, f'http://127.0.0.1:{port}/api/v1'
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run():
+    from main import app
+
+    caches = get_caches()
+    results = []
+    async with LifespanManager(app):
+        data = await seed(ARGS.examples, spare=ARGS.requests * (2 if ARGS.transport == 'both' else 1))
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench/api/v1') as c:
+            login = await c.post('/users/login', json={'username': data['username'], 'password': data['password']})
+            routes = build_routes(data, login.json()['access_token'])
+            if ARGS.routes:
+                selected = {name.strip() for name in ARGS.routes.split(',')}
+                routes = [route for route in routes if route['name'] in selected]
+
+            if ARGS.transport in ('asgi', 'both'):
+                results += await run_suite(c, routes, caches, 'asgi')
+
+        if ARGS.transport in ('uvicorn', 'both'):
+            server, task, base_url = await serve_uvicorn(app)
+            limits = httpx.Limits(max_connections=ARGS.concurrency)
+            async with httpx.AsyncClient(base_url=base_url, limits=limits) as c:
+                results += await run_suite(c, routes, caches, 'uvicorn')
+            server.should_exit = True
+            await task
+
+    report = {
+        'meta': {
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'db_url': os.environ['DB_URL'],
+            'cache': os.environ['CACHE_BACKEND'],
+            'load_shedding': ARGS.load_shedding,
+            'requests': ARGS.requests,
+            'concurrency': ARGS.concurrency,
+            'examples': ARGS.examples,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if ARGS.output == '-':
+        print(output)
+    else:
+        with open(ARGS.output, 'w') as file:
+            file.write(output)
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
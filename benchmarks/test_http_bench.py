@@ -0,0 +1,71 @@
+import re
+
+import pytest
+from aiocache.serializers import JsonSerializer
+from asgi_lifespan import LifespanManager
+from httpx import AsyncClient, ASGITransport
+
+from benchmarks.http_bench import EXCLUDED_ROUTES, build_routes, percentile, run_route
+from core.cache import create_cache
+from main import app
+
+
+"""Файл с тестами"""
+
+
+@pytest.fixture(scope="module")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="module")
+async def client():
+    async with LifespanManager(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://localhost:10000/api/v1") as c:
+            yield c
+
+
+def test_percentile():
+    latencies = [float(latency) for latency in range(1, 101)]
+    assert percentile(latencies, 50) == 50.5
+    assert percentile(latencies, 99) == 99.01
+    assert percentile([3.0], 95) == 3.0
+    assert percentile([], 95) == 0.0
+
+
+def test_routes():
+    """Бенчмарк обращается ко всем маршрутам API, кроме потоков событий, и только к существующим маршрутам"""
+    data = {'example_ids': [1, 2], 'category_id': 1, 'user_id': 1, 'username': 'bench', 'password': 'bench',
+            'spare_example_ids': [3], 'spare_category_ids': [2], 'spare_user_ids': [2], 'confirm_codes': ['code'],
+            'resend_tokens': ['token']}
+    app_routes = set()
+    for route in app.routes:
+        if route.path.startswith('/api/v1'):
+            path = re.sub(r'{\w+}', '{id}', route.path.removeprefix('/api/v1'))
+            app_routes |= {f'{method} {path}' for method in getattr(route, 'methods', None) or ('WS',)}
+    routes = build_routes(data, 'token')
+    assert {route['name'] for route in routes} | EXCLUDED_ROUTES == app_routes
+    for route in routes:
+        assert route['path']().startswith('/')
+
+
+@pytest.mark.anyio
+async def test_run_route(client: AsyncClient):
+    cache = create_cache('bench', JsonSerializer(), backend='memory')
+    route = {'name': 'GET /', 'method': 'GET', 'path': lambda: '/', 'cached': False}
+
+    await cache.set('key', 1)
+    result = await run_route(client, route, [cache], 'miss', total=20, concurrency=4)
+    assert await cache.get('key') is None  # В режиме miss кеши очищаются перед запросами
+    assert {key: result[key] for key in ('route', 'cache', 'requests', 'errors', 'effective_concurrency')} == {
+        "route": "GET /",
+        "cache": "miss",
+        "requests": 20,
+        "errors": 0,
+        "effective_concurrency": 1
+    }
+    assert 0 < result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+    assert result['rps'] > 0
+
+    result = await run_route(client, route, [cache], 'hit', total=5, concurrency=2)
+    assert result['requests'] == 5  # Запрос прогрева не входит в замер
@@ -1,9 +1,9 @@
-from aiocache.backends.redis import RedisCache
 from aiocache.serializers import JsonSerializer
 
-from config import REDIS_HOST, REDIS_PORT, REDIS_TTL
+from core.cache import create_cache
 
-"""Настройки кеша через редис. Используется 2 база данных. Время хранения кеша равно 60 секундам"""
+"""Настройки кеша. Бэкенд задаётся CACHE_BACKEND, ключи хранятся с префиксом categories. Время хранения кеша
+задаётся REDIS_TTL"""
 
 
-cache = RedisCache(serializer=JsonSerializer(), endpoint=REDIS_HOST, port=REDIS_PORT, db=2, ttl=REDIS_TTL)
+cache = create_cache(serializer=JsonSerializer(), namespace='categories')
@@ -1,17 +1,7 @@
-import logging
-import sys
+from core.logger import get_logger
 
 
-"""Конфигурация логгера"""
+"""Конфигурация логгера. Вывод идёт через общую неблокирующую очередь из core.logger"""
 
 
-category_logger = logging.Logger(name='example_logger')
-handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter(
-    fmt="%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
-
-handler.setFormatter(formatter)
-category_logger.addHandler(handler)
-category_logger.setLevel(logging.DEBUG)
\ No newline at end of file
+category_logger = get_logger('category_logger')
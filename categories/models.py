@@ -7,6 +7,23 @@ from tortoise import models, fields
 class Category(models.Model):
     id = fields.IntField(pk=True)
     title = fields.CharField(max_length=50, unique=True, null=False)
+    version = fields.IntField(default=1)  # Увеличивается при каждом обновлении, нужен для записи в кеш
 
     class Meta:
         table = 'Category'
+
+
+class CategoryStats(models.Model):
+    """Агрегаты объектов Example по категории. Обновляются приращениями при каждом изменении объектов
+    и периодически сверяются с таблицей Example"""
+    id = fields.IntField(pk=True)
+    category: fields.OneToOneRelation[Category] = fields.OneToOneField(
+        'models.Category', related_name='stats', on_delete=fields.OnDelete.CASCADE)
+    examples_count = fields.IntField(default=0)
+    price_sum = fields.DecimalField(max_digits=16, decimal_places=2, default=0)
+    price_min = fields.DecimalField(max_digits=10, decimal_places=2, null=True)
+    price_max = fields.DecimalField(max_digits=10, decimal_places=2, null=True)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = 'CategoryStats'
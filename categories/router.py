@@ -1,13 +1,24 @@
 from typing import List
 
-from fastapi import APIRouter, Query, Depends
+from fastapi import APIRouter, Query, Depends, BackgroundTasks
+from pydantic import TypeAdapter
 from starlette import status
 from starlette.exceptions import HTTPException
 
-from categories.models import Category
-from categories.schemas import ListCategoryPydantic, CreateCategoryPydantic
+from categories.models import Category, CategoryStats
+from categories.schemas import (ListCategoryPydantic, CreateCategoryPydantic, BatchCategoryPydantic,
+                                CategoryStatsPydantic)
 from categories.cache import cache
 
+from core.batch import parse_ids, load_many, batch_response
+from core.cache import is_tombstone
+from core.db import model_row
+from core.hotkeys import hot_keys
+from core.events import event_bus
+from core.querycache import query_cache
+from core.responses import json_response
+from core.writes import update_returning
+
 from examples.schemas import Status
 from users.auth import verify_token
 from users.models import User
@@ -17,6 +28,9 @@ from users.router import oauth2_scheme
 """Инициализация роутера"""
 category_router = APIRouter(prefix='/categories', tags=['categories'])
 
+categories_adapter = TypeAdapter(List[ListCategoryPydantic])  # Схема ответа get_categories для сериализации при промахе
+query_cache.register(Category)  # Кеш списков сбрасывается при любом изменении таблицы категорий
+
 
 @category_router.get('/', response_model=List[ListCategoryPydantic])
 async def get_categories(offset: int = Query(0), limit: int = Query(10),
@@ -33,11 +47,9 @@ async def get_categories(offset: int = Query(0), limit: int = Query(10),
         ]
         Она поддерживает пагинацию через offset и limit, сортировку через order_by(по умолчанию стоит сортировка по id)
         и фильтры. Они идут после order_by в параметрах функции и представляют собой query-запросы.
-        В случае если нет ни одного объекта, выводится пустой список []"""
-
-    cached_categories = await cache.get('categories')  # Пытаемся взять данные из кеша
-    if cached_categories:
-        return cached_categories
+        В случае если нет ни одного объекта, выводится пустой список []
+        Готовое JSON-тело ответа кешируется отдельно для каждого SQL-запроса и при попадании отдаётся
+        без валидации и сериализации"""
 
     filters = {}
     if title:
@@ -47,15 +59,98 @@ async def get_categories(offset: int = Query(0), limit: int = Query(10),
 
     if filters:
         """Получение результата с фильтрами через распаковку словаря **filters"""
-        categories = await Category.filter(**filters).offset(offset).limit(limit).all().order_by(order_by).values()
-        await cache.set('categories', categories)  # Запись результата в кеш
+        categories = Category.filter(**filters).offset(offset).limit(limit).all().order_by(order_by).values()
 
     else:
         """Получение результата без фильтров"""
-        categories = await Category.filter().offset(offset).limit(limit).all().order_by(order_by).values()
-        await cache.set('categories', categories)  # Запись результата в кеш
+        categories = Category.filter().offset(offset).limit(limit).all().order_by(order_by).values()
+
+    # Ответ из кеша запросов или из БД с валидацией и сериализацией при промахе
+    return json_response(await query_cache.body(categories, categories_adapter))
+
+
+async def warm_up_cache(keys: list):
+    """Прогрев кеша при запуске воркера: самые запрашиваемые категории загружаются одним запросом к БД,
+    а первая страница get_categories - если её ещё нет в кеше"""
+    category_ids = [int(key.removeprefix('category_')) for key in keys if key.startswith('category_')]
+    if category_ids:
+        await load_many(cache, Category, category_ids, 'category')
+    await query_cache.body(Category.filter().offset(0).limit(10).all().order_by('id').values(), categories_adapter)
 
-    return categories
+
+hot_keys.register(cache.namespace, warm_up_cache)
+
+
+@category_router.get('/batch', response_model=List[BatchCategoryPydantic])
+async def get_categories_batch(ids: str = Query(..., description='id категорий через запятую: 1,2,3')):
+
+    """Эта функция выводит несколько категорий по списку id в порядке запроса в формате:
+        [
+            {
+                "id": 0,
+                "found": true,
+                "item": {
+                    "id": 0,
+                    "title": "string"
+                }
+            }
+        ]
+        Все id читаются из кеша одним запросом, недостающие берутся из БД одним запросом и записываются в кеш.
+        Для несуществующих категорий found равен false, а item - null"""
+
+    category_ids = parse_ids(ids)
+    found = await load_many(cache, Category, category_ids, 'category')
+    return batch_response(category_ids, found)
+
+
+def stats_response(stats: dict) -> dict:
+    """Средняя цена считается из суммы и количества, которые хранятся в таблице статистики"""
+    count = stats['examples_count']
+    return {
+        'category_id': stats['category_id'],
+        'examples_count': count,
+        'price_min': stats['price_min'],
+        'price_avg': round(stats['price_sum'] / count, 2) if count else None,
+        'price_max': stats['price_max'],
+    }
+
+
+@category_router.get('/stats', response_model=List[CategoryStatsPydantic])
+async def get_categories_stats(offset: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
+
+    """Эта функция выводит статистику категорий, в которых есть объекты Example, по 10 штук в формате:
+        [
+            {
+                "category_id": 0,
+                "examples_count": 0,
+                "price_min": 0,
+                "price_avg": 0,
+                "price_max": 0
+            }
+        ]
+        Статистика читается из заранее посчитанной таблицы, а не считается по объектам Example.
+        Строки категорий, из которых удалили последний объект, остаются с нулевым количеством до reconcile"""
+
+    stats = await (CategoryStats.filter(examples_count__gt=0).order_by('category_id').offset(offset).limit(limit)
+                   .values())
+    return [stats_response(item) for item in stats]
+
+
+@category_router.get('/{category_id}/stats', response_model=CategoryStatsPydantic)
+async def get_category_stats(category_id: int):
+
+    """Эта функция выводит статистику объектов Example в категории: количество объектов, минимальную,
+        среднюю и максимальную цену. Формат ответа такой же, как у элемента списка /categories/stats.
+        Если категория не существует, пробрасывается ошибка 404"""
+
+    stats = await CategoryStats.filter(category_id=category_id, examples_count__gt=0).first().values()
+    if stats:
+        return stats_response(stats)
+    elif await Category.exists(id=category_id):
+        """В категории нет объектов"""
+        return {'category_id': category_id, 'examples_count': 0}
+    else:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Category not found')
 
 
 @category_router.get('/{category_id}', response_model=ListCategoryPydantic)
@@ -66,25 +161,32 @@ async def get_category(category_id: int):
             "id": 0,
             "title": "string"
         }
-        Если категория не существует, пробрасывается ошибка 404"""
+        Если категория не существует, пробрасывается ошибка 404. Отсутствие категории тоже кешируется
+        на короткое время"""
 
+    hot_keys.record(cache.namespace, f'category_{category_id}')  # Учёт обращения для прогрева кеша новых воркеров
     cached_obj = await cache.get(f'category_{category_id}')  # Попытка получения кеша
+    if cached_obj and is_tombstone(cached_obj):
+        """Категории нет, и это уже известно по кешу"""
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Category not found')
     if cached_obj:
         return cached_obj  # Если кеш есть, то возвращаем его
 
     category_obj = await Category.filter(id=category_id).first().values()  # Получение объекта
     if category_obj:
         """В случае если категория найдена"""
-        if not cached_obj:
-            await cache.set(f'category_{category_id}', category_obj)  # Сохранение в кеш, если его нету
+        # Сохранение в кеш, если там нет более новой версии, записанной обновлением
+        await cache.set_if_newer([(f'category_{category_id}', category_obj, category_obj['version'])])
         return category_obj
     else:
         """В случае если категория не найдена пробрасывается 404 ошибка"""
+        await cache.bury(f'category_{category_id}')  # Метка отсутствия, чтобы повторные запросы не шли в БД
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Category not found')
 
 
 @category_router.post('/', response_model=ListCategoryPydantic)
-async def create_category(data: CreateCategoryPydantic, token: str = Depends(oauth2_scheme)):
+async def create_category(data: CreateCategoryPydantic, background_tasks: BackgroundTasks,
+                          token: str = Depends(oauth2_scheme)):
 
     """Эта функция отвечает за создание категории. Её могут пользоваться только супер юзеры, в противном
         случае будет проброшена ошибка 403 Forbidden. Валидация пользователя происходит через JWT-токен и
@@ -101,7 +203,9 @@ async def create_category(data: CreateCategoryPydantic, token: str = Depends(oau
     if user.is_superuser:
 
         cat_obj = await Category.create(**data.model_dump())  # Создаём объект
-        await cache.delete('categories')   # Удаляем кеш, который создавали в функции get_categories для его обновления
+        # Записываем категорию в кеш. Кеш списков get_categories сбрасывается сам при записи в таблицу
+        await cache.write_through({f'category_{cat_obj.id}': model_row(cat_obj)})
+        background_tasks.add_task(event_bus.publish, 'category', 'created', model_row(cat_obj), category_id=cat_obj.id)
         return cat_obj
     else:
         """Если пользователь не является супер юзером, то пробрасывается ошибка 403"""
@@ -109,7 +213,8 @@ async def create_category(data: CreateCategoryPydantic, token: str = Depends(oau
 
 
 @category_router.put('/{category_id}', response_model=ListCategoryPydantic)
-async def update_category(category_id: int, data: CreateCategoryPydantic, token: str = Depends(oauth2_scheme)):
+async def update_category(category_id: int, data: CreateCategoryPydantic, background_tasks: BackgroundTasks,
+                          token: str = Depends(oauth2_scheme)):
 
     """Эта функция отвечает за обновление категории по ее id. Использовать функцию могут только
         супер юзеры, в противном случае будет проброшена ошибка 403 Forbidden. Валидация пользователя происходит через
@@ -122,32 +227,24 @@ async def update_category(category_id: int, data: CreateCategoryPydantic, token:
         Данные для обновления валидируются через pydantic """
 
     payload = verify_token(token)
-    user = await User.get(username=payload.get('sub'))  # Получаем пользователя из БД через токен
-    if user.is_superuser:
+    # Проверка прав пользователя из токена, обновление и получение обновленной категории одним запросом к БД
+    cat_obj = await update_returning(Category, category_id, data.model_dump(), payload.get('sub'))
+    if cat_obj:
+        """Если объект обновлен, то сохраняем его в кеш и отдаем пользователю"""
+        await cache.write_through({f'category_{category_id}': cat_obj})  # Записываем новую версию категории в кеш
+        background_tasks.add_task(event_bus.publish, 'category', 'updated', cat_obj, category_id=category_id)
 
-        cat_obj = await Category.filter(id=category_id).update(**data.model_dump())  # Пытаемся обновить объект
-        if cat_obj:  # int
-            """Если объект обновлен, то мы берем его из БД, сохраняем в кеш и отдаем пользователю"""
-            cat_obj = await Category.filter(id=category_id).first().values()
-
-            cached_obj = await cache.get(f'category_{category_id}')  # Получаем кеш и удаляем его, если он есть
-            if cached_obj:
-                await cache.delete(f'category_{category_id}')
-            await cache.delete('categories')  # Удаляем кеш, который создавали в функции get_categories для его
-            # обновления
-
-            """Если объект был обновлен, то возвращаем ответ"""
-            return cat_obj
-        else:
-            """Если объект не был обновлен, то пробрасываем ошибку 404"""
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Category {category_id} not found')
-    else:
+        return cat_obj
+    elif not await User.filter(username=payload.get('sub'), is_superuser=True).exists():
         """Если пользователь не является супер юзером, то пробрасываем ошибку 403"""
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You have not enough permissions')
+    else:
+        """Если объект не был обновлен, то пробрасываем ошибку 404"""
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Category {category_id} not found')
 
 
 @category_router.delete('/{category_id}', response_model=Status)
-async def delete_category(category_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_category(category_id: int, background_tasks: BackgroundTasks, token: str = Depends(oauth2_scheme)):
 
     """Эта функция отвечает за удаление категории по ее id. Использовать функцию могут только
         супер юзеры, в противном случае будет проброшена ошибка 403 Forbidden. Валидация пользователя происходит через
@@ -169,10 +266,10 @@ async def delete_category(category_id: int, token: str = Depends(oauth2_scheme))
             """Если объект не был удален, то пробрасываем ошибку 404"""
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Category {category_id} not found')
 
-        cached_example = cache.get(f'category_{category_id}')  # Получаем кеш и удаляем его, если он есть
-        if cached_example:
-            await cache.delete(f'category_{category_id}')
-        await cache.delete('categories')  # Удаляем кеш, который создавали в функции get_categories для его обновления
+        # Удаляем кеш самой категории. Кеш списков категорий и объектов Example сбрасывается сам
+        await cache.invalidate(f'category_{category_id}')
+        background_tasks.add_task(event_bus.publish, 'category', 'deleted', {'id': category_id},
+                                  category_id=category_id)
 
         """Если объект был удален, то возвращаем ответ"""
         return Status(status_code=200, message=f'Category {category_id} deleted')
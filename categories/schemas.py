@@ -7,6 +7,22 @@ class ListCategoryPydantic(BaseModel):
     title: str
 
 
+class BatchCategoryPydantic(BaseModel):
+    """Схема элемента ответа пакетного получения категорий. Если категории нет, found равен False"""
+    id: int
+    found: bool
+    item: ListCategoryPydantic | None = None
+
+
 class CreateCategoryPydantic(BaseModel):
     """Схема по которой создаются категории"""
     title: str = Field(max_length=50)
+
+
+class CategoryStatsPydantic(BaseModel):
+    """Схема статистики объектов Example в категории. Для категории без объектов цены равны null"""
+    category_id: int
+    examples_count: int
+    price_min: float | None = None
+    price_avg: float | None = None
+    price_max: float | None = None
@@ -0,0 +1,140 @@
+import asyncio
+import math
+import os
+import time
+from decimal import Decimal
+
+from tortoise import connections
+from tortoise.transactions import in_transaction
+
+from categories.logger import category_logger
+from config import CACHE_BACKEND
+from categories.models import CategoryStats
+from core.cache import UNAVAILABLE, get_redis_client, redis_call
+from core.db import QueryParams, db_value
+from core.metrics import metrics
+from examples.models import ExampleModel
+
+
+"""Статистика объектов Example по категориям: количество, сумма, минимум и максимум цены.
+Статистика не пересчитывается запросом с GROUP BY, а меняется приращениями при создании, изменении и удалении
+объектов. Расхождения, например после падения между записью объекта и статистики, исправляет reconcile"""
+
+
+STATS = CategoryStats._meta.db_table
+EXAMPLES = ExampleModel._meta.db_table
+COLUMNS = '"category_id", "examples_count", "price_sum", "price_min", "price_max", "updated_at"'
+
+"""Цена хранится в sqlite строкой, поэтому цены сравниваются после приведения к числу"""
+UPSERT_SQL = f'''ON CONFLICT ("category_id") DO UPDATE SET
+    "examples_count" = "{STATS}"."examples_count" + EXCLUDED."examples_count",
+    "price_sum" = "{STATS}"."price_sum" + EXCLUDED."price_sum",
+    "price_min" = CASE WHEN "{STATS}"."price_min" IS NULL
+        OR CAST(EXCLUDED."price_min" AS NUMERIC) < CAST("{STATS}"."price_min" AS NUMERIC)
+        THEN EXCLUDED."price_min" ELSE "{STATS}"."price_min" END,
+    "price_max" = CASE WHEN "{STATS}"."price_max" IS NULL
+        OR CAST(EXCLUDED."price_max" AS NUMERIC) > CAST("{STATS}"."price_max" AS NUMERIC)
+        THEN EXCLUDED."price_max" ELSE "{STATS}"."price_max" END,
+    "updated_at" = EXCLUDED."updated_at"'''
+
+
+def to_db(connection, value: Decimal):
+    """Цена в том виде, в котором её принимает драйвер БД"""
+    return db_value(connection, CategoryStats._meta.fields_map['price_sum'], value)
+
+
+async def record_added(rows: list):
+    """Добавляет в статистику новые объекты. rows - словари с полями category_id и price.
+    Для всех категорий выполняется один запрос INSERT ... ON CONFLICT DO UPDATE"""
+    totals = {}
+    for row in rows:
+        price = Decimal(str(row['price']))
+        count, total, low, high = totals.get(row['category_id'], (0, Decimal(0), price, price))
+        totals[row['category_id']] = (count + 1, total + price, min(low, price), max(high, price))
+    if not totals:
+        return
+
+    connection = connections.get('default')
+    param = QueryParams(connection)
+    values = ', '.join(f'({param(category_id)}, {param(count)}, {param(to_db(connection, total))}, '
+                       f'{param(to_db(connection, low))}, {param(to_db(connection, high))}, CURRENT_TIMESTAMP)'
+                       for category_id, (count, total, low, high) in totals.items())
+    await connection.execute_query(f'INSERT INTO "{STATS}" ({COLUMNS}) VALUES {values} {UPSERT_SQL}', param)
+
+
+async def record_removed(row: dict):
+    """Убирает из статистики удалённый объект или прежнюю версию изменённого объекта. Вызывается после записи
+    в таблицу Example. Минимум и максимум пересчитываются по категории, только если удалённая цена была одним из них"""
+    connection = connections.get('default')
+    param = QueryParams(connection)
+    price = to_db(connection, Decimal(str(row['price'])))
+
+    def extreme(function: str) -> str:
+        """Подзапрос минимума или максимума цены по категории. Плейсхолдеры sqlite позиционные,
+        поэтому каждый параметр добавляется в том месте запроса, где он стоит"""
+        return (f'(SELECT {function}(CAST("price" AS NUMERIC)) FROM "{EXAMPLES}" '
+                f'WHERE "category_id" = {param(row['category_id'])})')
+
+    await connection.execute_query(f'''UPDATE "{STATS}" SET
+        "examples_count" = "examples_count" - 1,
+        "price_sum" = "price_sum" - {param(price)},
+        "price_min" = CASE WHEN CAST("price_min" AS NUMERIC) < CAST({param(price)} AS NUMERIC)
+            THEN "price_min" ELSE {extreme('MIN')} END,
+        "price_max" = CASE WHEN CAST("price_max" AS NUMERIC) > CAST({param(price)} AS NUMERIC)
+            THEN "price_max" ELSE {extreme('MAX')} END,
+        "updated_at" = CURRENT_TIMESTAMP
+        WHERE "category_id" = {param(row['category_id'])}''', param)
+
+
+async def record_updated(old: dict, new: dict):
+    """Переносит изменённый объект в статистике. Если категория и цена не изменились, статистика не меняется"""
+    if old['category_id'] == new['category_id'] and Decimal(str(old['price'])) == Decimal(str(new['price'])):
+        return
+    await record_removed(old)
+    await record_added([new])
+
+
+async def reconcile():
+    """Пересчитывает статистику всех категорий по таблице Example и исправляет накопившиеся расхождения"""
+    started = time.perf_counter()
+    async with in_transaction() as connection:
+        await connection.execute_query(f'''INSERT INTO "{STATS}" ({COLUMNS})
+            SELECT "category_id", COUNT(*), SUM("price"), MIN(CAST("price" AS NUMERIC)), MAX(CAST("price" AS NUMERIC)),
+                CURRENT_TIMESTAMP
+            FROM "{EXAMPLES}" WHERE 1 = 1 GROUP BY "category_id"
+            ON CONFLICT ("category_id") DO UPDATE SET
+                "examples_count" = EXCLUDED."examples_count", "price_sum" = EXCLUDED."price_sum",
+                "price_min" = EXCLUDED."price_min", "price_max" = EXCLUDED."price_max",
+                "updated_at" = EXCLUDED."updated_at"''')
+        await connection.execute_query(
+            f'DELETE FROM "{STATS}" WHERE "category_id" NOT IN (SELECT "category_id" FROM "{EXAMPLES}")')
+
+    duration_ms = (time.perf_counter() - started) * 1000
+    metrics.observe('category_stats_reconcile_ms', duration_ms)
+    category_logger.info('Category stats reconciled in %.1f ms', duration_ms)
+
+
+RECONCILE_LOCK = 'category_stats_reconcile'  # Ключ Redis воркера, который выполняет сверку в текущем интервале
+
+
+async def reconcile_turn(interval: float, backend: str = CACHE_BACKEND) -> bool:
+    """Выполнять ли сверку этому воркеру. С Redis сверку за интервал выполняет только воркер, который первым
+    занял ключ RECONCILE_LOCK на interval секунд, в том числе среди воркеров других серверов. Без Redis воркеры
+    не могут договориться, поэтому сверка выполняется, только если воркер один"""
+    if backend != 'redis':
+        # WEB_CONCURRENCY задаёт serve.py уже после импорта config, поэтому значение читается при вызове
+        return int(os.environ.get('WEB_CONCURRENCY', 1)) <= 1
+    acquired = await redis_call(lambda: get_redis_client().set(RECONCILE_LOCK, os.getpid(), nx=True,
+                                                               ex=math.ceil(interval)))
+    return acquired is not UNAVAILABLE and bool(acquired)
+
+
+async def reconcile_periodically(interval: float):
+    """Фоновая задача воркера: раз в interval секунд сверяет статистику, если сейчас очередь этого воркера"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await reconcile_turn(interval):
+                await reconcile()
+        except Exception:
+            category_logger.exception('Category stats reconciliation failed')
@@ -3,6 +3,9 @@ from asgi_lifespan import LifespanManager
 from httpx import AsyncClient, ASGITransport
 
 from categories.models import Category
+from categories.stats import RECONCILE_LOCK, reconcile, reconcile_turn
+from core.cache import get_redis_client
+from examples.models import ExampleModel
 from main import app
 
 
@@ -41,6 +44,27 @@ async def test_get_category(client: AsyncClient):
     assert fail_response.status_code == 404
 
 
+@pytest.mark.anyio
+async def test_get_categories_batch(client: AsyncClient):
+    response = await client.get('/categories/batch?ids=1,-1')
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "id": 1,
+            "found": True,
+            "item": {
+                "id": 1,
+                "title": "string"
+            }
+        },
+        {
+            "id": -1,
+            "found": False,
+            "item": None
+        }
+    ]
+
+
 @pytest.mark.anyio
 async def test_get_categories(client: AsyncClient):
     response = await client.get('/categories/')
@@ -149,6 +173,8 @@ async def test_update_category(client: AsyncClient):
         "id": last_category_id,
         "title": "STRING",
     }
+    # Проверка прав, обновление и чтение категории - один запрос UPDATE ... RETURNING (раньше было 3 запроса)
+    assert response.headers['X-DB-Query-Count'] == '1'
 
     fail_response = await client.put(f'/categories/-1', json=example_data,
                                      headers={'Authorization': f'{admin_jwt_type.capitalize()} {admin_jwt_token}'})
@@ -201,3 +227,83 @@ async def test_delete_category(client: AsyncClient):
     fail_response = await client.delete('/categories/-1',
                                         headers={'Authorization': f'{user_jwt_type.capitalize()} {user_jwt_token}'})
     assert fail_response.status_code == 403
+
+
+@pytest.mark.anyio
+async def test_category_stats(client: AsyncClient):
+    await reconcile()  # Статистика объектов, которые уже есть в тестовой БД
+    response = await client.get('/categories/1/stats')
+    assert response.status_code == 200
+    examples_count = response.json()['examples_count']
+    assert examples_count == await ExampleModel.filter(category_id=1).count()
+
+    get_admin_jwt_token = await client.post('/users/login', json={
+        "username": "Riwick",
+        "password": "string"
+    })
+    admin_jwt_token = get_admin_jwt_token.json().get('access_token')
+    admin_jwt_type = get_admin_jwt_token.json().get('token_type')
+    headers = {'Authorization': f'{admin_jwt_type.capitalize()} {admin_jwt_token}'}
+
+    create_response = await client.post('/examples/', json={
+        "title": "Stats",
+        "age": 1,
+        "price": 99999,
+        "description": "string",
+        "category_id": 1
+    }, headers=headers)
+    assert create_response.status_code == 200
+
+    response = await client.get('/categories/1/stats')  # Статистика изменилась без пересчёта
+    assert response.json()['examples_count'] == examples_count + 1
+    assert response.json()['price_max'] == 99999
+
+    delete_response = await client.delete(f'/examples/{create_response.json()["id"]}', headers=headers)
+    assert delete_response.status_code == 200
+
+    response = await client.get('/categories/1/stats')
+    assert response.json()['examples_count'] == examples_count
+
+    list_response = await client.get('/categories/stats')
+    assert list_response.status_code == 200
+    assert response.json() in list_response.json()
+
+    fail_response = await client.get('/categories/-1/stats')
+    assert fail_response.status_code == 404
+
+    category_response = await client.post('/categories/', json={"title": "Stats"}, headers=headers)
+    assert category_response.status_code == 200
+    category_id = category_response.json()['id']
+    create_response = await client.post('/examples/', json={
+        "title": "Stats",
+        "age": 1,
+        "price": 5,
+        "description": "string",
+        "category_id": category_id
+    }, headers=headers)
+    assert create_response.status_code == 200
+    list_response = await client.get('/categories/stats?limit=1000')
+    assert category_id in [item['category_id'] for item in list_response.json()]
+
+    await client.delete(f'/examples/{create_response.json()["id"]}', headers=headers)  # Последний объект категории
+    list_response = await client.get('/categories/stats?limit=1000')
+    assert category_id not in [item['category_id'] for item in list_response.json()]
+    response = await client.get(f'/categories/{category_id}/stats')
+    assert response.status_code == 200
+    assert response.json() == {
+        "category_id": category_id,
+        "examples_count": 0,
+        "price_min": None,
+        "price_avg": None,
+        "price_max": None
+    }
+
+
+@pytest.mark.anyio
+async def test_reconcile_turn(client: AsyncClient):
+    await get_redis_client().delete(RECONCILE_LOCK)
+    try:
+        assert await reconcile_turn(60, 'redis') is True
+        assert await reconcile_turn(60, 'redis') is False  # Другие воркеры в этом интервале сверку пропускают
+    finally:
+        await get_redis_client().delete(RECONCILE_LOCK)
@@ -0,0 +1,57 @@
+from decimal import Decimal
+
+from fastapi.encoders import jsonable_encoder
+from starlette import status
+from starlette.exceptions import HTTPException
+
+from config import BATCH_MAX_IDS
+from core.cache import is_tombstone
+
+
+"""Пакетное получение объектов по списку id: одно чтение кеша, один запрос в БД на промахи
+и один запрос к кешу для догрузки"""
+
+
+def parse_ids(ids: str) -> list[int]:
+    """Разбирает query-параметр вида "1,2,3". Порядок и повторы сохраняются"""
+    try:
+        parsed = [int(item) for item in ids.split(',') if item.strip()]
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail='ids must be a comma separated list of integers')
+    if not parsed:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='ids must not be empty')
+    if len(parsed) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f'No more than {BATCH_MAX_IDS} ids per request')
+    return parsed
+
+
+async def load_many(cache, model, ids: list[int], key_prefix: str) -> dict:
+    """Возвращает словарь {id: объект} для найденных id. Ключи кеша имеют вид <key_prefix>_<id>.
+    id с меткой отсутствия в кеше не запрашиваются из БД. Объекты, прочитанные из кеша и из БД, имеют одни типы"""
+    if not ids:
+        return {}  # MGET без ключей - ошибка Redis, а пустая страница списка - обычный случай
+    unique_ids = list(dict.fromkeys(ids))
+    cached = await cache.multi_get([f'{key_prefix}_{obj_id}' for obj_id in unique_ids])  # MGET всех ключей
+    found, missing = {}, []
+    for obj_id, value in zip(unique_ids, cached):
+        if value is None:
+            missing.append(obj_id)
+        elif not is_tombstone(value):
+            found[obj_id] = value
+
+    if missing:
+        loaded = {row['id']: row for row in await model.filter(id__in=missing).values()}  # Один запрос на промахи
+        if loaded:  # Догрузка в кеш без перезаписи более новых версий
+            await cache.set_if_newer([(f'{key_prefix}_{obj_id}', row, row['version'])
+                                      for obj_id, row in loaded.items()])
+        # Строки из БД приводятся к тем же JSON-типам, в которых их возвращает кеш: Decimal - к числу
+        found.update((obj_id, jsonable_encoder(row, custom_encoder={Decimal: float})) for obj_id, row in loaded.items())
+
+    return found
+
+
+def batch_response(ids: list[int], found: dict) -> list[dict]:
+    """Ответ в порядке запроса, для ненайденных id - found: false"""
+    return [{'id': obj_id, 'found': obj_id in found, 'item': found.get(obj_id)} for obj_id in ids]
@@ -0,0 +1,73 @@
+import time
+
+from core.metrics import metrics
+
+
+"""Автомат защиты (circuit breaker) для внешних зависимостей. Пока зависимость отвечает, автомат закрыт.
+После failures ошибок подряд он размыкается, и на reset_seconds вызовы к зависимости не выполняются.
+Затем автомат переходит в полуоткрытое состояние и пропускает не больше probes пробных вызовов одновременно:
+успешный пробный вызов закрывает автомат, ошибка снова размыкает его. Состояние отдаётся в метрике
+breaker_<имя>_state"""
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Счётчик ошибок зависимости и её состояние для одного процесса"""
+
+    def __init__(self, name: str, failures: int, reset_seconds: float, probes: int):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.probes = probes
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.report()
+
+    def report(self):
+        metrics.set(f'breaker_{self.name}_state', self.state)
+
+    def allow(self) -> bool:
+        """Можно ли выполнить вызов. Каждый разрешённый вызов завершается success, failure или release"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                metrics.inc(f'breaker_{self.name}_rejected')
+                return False
+            self.state = HALF_OPEN
+            self.report()
+        if self.state == HALF_OPEN:
+            if self.probes_in_flight >= self.probes:
+                metrics.inc(f'breaker_{self.name}_rejected')
+                return False
+            self.probes_in_flight += 1
+            metrics.inc(f'breaker_{self.name}_probes')
+        return True
+
+    def release(self):
+        """Вызов завершился, но его результат ничего не говорит о зависимости"""
+        if self.state == HALF_OPEN and self.probes_in_flight:
+            self.probes_in_flight -= 1
+
+    def success(self):
+        self.release()
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            self.state = CLOSED
+            self.probes_in_flight = 0
+            self.report()
+
+    def failure(self):
+        self.release()
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failures:
+            if self.state != OPEN:
+                metrics.inc(f'breaker_{self.name}_opened')
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probes_in_flight = 0
+            self.report()
@@ -0,0 +1,471 @@
+import asyncio
+import zlib
+from collections import OrderedDict
+
+import redis.asyncio as redis
+from aiocache import RedisCache, SimpleMemoryCache
+from aiocache.base import BaseCache
+from aiocache.serializers import BaseSerializer
+from redis.exceptions import RedisError
+
+from config import (CACHE_BACKEND, CACHE_MAX_ENTRIES, CACHE_WRITE_THROUGH, CACHE_TOMBSTONE_TTL,
+                    CACHE_COMPRESS_MIN_BYTES, CACHE_MAX_ENTRY_BYTES, REDIS_HOST, REDIS_PORT, REDIS_TTL, REDIS_POOL_SIZE,
+                    CACHE_TIMEOUT_MS, CACHE_BREAKER_FAILURES, CACHE_BREAKER_RESET_SECONDS, CACHE_BREAKER_PROBES)
+from core.breaker import CircuitBreaker, HALF_OPEN
+from core.deadline import remaining
+from core.logger import get_logger
+from core.metrics import metrics
+
+
+"""Бэкенды кеша. Бэкенд выбирается настройкой CACHE_BACKEND:
+    redis - общий кеш для нескольких процессов и серверов;
+    memory - кеш в памяти процесса с ограничением размера, для развёртывания в один процесс;
+    null - ничего не хранит, чтобы измерять производительность БД без кеша.
+У всех бэкендов одинаковые сериализатор и TTL. Ключи разных роутеров разделяются префиксом namespace.
+Значения больше CACHE_COMPRESS_MIN_BYTES хранятся сжатыми, размеры записей учитываются в метриках по namespace.
+Операции с кешем внутри HTTP-запроса ждут не дольше, чем осталось до дедлайна запроса.
+Операции с Redis ждут не дольше CACHE_TIMEOUT_MS и проходят через общий для процесса автомат защиты: когда Redis
+недоступен, кеши сразу отвечают промахом, а запись пропускается, и обработчики идут напрямую в БД"""
+
+
+cache_logger = get_logger('cache_logger')
+
+
+"""Метка отсутствующего объекта. Хранится в ключе самого объекта, поэтому запись объекта при создании
+через write_through заменяет её без отдельного удаления"""
+TOMBSTONE = {'missing': True}
+
+
+def is_tombstone(value) -> bool:
+    """Проверяет, что из кеша прочитана метка отсутствующего объекта, и учитывает попадание в метрике"""
+    if value == TOMBSTONE:
+        metrics.inc('cache_tombstone_hits')
+        return True
+    return False
+
+
+def version_key(key: str) -> str:
+    """Ключ, в котором хранится версия значения key"""
+    return f'{key}:version'
+
+
+COMPRESSED = b'\x00'  # Первый байт сжатого значения. С него не начинается ни один JSON, поэтому старые записи читаются
+
+
+class PackedSerializer(BaseSerializer):
+    """Обёртка над сериализатором кеша: сжимает zlib значения больше CACHE_COMPRESS_MIN_BYTES и учитывает
+    размеры записей namespace. Значения хранятся байтами, поэтому Redis отдаёт их без декодирования"""
+
+    DEFAULT_ENCODING = None
+
+    def __init__(self, serializer: BaseSerializer, namespace: str):
+        super().__init__()
+        self.serializer = serializer
+        self.namespace = namespace
+
+    def pack(self, data: bytes) -> bytes:
+        """Сжимает данные, если они больше порога и сжатие уменьшает их размер"""
+        packed = data
+        if CACHE_COMPRESS_MIN_BYTES and len(data) > CACHE_COMPRESS_MIN_BYTES:
+            compressed = COMPRESSED + zlib.compress(data, 1)
+            if len(compressed) < len(data):
+                packed = compressed
+                metrics.observe(f'cache_{self.namespace}_compression_ratio', len(data) / len(compressed))
+        metrics.observe(f'cache_{self.namespace}_entry_bytes', len(data))
+        metrics.observe(f'cache_{self.namespace}_stored_bytes', len(packed))
+        return packed
+
+    @staticmethod
+    def unpack(value: bytes) -> bytes:
+        return zlib.decompress(value[1:]) if value.startswith(COMPRESSED) else value
+
+    def dumps(self, value) -> bytes:
+        data = self.serializer.dumps(value)
+        return self.pack(data.encode() if isinstance(data, str) else data)
+
+    def loads(self, value):
+        if value is None:
+            return None
+        return self.serializer.loads(self.unpack(to_bytes(value)))
+
+
+def to_bytes(value):
+    """Приводит значение из кеша к байтам: кеш в памяти отдаёт значения в том виде, в котором их записали"""
+    return value.encode() if isinstance(value, str) else value
+
+
+class CacheMixin:
+    """Операции над несколькими ключами, общие для всех бэкендов"""
+
+    @property
+    def timeout(self):
+        """Таймаут операций aiocache: настроенный таймаут, но не больше времени до дедлайна запроса"""
+        return remaining(self._timeout)
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+    async def invalidate(self, *keys):
+        """Удаляет несколько ключей. Бэкенды с сетевыми запросами делают это за один запрос"""
+        for key in keys:
+            await self.delete(key)
+
+    async def pop(self, key):
+        """Читает и удаляет ключ. Бэкенды переопределяют метод, чтобы значение мог получить только один
+        из одновременных вызовов"""
+        value = await self.get(key)
+        await self.delete(key)
+        return value
+
+    async def bury(self, key):
+        """Запоминает, что объекта key нет в БД, на CACHE_TOMBSTONE_TTL секунд. Метка записывается, только если
+        ключ пуст: объект, созданный и записанный в кеш после чтения из БД, не будет закрыт меткой"""
+        if not CACHE_TOMBSTONE_TTL:
+            return
+        try:
+            await self.add(key, TOMBSTONE, ttl=CACHE_TOMBSTONE_TTL)
+            metrics.inc('cache_tombstones_written')
+        except ValueError:
+            pass
+
+    async def set_body(self, key, body: bytes):
+        """Записывает готовое JSON-тело ответа без сериализации. Ответ больше CACHE_MAX_ENTRY_BYTES не кешируется"""
+        packed = self.serializer.pack(body)
+        if len(packed) > CACHE_MAX_ENTRY_BYTES:
+            metrics.inc(f'cache_{self.namespace}_too_large')
+            return
+        await self.set(key, packed, dumps_fn=to_bytes)
+
+    async def set_if_newer(self, items, invalidate=()) -> int:
+        """Записывает значения из items - списка (key, value, version), только если в кеше нет значения
+        с такой же или более новой версией. Перед записью удаляет ключи invalidate.
+        Возвращает количество записанных значений"""
+        await self.invalidate(*invalidate)
+        written = 0
+        for key, value, version in items:
+            if (await self.get(version_key(key)) or 0) < version:
+                await self.set(key, value)
+                await self.set(version_key(key), version)
+                written += 1
+        return written
+
+    async def write_through(self, rows: dict, invalidate=()):
+        """Записывает свежие строки из БД в ключи rows вместо удаления, чтобы следующий читатель не шёл в БД.
+        Версия берётся из поля version строки. При CACHE_WRITE_THROUGH=0 ключи просто удаляются"""
+        if CACHE_WRITE_THROUGH:
+            await self.set_if_newer([(key, row, row['version']) for key, row in rows.items()], invalidate)
+        else:
+            await self.invalidate(*rows, *invalidate)
+
+
+_redis_client: redis.Redis | None = None
+
+
+def get_redis_client() -> redis.Redis:
+    """Клиент Redis с одним пулом соединений на процесс, общий для всех namespace. Подключение ждёт
+    не дольше CACHE_TIMEOUT_MS, а ответ - не дольше самой долгой операции, очистки namespace после сбоя Redis,
+    поэтому вызовы вне кеша не зависают на недоступном Redis"""
+    global _redis_client
+    if _redis_client is None:
+        pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=0, max_connections=REDIS_POOL_SIZE,
+                                    socket_connect_timeout=CACHE_TIMEOUT_MS / 1000,
+                                    socket_timeout=CACHE_BREAKER_RESET_SECONDS)
+        _redis_client = redis.Redis(connection_pool=pool)
+    return _redis_client
+
+
+async def close_redis_client():
+    """Закрывает общий пул соединений Redis при остановке воркера"""
+    global _redis_client
+    if _redis_client is not None:
+        await _redis_client.aclose()
+        _redis_client = None
+
+
+class CacheUnavailable(ConnectionError):
+    """Redis недоступен, а хранилище не может работать без него, например хранилище кодов подтверждения"""
+
+
+redis_breaker = CircuitBreaker('redis', CACHE_BREAKER_FAILURES, CACHE_BREAKER_RESET_SECONDS, CACHE_BREAKER_PROBES)
+dropped_writes = {}  # namespace -> кеш, запись в который пропущена, пока Redis был недоступен
+
+
+async def recover_dropped_writes():
+    """Очищает namespace, в которых пропущены записи и удаления, пока Redis был недоступен: в них могут
+    остаться устаревшие значения. Выполняется первым пробным вызовом после сбоя"""
+    for namespace, cache in list(dropped_writes.items()):
+        await cache.clear(timeout=remaining(CACHE_BREAKER_RESET_SECONDS))  # KEYS по namespace дольше обычных операций
+        dropped_writes.pop(namespace, None)
+        cache_logger.warning('Cache namespace %s cleared after Redis outage', namespace)
+
+
+UNAVAILABLE = object()  # Результат операции, пропущенной из-за недоступного Redis
+
+
+async def redis_call(operation, fallback=UNAVAILABLE, timeout: float = CACHE_TIMEOUT_MS / 1000):
+    """Выполняет корутину operation() с командами общего клиента Redis вне кеша (фильтр Блума, события,
+    счётчики ключей) через тот же автомат защиты и с тем же таймаутом, что и операции кеша.
+    Если Redis недоступен или не ответил, возвращает fallback"""
+    if not redis_breaker.allow():
+        return fallback
+    limited_timeout = remaining(timeout)
+    try:
+        if redis_breaker.state == HALF_OPEN and dropped_writes:
+            await recover_dropped_writes()
+        result = await asyncio.wait_for(operation(), limited_timeout)
+    except (asyncio.TimeoutError, RedisError, OSError) as exc:
+        if limited_timeout != timeout and isinstance(exc, asyncio.TimeoutError):
+            redis_breaker.release()  # Таймаут сокращён дедлайном запроса, а не медленным Redis
+        else:
+            redis_breaker.failure()
+        metrics.inc('cache_timeouts' if isinstance(exc, asyncio.TimeoutError) else 'cache_errors')
+        cache_logger.warning('Redis call %s failed: %r', operation.__qualname__, exc)
+        return fallback
+    redis_breaker.success()
+    return result
+
+
+def count_round_trips(keys_count: int):
+    """Учитывает один выполненный сетевой запрос вместо keys_count отдельных"""
+    metrics.inc('cache_round_trips')
+    metrics.inc('cache_round_trips_saved', max(keys_count - 1, 0))
+
+
+"""KEYS: пары (ключ, ключ версии) для записи, затем ключи для удаления. ARGV: TTL, затем пары (значение, версия)"""
+SET_IF_NEWER_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+local count = (#ARGV - 1) / 2
+for i = 2 * count + 1, #KEYS do
+    redis.call('del', KEYS[i])
+end
+local written = 0
+for i = 1, count do
+    local version = tonumber(ARGV[2 * i + 1])
+    if tonumber(redis.call('get', KEYS[2 * i]) or '0') < version then
+        if ttl > 0 then
+            redis.call('set', KEYS[2 * i - 1], ARGV[2 * i], 'EX', ttl)
+            redis.call('set', KEYS[2 * i], version, 'EX', ttl)
+        else
+            redis.call('set', KEYS[2 * i - 1], ARGV[2 * i])
+            redis.call('set', KEYS[2 * i], version)
+        end
+        written = written + 1
+    end
+end
+return written
+"""
+
+
+class SharedRedisCache(CacheMixin, RedisCache):
+    """Кеш в Redis, который работает через общий пул соединений. Ключи хранятся в базе 0 с префиксом namespace.
+    degrade=True - при недоступном Redis чтение возвращает промах, а запись пропускается. degrade=False - для
+    хранилищ, данные которых есть только в Redis: операции сразу завершаются ошибкой CacheUnavailable"""
+
+    NAME = 'shared_redis'
+
+    def __init__(self, degrade: bool = True, **kwargs):
+        super().__init__(endpoint=REDIS_HOST, port=REDIS_PORT, db=0, timeout=CACHE_TIMEOUT_MS / 1000, **kwargs)
+        self.client = get_redis_client()
+        self.degrade = degrade
+
+    async def guarded(self, fallback, write: bool, operation, *args, **kwargs):
+        """Выполняет операцию с Redis через автомат защиты. Если Redis недоступен, возвращает fallback"""
+        if not redis_breaker.allow():
+            return self.unavailable(fallback, write)
+        limited = self.timeout != self._timeout  # Таймаут сокращён дедлайном запроса, а не медленным Redis
+        try:
+            if redis_breaker.state == HALF_OPEN and dropped_writes:
+                await recover_dropped_writes()
+            result = await operation(*args, **kwargs)
+        except ValueError:
+            redis_breaker.success()  # add: ключ уже существует
+            raise
+        except (asyncio.TimeoutError, RedisError, OSError) as exc:
+            if limited and isinstance(exc, asyncio.TimeoutError):
+                redis_breaker.release()
+            else:
+                redis_breaker.failure()
+            metrics.inc('cache_timeouts' if isinstance(exc, asyncio.TimeoutError) else 'cache_errors')
+            return self.unavailable(fallback, write, exc)
+        redis_breaker.success()
+        return result
+
+    def unavailable(self, fallback, write: bool, exc: Exception | None = None):
+        if not self.degrade:
+            raise CacheUnavailable(f'Redis is unavailable for {self.namespace}') from exc
+        if write:
+            dropped_writes[self.namespace] = self
+        return fallback
+
+    async def get(self, key, *args, **kwargs):
+        return await self.guarded(kwargs.get('default'), False, super().get, key, *args, **kwargs)
+
+    async def exists(self, key, *args, **kwargs):
+        return await self.guarded(False, False, super().exists, key, *args, **kwargs)
+
+    async def set(self, key, value, *args, **kwargs):
+        return await self.guarded(False, True, super().set, key, value, *args, **kwargs)
+
+    async def add(self, key, value, *args, **kwargs):
+        return await self.guarded(True, True, super().add, key, value, *args, **kwargs)
+
+    async def delete(self, key, *args, **kwargs):
+        return await self.guarded(0, True, super().delete, key, *args, **kwargs)
+
+    async def multi_get(self, keys, *args, **kwargs):
+        values = await self.guarded(UNAVAILABLE, False, super().multi_get, keys, *args, **kwargs)
+        if values is UNAVAILABLE:
+            return [None] * len(keys)
+        count_round_trips(len(keys))
+        return values
+
+    async def multi_set(self, pairs, *args, **kwargs):
+        """MSET и EXPIRE всех ключей уходят одним pipeline"""
+        result = await self.guarded(UNAVAILABLE, True, super().multi_set, pairs, *args, **kwargs)
+        if result is UNAVAILABLE:
+            return False
+        count_round_trips(len(pairs))
+        return result
+
+    async def invalidate(self, *keys):
+        if keys:
+            result = await self.guarded(UNAVAILABLE, True, self.command, self.client.delete,
+                                        *(self._build_key(key) for key in keys))
+            if result is not UNAVAILABLE:
+                count_round_trips(len(keys))
+
+    async def pop(self, key):
+        """Чтение и удаление одной командой GETDEL"""
+        value = await self.guarded(None, True, self.command, self.client.getdel, self._build_key(key))
+        return self.serializer.loads(value)
+
+    async def set_if_newer(self, items, invalidate=()) -> int:
+        """Проверка версий, запись и удаление ключей выполняются одним Lua-скриптом за один запрос к Redis"""
+        keys, args = [], [self.ttl or 0]
+        for key, value, version in items:
+            keys += [self._build_key(key), self._build_key(version_key(key))]
+            args += [self.serializer.dumps(value), version]
+        keys += [self._build_key(key) for key in invalidate]
+
+        written = await self.guarded(UNAVAILABLE, True, self.command,
+                                     self.client.eval, SET_IF_NEWER_SCRIPT, len(keys), *keys, *args)
+        if written is UNAVAILABLE:
+            return 0
+        count_round_trips(len(items) * 2 + len(invalidate))
+        return written
+
+    async def command(self, method, *args):
+        """Команда клиента Redis с таймаутом операций кеша"""
+        return await asyncio.wait_for(method(*args), self.timeout)
+
+    async def _clear(self, namespace=None, _conn=None):
+        """Очищает только ключи своего namespace, а не всю общую базу"""
+        return await super()._clear(namespace or self.namespace, _conn=_conn)
+
+    async def _close(self, *args, _conn=None, **kwargs):
+        """Общий пул закрывается один раз через close_redis_client"""
+        return None
+
+
+class MemoryCache(CacheMixin, SimpleMemoryCache):
+    """Кеш в памяти процесса. Хранит не больше max_size ключей и при переполнении вытесняет ключи,
+    к которым дольше всего не обращались"""
+
+    NAME = 'bounded_memory'
+
+    def __init__(self, max_size: int = CACHE_MAX_ENTRIES, **kwargs):
+        super().__init__(**kwargs)
+        self.max_size = max_size
+        self._cache = OrderedDict()
+
+    async def _get(self, key, encoding='utf-8', _conn=None):
+        value = self._cache.get(key)
+        if value is not None:
+            self._cache.move_to_end(key)
+        return value
+
+    async def _multi_get(self, keys, encoding='utf-8', _conn=None):
+        return [await self._get(key) for key in keys]
+
+    async def pop(self, key):
+        """Чтение и удаление без ожидания между ними, поэтому одновременные вызовы не получат значение дважды"""
+        key = self._build_key(key)
+        value = self._cache.get(key)
+        await self._delete(key)
+        return self.serializer.loads(value)
+
+    async def _set(self, key, value, ttl=None, _cas_token=None, _conn=None):
+        result = await super()._set(key, value, ttl=ttl, _cas_token=_cas_token, _conn=_conn)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            await self._delete(next(iter(self._cache)))
+            metrics.inc('cache_evictions')
+        return result
+
+    async def _clear(self, namespace=None, _conn=None):
+        result = await super()._clear(namespace, _conn=_conn)
+        self._cache = OrderedDict(self._cache)
+        return result
+
+
+class NullCache(CacheMixin, BaseCache):
+    """Кеш, который ничего не хранит: любое чтение - промах, любая запись сразу забывается"""
+
+    NAME = 'null'
+
+    async def _get(self, key, encoding='utf-8', _conn=None):
+        return None
+
+    async def _gets(self, key, encoding='utf-8', _conn=None):
+        return None
+
+    async def _multi_get(self, keys, encoding='utf-8', _conn=None):
+        return [None] * len(keys)
+
+    async def _set(self, key, value, ttl=None, _cas_token=None, _conn=None):
+        return True
+
+    async def _multi_set(self, pairs, ttl=None, _conn=None):
+        return True
+
+    async def _add(self, key, value, ttl=None, _conn=None):
+        return True
+
+    async def _exists(self, key, _conn=None):
+        return False
+
+    async def _increment(self, key, delta, _conn=None):
+        return delta
+
+    async def _expire(self, key, ttl, _conn=None):
+        return False
+
+    async def _delete(self, key, _conn=None):
+        return 0
+
+    async def _clear(self, namespace=None, _conn=None):
+        return True
+
+    async def _raw(self, command, *args, encoding='utf-8', _conn=None, **kwargs):
+        return None
+
+    async def _redlock_release(self, key, value):
+        return 0
+
+    async def _close(self, *args, _conn=None, **kwargs):
+        return None
+
+
+def create_cache(namespace: str, serializer, backend: str = CACHE_BACKEND, degrade: bool = True) -> BaseCache:
+    """Создаёт кеш выбранного бэкенда. namespace - префикс всех ключей этого кеша.
+    degrade=False - хранилище, которое при недоступном Redis завершает операции ошибкой, а не промахом"""
+    serializer = PackedSerializer(serializer, namespace)
+    if backend == 'redis':
+        return SharedRedisCache(serializer=serializer, namespace=namespace, ttl=REDIS_TTL, degrade=degrade)
+    if backend == 'memory':
+        return MemoryCache(serializer=serializer, namespace=namespace, ttl=REDIS_TTL)
+    if backend == 'null':
+        return NullCache(serializer=serializer, namespace=namespace, ttl=REDIS_TTL)
+    raise ValueError(f'Unknown cache backend "{backend}", expected redis, memory or null')
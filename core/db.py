@@ -0,0 +1,153 @@
+import hashlib
+from datetime import datetime
+from decimal import Decimal
+
+from tortoise import Tortoise, connections
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.exceptions import OperationalError
+from tortoise.utils import get_schema_sql
+
+from config import DB_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, REQUEST_TIMEOUT_MAX_MS
+from core.models import SchemaVersion
+
+
+"""Конфигурация TortoiseORM, версия схемы БД и прогрев пула соединений"""
+
+
+MODELS = ['examples.models', 'categories.models', 'users.models', 'core.models']
+
+
+def get_db_config(db_url: str = DB_URL) -> dict:
+    """Собирает конфигурацию соединения из DB_URL. Для postgres задаётся размер пула, чтобы при старте
+    воркера сразу открывалось DB_POOL_MIN_SIZE соединений, и statement_timeout, который прерывает запросы
+    дольше самого длинного дедлайна HTTP-запроса"""
+    db_config = expand_db_url(db_url)
+    if db_config['engine'] == 'tortoise.backends.asyncpg':
+        db_config['credentials'].setdefault('minsize', DB_POOL_MIN_SIZE)
+        db_config['credentials'].setdefault('maxsize', DB_POOL_MAX_SIZE)
+        server_settings = db_config['credentials'].setdefault('server_settings', {})
+        server_settings.setdefault('statement_timeout', str(REQUEST_TIMEOUT_MAX_MS))
+    return db_config
+
+
+TORTOISE_ORM = {
+    'connections': {
+        'default': get_db_config(),
+    },
+    'apps': {
+        'models': {
+            'models': MODELS,
+            'default_connection': 'default',
+        }
+    }
+}
+
+
+"""Изменения таблиц, которые уже есть в БД. generate_schemas создаёт только недостающие таблицы, поэтому каждая
+новая колонка существующей таблицы добавляется сюда шагом (таблица, колонка, определение). Шаги выполняются
+по порядку и только для отсутствующих колонок, поэтому повторный запуск migrate.py ничего не меняет"""
+MIGRATIONS = [
+    ('Example', 'version', 'INT NOT NULL DEFAULT 1'),
+    ('Category', 'version', 'INT NOT NULL DEFAULT 1'),
+    ('User', 'version', 'INT NOT NULL DEFAULT 1'),
+]
+
+
+def schema_version() -> str:
+    """Версия схемы - хеш SQL, который TortoiseORM генерирует для текущих моделей"""
+    schema_sql = get_schema_sql(connections.get('default'), safe=False)
+    return hashlib.sha256(schema_sql.encode()).hexdigest()[:16]
+
+
+async def table_columns(table: str) -> set:
+    """Колонки таблицы в БД. Для отсутствующей таблицы - пустое множество"""
+    connection = connections.get('default')
+    if connection.capabilities.dialect == 'postgres':
+        _, rows = await connection.execute_query(
+            'SELECT "column_name" FROM information_schema.columns '
+            'WHERE "table_schema" = current_schema() AND "table_name" = $1', [table])
+        return {row['column_name'] for row in rows}
+    _, rows = await connection.execute_query(f'PRAGMA table_info("{table}")')
+    return {row['name'] for row in rows}
+
+
+async def missing_columns() -> dict:
+    """Таблица -> колонки моделей, которых нет в БД"""
+    missing = {}
+    for model in Tortoise.apps['models'].values():
+        columns = set(model._meta.fields_db_projection.values()) - await table_columns(model._meta.db_table)
+        if columns:
+            missing[model._meta.db_table] = sorted(columns)
+    return missing
+
+
+async def apply_schema():
+    """Создаёт недостающие таблицы, добавляет колонки шагами MIGRATIONS и записывает версию схемы.
+    Вызывается один раз на деплой из migrate.py. Версия не записывается, пока в БД не хватает колонок моделей"""
+    await Tortoise.generate_schemas(safe=True)
+    connection = connections.get('default')
+    for table, column, definition in MIGRATIONS:
+        if column not in await table_columns(table):
+            await connection.execute_script(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+
+    missing = await missing_columns()
+    if missing:
+        raise RuntimeError(f'Columns {missing} are missing in the database, add them to core.db.MIGRATIONS')
+    version = schema_version()
+    if not await SchemaVersion.filter(version=version).exists():
+        await SchemaVersion.create(version=version)
+    return version
+
+
+async def verify_schema():
+    """Проверяет, что в БД применена схема текущей версии кода и в таблицах есть все колонки моделей.
+    Иначе воркер не стартует"""
+    expected = schema_version()
+    try:
+        record = await SchemaVersion.all().order_by('-id').first()
+    except OperationalError:
+        record = None  # Таблицы версий ещё нет, значит migrate.py не запускался
+    applied = record.version if record else None
+    if applied != expected:
+        raise RuntimeError(f'Database schema version is {applied}, expected {expected}. Run "python migrate.py"')
+    missing = await missing_columns()
+    if missing:
+        raise RuntimeError(f'Columns {missing} are missing in the database. Run "python migrate.py"')
+
+
+class QueryParams(list):
+    """Параметры SQL-запроса. Вызов params(value) добавляет значение и возвращает его плейсхолдер:
+    $n для postgres, ? для sqlite"""
+
+    def __init__(self, connection):
+        super().__init__()
+        self.postgres = connection.capabilities.dialect == 'postgres'
+
+    def __call__(self, value) -> str:
+        self.append(value)
+        return f'${len(self)}' if self.postgres else '?'
+
+
+def db_value(connection, field, value, instance=None):
+    """Значение поля модели в том виде, в котором его записывает TortoiseORM: sqlite хранит Decimal и дату
+    строкой, а bool - числом. instance - объект модели, для которого заполняются поля auto_now"""
+    value = field.to_db_value(value, instance)
+    if connection.capabilities.dialect == 'sqlite':
+        if isinstance(value, Decimal):
+            return str(value.quantize(field.quant).normalize())
+        if isinstance(value, datetime):
+            return value.isoformat(' ')
+        if isinstance(value, bool):
+            return int(value)
+    return value
+
+
+def model_row(obj) -> dict:
+    """Словарь полей объекта в том же виде, в котором его возвращает .values()"""
+    return {name: getattr(obj, name) for name in obj._meta.fields_db_projection}
+
+
+async def warm_up_database():
+    """Открывает пул соединений и проверяет доступность БД до приёма первого запроса"""
+    for connection in connections.all():
+        await connection.execute_query('SELECT 1')
@@ -0,0 +1,58 @@
+import time
+from contextvars import ContextVar
+
+from config import REQUEST_TIMEOUT_MS, REQUEST_TIMEOUT_MAX_MS, ROUTE_TIMEOUTS
+
+
+"""Дедлайн HTTP-запроса. Запросы к БД и кешу внутри запроса ждут не дольше, чем осталось до дедлайна"""
+
+
+MIN_TIMEOUT = 0.001  # Таймаут 0 в aiocache означает "без таймаута", поэтому истёкший дедлайн - это 1 мс
+
+
+class Deadline:
+    """Дедлайн одного HTTP-запроса. Задачи, созданные при обработке запроса, копируют контекст вместе
+    с этим объектом, поэтому дедлайн, снятый после отправки ответа, перестаёт действовать и в них"""
+
+    def __init__(self, at: float):
+        self.at = at
+
+    def clear(self):
+        self.at = None
+
+
+current_deadline: ContextVar[Deadline | None] = ContextVar('current_deadline', default=None)
+
+
+def parse_route_timeouts(value: str) -> dict:
+    """Разбирает строку вида "GET /api/v1/examples/=2000" в словарь {"GET /api/v1/examples/": 2000}"""
+    timeouts = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        route, _, timeout = item.rpartition('=')
+        timeouts[route.strip()] = int(timeout)
+    return timeouts
+
+
+route_timeouts = parse_route_timeouts(ROUTE_TIMEOUTS)
+
+
+def request_timeout(method: str, route: str | None, header: str | None) -> float:
+    """Таймаут запроса в секундах. Заголовок X-Request-Timeout-Ms важнее настройки маршрута,
+    но не может превышать REQUEST_TIMEOUT_MAX_MS"""
+    timeout_ms = route_timeouts.get(f'{method} {route}', REQUEST_TIMEOUT_MS)
+    if header:
+        try:
+            timeout_ms = min(int(header), REQUEST_TIMEOUT_MAX_MS)
+        except ValueError:
+            pass
+    return max(timeout_ms, 1) / 1000
+
+
+def remaining(timeout: float | None = None) -> float | None:
+    """Сколько секунд осталось до дедлайна текущего запроса, но не больше timeout.
+    Вне запроса и после отправки ответа, например в BackgroundTasks, возвращает timeout"""
+    deadline = current_deadline.get()
+    if deadline is None or deadline.at is None:
+        return timeout
+    left = max(deadline.at - time.monotonic(), MIN_TIMEOUT)
+    return left if not timeout else min(timeout, left)
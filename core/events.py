@@ -0,0 +1,123 @@
+import asyncio
+import contextlib
+import json
+
+from fastapi.encoders import jsonable_encoder
+
+from config import EVENTS_BACKEND, EVENTS_BUFFER_SIZE, EVENTS_CHANNEL
+from core.cache import UNAVAILABLE, get_redis_client, redis_call
+from core.logger import get_logger
+from core.metrics import metrics
+
+
+"""Лента изменений объектов для подписчиков SSE и WebSocket. Роутеры публикуют события создания, изменения
+и удаления, а каждый воркер раздаёт их своим подписчикам. Бэкенд задаётся EVENTS_BACKEND:
+    redis - события идут через Redis pub/sub и доходят до подписчиков всех воркеров и серверов;
+    local - события раздаются только внутри процесса, для развёртывания в один процесс без Redis"""
+
+
+events_logger = get_logger('events_logger')
+
+EVENTS_POLL_SECONDS = 1  # Сколько ждать сообщение pub/sub за одно чтение
+OVERFLOW = {'entity': 'stream', 'action': 'overflow'}  # Подписчик пропустил события и должен перечитать данные
+
+
+class Subscription:
+    """Подписка одного клиента. Буфер событий ограничен, чтобы медленный клиент не занимал память воркера"""
+
+    def __init__(self, categories: set | None = None, size: int = EVENTS_BUFFER_SIZE):
+        self.categories = categories
+        self.queue = asyncio.Queue(maxsize=size)
+
+    def matches(self, event: dict) -> bool:
+        """Фильтр по категориям. Перенос объекта в другую категорию виден подписчикам обеих категорий"""
+        if self.categories is None:
+            return True
+        return event.get('category_id') in self.categories or event.get('previous_category_id') in self.categories
+
+    def offer(self, event: dict):
+        if not self.matches(event):
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            """Клиент не успевает читать: накопленные события отбрасываются, вместо них клиент получает overflow"""
+            dropped = self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+            metrics.inc('events_dropped', dropped + 1)
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+class EventBus:
+    """Публикация событий и раздача их подписчикам текущего воркера"""
+
+    def __init__(self, backend: str = EVENTS_BACKEND):
+        self.backend = backend
+        self.subscriptions = set()
+        self.listener: asyncio.Task | None = None
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, categories: set | None = None):
+        subscription = Subscription(categories)
+        self.subscriptions.add(subscription)
+        metrics.set('events_subscribers', len(self.subscriptions))
+        try:
+            yield subscription
+        finally:
+            self.subscriptions.discard(subscription)
+            metrics.set('events_subscribers', len(self.subscriptions))
+
+    async def publish(self, entity: str, action: str, data: dict, category_id: int | None = None,
+                      previous_category_id: int | None = None):
+        """Публикует событие action (created, updated, deleted) над объектом entity. Если Redis недоступен,
+        событие пропускается: лента изменений не гарантирует доставку, а запись объекта уже выполнена"""
+        event = jsonable_encoder({'entity': entity, 'action': action, 'id': data.get('id'),
+                                  'category_id': category_id, 'previous_category_id': previous_category_id,
+                                  'data': data if action != 'deleted' else None})
+        if self.backend == 'redis':
+            if await redis_call(lambda: get_redis_client().publish(EVENTS_CHANNEL, json.dumps(event))) is UNAVAILABLE:
+                metrics.inc('events_dropped')
+                return
+        else:
+            self.dispatch(event)
+        metrics.inc('events_published')
+
+    def dispatch(self, event: dict):
+        for subscription in list(self.subscriptions):
+            subscription.offer(event)
+
+    async def listen(self):
+        """Получает события из Redis и раздаёт их подписчикам воркера. После ошибки подключается заново"""
+        while True:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(EVENTS_CHANNEL)
+                while True:
+                    # Явный таймаут ожидания заменяет socket_timeout пула: без событий соединение не считается сбоем
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=EVENTS_POLL_SECONDS)
+                    if message is not None:
+                        self.dispatch(json.loads(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                events_logger.warning('Events listener failed, reconnecting: %s', exc)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def start(self):
+        if self.backend == 'redis' and self.listener is None:
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
+
+
+event_bus = EventBus()
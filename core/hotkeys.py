@@ -0,0 +1,81 @@
+import asyncio
+from collections import Counter, defaultdict
+
+from config import CACHE_BACKEND, HOT_KEYS_TRACKED
+from core.cache import UNAVAILABLE, get_redis_client, redis_call
+from core.logger import get_logger
+from core.metrics import metrics
+
+
+"""Учёт самых запрашиваемых ключей кеша и их прогрев при запуске воркера. Воркер считает обращения к ключам
+в памяти и периодически добавляет счётчики в общий для всех воркеров sorted set Redis. Новый воркер до приёма
+запросов загружает самые запрашиваемые ключи из БД, а роутеры регистрируют для этого загрузчики своих namespace"""
+
+
+hot_keys_logger = get_logger('hot_keys_logger')
+
+HOT_KEYS_SET = 'hot_keys'  # Ключ sorted set Redis, элементы вида <namespace>:<ключ>
+
+
+class HotKeys:
+    """Счётчики обращений к ключам кеша и загрузчики ключей по namespace"""
+
+    def __init__(self, backend: str = CACHE_BACKEND):
+        self.backend = backend
+        self.counts = Counter()
+        self.loaders = {}
+
+    def record(self, namespace: str, key: str):
+        """Учитывает обращение к ключу. Не обращается к сети, счётчики уходят в Redis через flush.
+        Без Redis обращения не учитываются: счётчики некуда сбросить, и они росли бы без ограничений"""
+        if self.backend == 'redis':
+            self.counts[f'{namespace}:{key}'] += 1
+
+    def register(self, namespace: str, loader):
+        """loader(keys) - корутина, которая загружает в кеш ключи своего namespace из списка keys"""
+        self.loaders[namespace] = loader
+
+    async def flush(self):
+        """Добавляет накопленные счётчики в Redis одним pipeline и оставляет в нём HOT_KEYS_TRACKED ключей"""
+        if self.backend != 'redis' or not self.counts:
+            return
+        counts, self.counts = self.counts, Counter()
+
+        async def write():
+            async with get_redis_client().pipeline(transaction=False) as pipe:
+                for member, count in counts.items():
+                    pipe.zincrby(HOT_KEYS_SET, count, member)
+                pipe.zremrangebyrank(HOT_KEYS_SET, 0, -HOT_KEYS_TRACKED - 1)
+                await pipe.execute()
+
+        await redis_call(write)  # Если Redis недоступен, счётчики за интервал пропускаются
+
+    async def flush_periodically(self, interval: float):
+        """Фоновая задача воркера: записывает счётчики раз в interval секунд"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as exc:
+                hot_keys_logger.warning('Hot keys flush failed: %s', exc)
+
+    async def top(self, limit: int) -> list[str]:
+        """Самые запрашиваемые ключи. Без Redis их нет, и загрузчики прогревают только первые страницы списков"""
+        if self.backend != 'redis':
+            return []
+        members = await redis_call(lambda: get_redis_client().zrevrange(HOT_KEYS_SET, 0, limit - 1))
+        return [] if members is UNAVAILABLE else [member.decode() for member in members]
+
+    async def warm_up(self, limit: int):
+        """Загружает в кеш limit самых запрашиваемых ключей. Загрузчик вызывается для каждого namespace,
+        даже если его ключей нет среди самых запрашиваемых, чтобы он мог прогреть первые страницы списков"""
+        keys = defaultdict(list)
+        for member in await self.top(limit):
+            namespace, _, key = member.partition(':')
+            keys[namespace].append(key)
+        for namespace, loader in self.loaders.items():
+            await loader(keys[namespace])
+        metrics.set('cache_warm_up_keys', sum(map(len, keys.values())))
+
+
+hot_keys = HotKeys()
@@ -0,0 +1,149 @@
+import math
+import time
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from config import CONCURRENCY_LIMITS, LATENCY_TOLERANCE, LOAD_SHEDDING
+from core.metrics import metrics
+from core.middleware import find_route
+
+
+"""Адаптивное ограничение одновременных запросов воркера. Маршруты делятся на классы:
+    cached_read - чтения, которые обычно отдаются из кеша;
+    db_read - чтения, которые идут в БД;
+    write - создание, изменение и удаление;
+    auth - вход и регистрация, где основное время занимает bcrypt.
+Для каждого класса лимит подстраивается по принципу AIMD: растёт на единицу, пока задержка близка к базовой,
+и уменьшается в BACKOFF раз, когда задержка превышает базовую в LATENCY_TOLERANCE раз или запрос падает.
+Запросы сверх лимита сразу получают 503 с заголовком Retry-After, а не ждут в очереди"""
+
+
+AUTH_ROUTES = {('POST', '/api/v1/users/login'), ('POST', '/api/v1/users/register')}
+# Метрики должны быть доступны и под нагрузкой, а поток событий занимал бы место в лимите всё время подписки.
+# Пакет запросов сам места не занимает: его занимает каждый запрос пакета в лимите своего класса
+EXEMPT_ROUTES = {('GET', '/api/v1/metrics'), ('GET', '/api/v1/ready'), ('GET', '/api/v1/events/stream'),
+                 ('POST', '/api/v1/batch/')}
+OVERLOADED = 'Server is overloaded, retry later'
+BACKOFF = 0.9  # Во сколько раз уменьшается лимит при перегрузке
+MAX_GROWTH = 4  # Во сколько раз лимит может вырасти относительно начального
+BASELINE_DRIFT = 0.01  # Скорость, с которой базовая задержка подтягивается к выросшей задержке
+SMOOTHING = 0.2  # Вес нового значения в скользящих средних задержки и количества SQL-запросов
+CACHED_QUERIES = 0.5  # Маршрут считается кешируемым, если в среднем делает меньше стольких SQL-запросов
+
+
+def parse_limits(value: str) -> dict:
+    """Разбирает строку вида "db_read=40,write=20" в словарь лимитов"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, limit = item.partition('=')
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+class AdaptiveLimit:
+    """Лимит одновременных запросов одного класса маршрутов"""
+
+    def __init__(self, name: str, initial: int, tolerance: float = LATENCY_TOLERANCE):
+        self.name = name
+        self.limit = float(initial)
+        self.max_limit = initial * MAX_GROWTH
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.baseline_ms = None
+        self.recent_ms = None
+        self.last_backoff = 0.0
+
+    def try_acquire(self) -> bool:
+        """Занимает место под запрос. False - лимит исчерпан и запрос нужно отклонить"""
+        if self.in_flight >= int(self.limit):
+            metrics.inc(f'shed_{self.name}')
+            return False
+        self.in_flight += 1
+        metrics.set(f'in_flight_{self.name}', self.in_flight)
+        return True
+
+    def release(self, latency_ms: float, failed: bool):
+        """Освобождает место и подстраивает лимит под задержку завершившегося запроса"""
+        self.in_flight -= 1
+        metrics.set(f'in_flight_{self.name}', self.in_flight)
+
+        if self.baseline_ms is None:
+            self.baseline_ms = self.recent_ms = latency_ms
+        # Текущая задержка сглаживается, чтобы единичный медленный запрос не уменьшал лимит
+        self.recent_ms += (latency_ms - self.recent_ms) * SMOOTHING
+        if self.recent_ms < self.baseline_ms:
+            self.baseline_ms = self.recent_ms
+        else:
+            self.baseline_ms += (self.recent_ms - self.baseline_ms) * BASELINE_DRIFT
+
+        now = time.monotonic()
+        if failed or self.recent_ms > self.baseline_ms * self.tolerance:
+            # Запросы, начатые до уменьшения, завершатся так же медленно, поэтому лимит уменьшается
+            # не чаще одного раза за базовую задержку
+            if (now - self.last_backoff) * 1000 > self.baseline_ms:
+                self.limit = max(1.0, self.limit * BACKOFF)
+                self.last_backoff = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)  # +1 за каждые limit быстрых запросов
+        metrics.set(f'limit_{self.name}', int(self.limit))
+
+    def retry_after(self) -> int:
+        """Через сколько секунд клиенту стоит повторить запрос"""
+        return max(1, math.ceil((self.baseline_ms or 0) * self.tolerance / 1000))
+
+
+class ConcurrencyLimiter:
+    """Лимиты по классам маршрутов. Класс чтения определяется по среднему количеству SQL-запросов маршрута,
+    которое отдаёт query_accounting_middleware в заголовке X-DB-Query-Count"""
+
+    def __init__(self, limits: dict):
+        self.limits = {name: AdaptiveLimit(name, initial) for name, initial in limits.items()}
+        self.route_queries = {}  # Шаблон маршрута -> скользящее среднее SQL-запросов на запрос
+
+    def route_class(self, method: str, route: str) -> str:
+        if (method, route) in AUTH_ROUTES:
+            return 'auth'
+        if method != 'GET':
+            return 'write'
+        if self.route_queries.get(route, 1) < CACHED_QUERIES:
+            return 'cached_read'
+        return 'db_read'
+
+    def observe_queries(self, route: str, count: int):
+        average = self.route_queries.get(route)
+        self.route_queries[route] = count if average is None else average + (count - average) * SMOOTHING
+
+
+limiter = ConcurrencyLimiter(parse_limits(CONCURRENCY_LIMITS))
+
+
+def route_limit(method: str, route: str | None) -> AdaptiveLimit | None:
+    """Лимит класса маршрута route. None - запрос не ограничивается"""
+    if not LOAD_SHEDDING or route is None or (method, route) in EXEMPT_ROUTES:
+        return None
+    return limiter.limits.get(limiter.route_class(method, route))
+
+
+async def load_shedding_middleware(request: Request, call_next):
+    """Отклоняет запрос с 503, если в его классе маршрутов уже выполняется максимум запросов.
+    Под перегрузкой воркер быстро отказывает части запросов, а остальные выполняет с обычной задержкой"""
+
+    route = find_route(request)
+    limit = route_limit(request.method, route)
+    if limit is None:
+        return await call_next(request)
+    if not limit.try_acquire():
+        return JSONResponse({'detail': OVERLOADED}, status_code=503, headers={'Retry-After': str(limit.retry_after())})
+
+    started = time.perf_counter()
+    failed = True
+    try:
+        response = await call_next(request)
+        failed = response.status_code >= 500
+    finally:
+        limit.release((time.perf_counter() - started) * 1000, failed)
+
+    if 'X-DB-Query-Count' in response.headers:
+        limiter.observe_queries(route, int(response.headers['X-DB-Query-Count']))
+    return response
@@ -0,0 +1,146 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import os
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_LEVEL, LOG_QUEUE_SIZE, LOG_SAMPLING
+from core.metrics import metrics
+
+
+"""Централизованная конфигурация логирования. Записи из event loop только кладутся в ограниченную очередь,
+а в stdout их пишет отдельный поток QueueListener, поэтому медленный вывод не блокирует обработку запросов"""
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись лога в одну строку JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc_info'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler, который никогда не ждёт: если очередь заполнена, запись отбрасывается и считается"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Подставляет аргументы в сообщение и переводит traceback в текст, чтобы запись можно было
+        безопасно передать в другой поток. Traceback остаётся отдельным полем, а не частью сообщения"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('log_records_dropped')
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей уровня ниже WARNING для логгеров из rates. Доля ищется по имени
+    логгера и его родителям, предупреждения и ошибки пропускаются всегда"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def rate_for(self, name: str) -> float:
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+def parse_sampling(value: str) -> dict:
+    """Разбирает строку вида "tortoise.db_client=0.01,db_logger=0.5" в словарь долей"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+queue_handler: BoundedQueueHandler | None = None
+listener: QueueListener | None = None
+
+
+def setup_logging():
+    """Подключает к корневому логгеру неблокирующий обработчик. Повторный вызов ничего не делает"""
+    global queue_handler, listener
+    if listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    queue_handler = BoundedQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter(parse_sampling(LOG_SAMPLING)))
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger('tortoise').setLevel(logging.WARNING)  # SQL-запросы учитываются в core.queries
+
+    listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(shutdown_logging)
+    os.register_at_fork(after_in_child=restart_logging)
+
+
+def restart_logging():
+    """Вызывается в процессе-потомке после fork, например в воркере gunicorn с preload. Поток записи логов
+    не переживает fork, поэтому он создаётся заново вместе с очередью, блокировки которой могли остаться захваченными"""
+    global listener
+    if listener is None:
+        return
+    queue_handler.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = QueueListener(queue_handler.queue, *listener.handlers, respect_handler_level=True)
+    listener.start()
+
+
+def shutdown_logging():
+    """Останавливает поток записи логов, дописав оставшиеся в очереди записи"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Возвращает логгер приложения, записи которого идут через общую очередь"""
+    setup_logging()
+    return logging.getLogger(name)
+
+
+db_logger = get_logger('db_logger')
@@ -0,0 +1,45 @@
+import threading
+from collections import defaultdict
+
+
+"""Простейший сборщик метрик процесса. Метрики хранятся в памяти воркера и отдаются через /api/v1/metrics"""
+
+
+class Metrics:
+    """Счетчики, значения и наблюдения (count/sum/max) с доступом из любых потоков"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._observations = {}
+
+    def inc(self, name: str, value: float = 1):
+        """Увеличивает счетчик name на value"""
+        with self._lock:
+            self._counters[name] += value
+
+    def set(self, name: str, value):
+        """Записывает текущее значение метрики name"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """Добавляет наблюдение в метрику name, для которой хранятся количество, сумма и максимум"""
+        with self._lock:
+            obs = self._observations.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0})
+            obs['count'] += 1
+            obs['sum'] += value
+            obs['max'] = max(obs['max'], value)
+
+    def snapshot(self) -> dict:
+        """Возвращает копию всех метрик в виде словаря"""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'observations': {name: dict(obs) for name, obs in self._observations.items()},
+            }
+
+
+metrics = Metrics()
@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from starlette.routing import Match
+
+from core.deadline import Deadline, current_deadline, request_timeout
+from core.logger import db_logger
+from core.metrics import metrics
+from core.queries import QueryRecorder, current_recorder
+
+
+"""Middleware приложения"""
+
+
+def find_route(request: Request) -> str | None:
+    """Шаблон маршрута запроса, например /api/v1/examples/{example_id}"""
+    for route in request.app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return None
+
+
+async def query_accounting_middleware(request: Request, call_next):
+    """Считает SQL-запросы каждого HTTP-запроса и отдаёт их количество и суммарное время в заголовках ответа.
+    Если один и тот же запрос повторяется много раз, запрос помечается как N+1"""
+
+    recorder = QueryRecorder()
+    token = current_recorder.set(recorder)
+    try:
+        response = await call_next(request)
+    finally:
+        current_recorder.reset(token)
+
+    response.headers['X-DB-Query-Count'] = str(recorder.count)
+    response.headers['X-DB-Time-Ms'] = f'{recorder.total_ms:.2f}'
+    metrics.observe('db_queries_per_request', recorder.count)
+    metrics.observe('db_time_ms_per_request', recorder.total_ms)
+
+    repeated = recorder.n_plus_one()
+    if repeated:
+        response.headers['X-DB-N-Plus-One'] = '1'
+        metrics.inc('db_n_plus_one_requests')
+        db_logger.warning('Possible N+1 in %s %s: %s', request.method, request.url.path, repeated)
+
+    return response
+
+
+class DeadlineMiddleware:
+    """Ограничивает время обработки запроса дедлайном: таймаут маршрута из ROUTE_TIMEOUTS, REQUEST_TIMEOUT_MS
+    или заголовок X-Request-Timeout-Ms. Запросы к БД и кешу ждут не дольше дедлайна, а если дедлайн истёк
+    или клиент отключился, обработка запроса отменяется и соединение с БД сразу возвращается в пул.
+    Если ответ ещё не начат, клиент получает 504. Дедлайн ограничивает время до начала ответа, поэтому потоковые
+    ответы после начала отправки прерываются только отключением клиента. После отправки ответа дедлайн снимается,
+    и фоновые задачи запроса ждут БД и кеш с обычными таймаутами"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        request = Request(scope)
+        timeout = request_timeout(request.method, find_route(request), request.headers.get('X-Request-Timeout-Ms'))
+        deadline = time.monotonic() + timeout
+        token = current_deadline.set(Deadline(deadline))
+
+        messages = asyncio.Queue()
+        response_started = response_complete = False
+
+        async def receive_message():
+            message = await messages.get()
+            if message['type'] == 'http.disconnect':
+                messages.put_nowait(message)  # Повторные вызовы тоже получают disconnect
+            return message
+
+        async def send_message(message):
+            nonlocal response_started, response_complete
+            if message['type'] == 'http.response.start':
+                response_started = True
+            elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+                current_deadline.get().clear()  # Объект общий для всех задач запроса, в том числе BackgroundTasks
+            await send(message)
+
+        async def watch_client():
+            """Единственный читатель receive сервера: передаёт сообщения приложению и замечает отключение клиента"""
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message['type'] == 'http.disconnect':
+                    return
+
+        app_task = asyncio.create_task(self.app(scope, receive_message, send_message))
+        watcher = asyncio.create_task(watch_client())
+        try:
+            while True:
+                if response_complete:
+                    """Ответ отправлен, дальше выполняются только фоновые задачи, дедлайн с них уже снят"""
+                    return await app_task
+
+                waiting = {app_task} if watcher.done() else {app_task, watcher}
+                left = None if response_started else deadline - time.monotonic()
+                done, _ = await asyncio.wait(waiting, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+                if app_task in done:
+                    try:
+                        return app_task.result()
+                    except TimeoutError:
+                        """Запрос к БД или кешу не уложился в дедлайн"""
+                        if response_started:
+                            raise
+                        break
+                if not done:
+                    if response_started:
+                        continue  # Ответ начался до дедлайна, дальше ждём без дедлайна
+                    """Дедлайн истёк"""
+                    break
+                if watcher in done and not response_complete:
+                    """Клиент отключился: результат никому не нужен. Ответ 499 сервер уже не отправит,
+                    но его ждут внешние middleware"""
+                    metrics.inc('requests_client_disconnected')
+                    await self.cancel(app_task)
+                    if not response_started:
+                        response = JSONResponse({'detail': 'Client closed request'}, status_code=499)
+                        await response(scope, receive_message, send)
+                    return
+
+            metrics.inc('requests_deadline_exceeded')
+            db_logger.warning('Deadline of %.0f ms exceeded in %s %s', timeout * 1000, request.method, request.url.path)
+            await self.cancel(app_task)
+            if not response_started:
+                response = JSONResponse({'detail': 'Request deadline exceeded'}, status_code=504)
+                await response(scope, receive_message, send)
+        finally:
+            watcher.cancel()
+            if not app_task.done():
+                await self.cancel(app_task)
+            current_deadline.get().clear()
+            current_deadline.reset(token)
+
+    @staticmethod
+    async def cancel(task: asyncio.Task):
+        """Отменяет обработку запроса. asyncpg при отмене прерывает выполняющийся запрос на сервере"""
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
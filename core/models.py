@@ -0,0 +1,13 @@
+from tortoise import models, fields
+
+
+"""Служебные модели приложения"""
+
+
+class SchemaVersion(models.Model):
+    id = fields.IntField(pk=True)
+    version = fields.CharField(max_length=64)  # Хеш схемы, которую применил migrate.py
+    applied_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = 'SchemaVersion'
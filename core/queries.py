@@ -0,0 +1,212 @@
+import asyncio
+import functools
+import random
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from tortoise import connections
+from tortoise.backends.base.client import BaseTransactionWrapper
+from tortoise.backends.base.executor import BaseExecutor
+from tortoise.queryset import UpdateQuery
+
+from config import SLOW_QUERY_MS, QUERY_LOG_SAMPLE_RATE, N_PLUS_ONE_THRESHOLD
+from core.deadline import remaining
+from core.logger import db_logger
+from core.metrics import metrics
+
+
+"""Учёт SQL-запросов в рамках одного HTTP-запроса: количество, суммарное время, медленные запросы и N+1"""
+
+
+QUERY_METHODS = ('execute_insert', 'execute_many', 'execute_query', 'execute_query_dict', 'execute_script')
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_write = re.compile(r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+"?(\w+)"?', re.IGNORECASE)
+
+# Корутины listener(table, columns), которые вызываются после каждого INSERT, UPDATE и DELETE
+write_listeners = []
+
+# Колонки выполняемого сейчас UPDATE. Их задаёт вызов ORM или updating(), а не разбор SQL
+update_columns: ContextVar[frozenset | None] = ContextVar('update_columns', default=None)
+
+
+def normalize_query(query: str) -> str:
+    """Заменяет литералы на ?, чтобы одинаковые по форме запросы считались одним шаблоном"""
+    return _literals.sub('?', query)
+
+
+def written_table(query: str) -> str | None:
+    """Таблица, которую изменяет запрос INSERT, UPDATE или DELETE. Для остальных запросов None"""
+    match = _write.match(query)
+    return match.group(1) if match else None
+
+
+@contextmanager
+def updating(columns):
+    """Колонки UPDATE, который выполняется внутри блока, для write_listeners. UPDATE вне такого блока,
+    например raw SQL, считается изменением любых колонок таблицы"""
+    token = update_columns.set(frozenset(columns))
+    try:
+        yield
+    finally:
+        update_columns.reset(token)
+
+
+def db_columns(model, names) -> frozenset:
+    """Колонки таблицы модели для её полей. Связь заменяется колонкой внешнего ключа: category -> category_id"""
+    meta = model._meta
+    columns = set()
+    for name in names:
+        source = getattr(meta.fields_map.get(name), 'source_field', None) or name
+        columns.add(meta.fields_db_projection.get(source, source))
+    return frozenset(columns)
+
+
+class QueryRecorder:
+    """Собирает статистику по SQL-запросам, выполненным в рамках одного HTTP-запроса"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.templates = Counter()
+
+    def record(self, query: str, duration: float):
+        self.count += 1
+        self.total_time += duration
+        self.templates[normalize_query(query)] += 1
+
+    @property
+    def total_ms(self) -> float:
+        return self.total_time * 1000
+
+    def n_plus_one(self) -> list:
+        """Шаблоны запросов, которые повторились не меньше N_PLUS_ONE_THRESHOLD раз"""
+        return [template for template, count in self.templates.items() if count >= N_PLUS_ONE_THRESHOLD]
+
+
+current_recorder: ContextVar[QueryRecorder | None] = ContextVar('current_recorder', default=None)
+
+
+def record_query(query: str, duration: float):
+    """Регистрирует выполненный запрос. Запрос логируется только если он медленный или попал в выборку"""
+    recorder = current_recorder.get()
+    if recorder is not None:
+        recorder.record(query, duration)
+
+    duration_ms = duration * 1000
+    if duration_ms >= SLOW_QUERY_MS:
+        metrics.inc('db_slow_queries')
+        db_logger.warning('Slow query (%.1f ms): %s', duration_ms, query)
+    elif QUERY_LOG_SAMPLE_RATE and random.random() < QUERY_LOG_SAMPLE_RATE:
+        db_logger.info('Sampled query (%.1f ms): %s', duration_ms, query)
+
+
+def _timed(method):
+    """Оборачивает execute_* метод клиента БД замером времени выполнения. Внутри HTTP-запроса SQL-запрос
+    ждёт не дольше, чем осталось до дедлайна запроса. После изменяющего запроса вызываются write_listeners"""
+
+    @functools.wraps(method)
+    async def wrapper(self, query, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(method(self, query, *args, **kwargs), remaining())
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+        table = written_table(query) if write_listeners else None
+        if table:
+            columns = update_columns.get() if query.lstrip()[:6].upper() == 'UPDATE' else None
+            await notify_write(table, columns)
+            if isinstance(self, BaseTransactionWrapper):
+                """Запрос станет виден другим соединениям только после фиксации, поэтому слушатели вызываются
+                ещё раз после неё"""
+                pending = self.__dict__.setdefault('pending_writes', {})
+                previous = pending.get(table, frozenset())
+                pending[table] = None if previous is None or columns is None else previous | columns
+        return result
+
+    wrapper.query_recorded = True
+    return wrapper
+
+
+def _committed(method):
+    """Оборачивает commit транзакции: после фиксации write_listeners вызываются для всех таблиц, изменённых
+    в транзакции. Читатель, который между запросом и фиксацией закешировал прежние строки, их больше не прочитает"""
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        result = await method(self, *args, **kwargs)
+        pending = self.__dict__.pop('pending_writes', {})
+        for table, columns in pending.items():
+            await notify_write(table, columns)
+        return result
+
+    wrapper.query_recorded = True
+    return wrapper
+
+
+def _tracked_update(columns):
+    """Оборачивает метод ORM, который выполняет UPDATE: columns(self, *args) - колонки, которые он изменяет"""
+
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            with updating(columns(self, *args)):
+                return await method(self, *args, **kwargs)
+
+        wrapper.query_recorded = True
+        return wrapper
+
+    return decorator
+
+
+async def notify_write(table: str, columns: frozenset | None):
+    for listener in write_listeners:
+        await listener(table, columns)
+
+
+def _query_columns(query) -> frozenset:
+    return db_columns(query.model, query.update_kwargs)
+
+
+def _saved_columns(executor, instance, update_fields=None) -> frozenset:
+    """save() без update_fields записывает все колонки, кроме первичного ключа"""
+    meta = executor.model._meta
+    return db_columns(executor.model, update_fields or [name for name in meta.fields_db_projection
+                                                        if name != meta.pk_attr])
+
+
+def instrument_updates():
+    """Передаёт write_listeners колонки из вызовов ORM: QuerySet.update(**поля) и Model.save(update_fields).
+    Повторный вызов ничего не делает"""
+    if not getattr(UpdateQuery._execute, 'query_recorded', False):
+        UpdateQuery._execute = _tracked_update(_query_columns)(UpdateQuery._execute)
+    if not getattr(BaseExecutor.execute_update, 'query_recorded', False):
+        BaseExecutor.execute_update = _tracked_update(_saved_columns)(BaseExecutor.execute_update)
+
+
+def instrument_client_class(client_class):
+    """Подменяет execute_* методы класса клиента на версии с замером времени. Повторный вызов ничего не делает"""
+    for name in QUERY_METHODS:
+        method = getattr(client_class, name, None)
+        if method is not None and not getattr(method, 'query_recorded', False):
+            setattr(client_class, name, _timed(method))
+
+
+def install_query_recorder():
+    """Подключает учёт запросов ко всем открытым соединениям TortoiseORM и их транзакциям
+    и передачу колонок UPDATE из вызовов ORM"""
+    for connection in connections.all():
+        client_class = type(connection)
+        instrument_client_class(client_class)
+
+        transaction_class = getattr(sys.modules[client_class.__module__], 'TransactionWrapper', None)
+        if transaction_class is not None:
+            instrument_client_class(transaction_class)
+            if not getattr(transaction_class.commit, 'query_recorded', False):
+                transaction_class.commit = _committed(transaction_class.commit)
+    instrument_updates()
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import secrets
+from copy import copy
+
+from aiocache.serializers import JsonSerializer
+
+from config import PREFETCH_BUDGET
+from core.cache import create_cache, to_bytes
+from core.limiter import limiter
+from core.logger import get_logger
+from core.metrics import metrics
+from core.queries import write_listeners
+from core.responses import render
+
+
+"""Кеш результатов запросов TortoiseORM. Ключ записи - хеш скомпилированного SQL вместе с параметрами, поэтому
+разные фильтры, сортировки и страницы кешируются отдельно. У каждой таблицы есть поколение - случайная метка,
+которой помечаются записи кеша. Любой INSERT, UPDATE или DELETE в таблицу, в том числе из raw SQL, меняет её
+поколение, и все записи со старой меткой перестают читаться без перебора ключей.
+Для списков объектов Example кешируется только упорядоченный список id, а сами строки берутся из кеша объектов,
+поэтому такие списки помечаются поколениями строк и отдельных колонок и переживают изменения других колонок.
+Поколение меняется сразу после выполнения запроса и, если запрос выполнен в транзакции, ещё раз после её
+фиксации: список, закешированный между запросом и фиксацией по прежним строкам, не переживает фиксацию"""
+
+
+query_cache_logger = get_logger('query_cache_logger')
+
+
+PREFETCHED = b'prefetched'  # Отметка записи, загруженной заранее и ещё не прочитанной
+
+
+def generation_key(table: str) -> str:
+    """Поколение, которое меняется при любом изменении таблицы"""
+    return f'generation_{table}'
+
+
+def rows_generation_key(table: str) -> str:
+    """Поколение, которое меняется, когда строки таблицы добавляются или удаляются"""
+    return f'generation_{table}_rows'
+
+
+def column_generation_key(table: str, column: str) -> str:
+    """Поколение, которое меняется при UPDATE колонки"""
+    return f'generation_{table}.{column}'
+
+
+def new_generation() -> bytes:
+    return secrets.token_hex(8).encode()
+
+
+class QueryCache:
+    """Кеш готовых JSON-ответов по запросам к зарегистрированным моделям"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.models = []
+        self._dependents = None
+        self.prefetching = 0  # Заранее загружаемых сейчас ответов
+        self.prefetched = 0
+        self.prefetch_hits = 0
+
+    def register(self, model):
+        """Подключает автоматическую инвалидацию кеша запросов к таблице модели"""
+        self.models.append(model)
+        self._dependents = None
+
+    @property
+    def dependents(self) -> dict:
+        """Таблица -> зарегистрированные таблицы, строки которых удаляются вместе с её строками (ON DELETE CASCADE).
+        Считается при первом обращении, потому что связи моделей известны только после инициализации TortoiseORM"""
+        if self._dependents is None:
+            dependents = {model._meta.db_table: set() for model in self.models}
+            for model in self.models:
+                for field_name in model._meta.fk_fields:
+                    related_table = model._meta.fields_map[field_name].related_model._meta.db_table
+                    dependents.setdefault(related_table, set()).add(model._meta.db_table)
+            self._dependents = dependents
+        return self._dependents
+
+    async def lookup(self, key: str, generation_keys: list) -> tuple:
+        """Текущие поколения и запись кеша по ключу - одним запросом к кешу. Запись кеша - метка и данные
+        через перевод строки. Метка - поколения через точку, за которыми у заранее загруженной записи,
+        которую ещё не читали, через пробел идёт PREFETCHED. Возвращает (поколения, данные или None, отметка)"""
+        *generations, entry = await self.cache.multi_get([*generation_keys, key], loads_fn=to_bytes)
+        if entry is None or None in generations:
+            return generations, None, b''
+        tag, _, payload = self.cache.serializer.unpack(entry).partition(b'\n')
+        tag, _, origin = tag.partition(b' ')
+        if tag != b'.'.join(generations):
+            return generations, None, b''
+        return generations, payload, origin
+
+    async def fetch(self, key: str, generation_keys: list, load, prefetch: bool = False) -> bytes:
+        """Данные записи key из кеша или из корутины load() при промахе. prefetch=True - запись загружается
+        заранее и помечается, чтобы учесть её первое чтение"""
+        generations, payload, origin = await self.lookup(key, generation_keys)
+        if payload is not None:
+            if prefetch:
+                return payload
+            metrics.inc('query_cache_hits')
+            if origin == PREFETCHED:
+                # Первое чтение заранее загруженной записи. Метка снимается, чтобы запись учлась один раз
+                self.prefetch_hits += 1
+                metrics.inc('query_cache_prefetch_hits')
+                self.report_prefetch()
+                await self.cache.set_body(key, b'.'.join(generations) + b'\n' + payload)
+            return payload
+
+        if not prefetch:
+            metrics.inc('query_cache_misses')
+        generations = await self.start_generations(generation_keys, generations)
+        payload = await load()
+        if generations is not None:
+            tag = b'.'.join(generations) + (b' ' + PREFETCHED if prefetch else b'')
+            await self.cache.set_body(key, tag + b'\n' + payload)
+            if prefetch:
+                self.prefetched += 1
+                metrics.inc('query_cache_prefetched')
+                self.report_prefetch()
+        return payload
+
+    async def body(self, queryset, adapter, prefetch: bool = False) -> bytes:
+        """JSON-тело ответа для queryset: из кеша или из БД с валидацией через adapter.
+        Запись помечена поколением таблицы, которое меняется при любом изменении таблицы"""
+        table = queryset.model._meta.db_table
+        key = 'query_' + query_digest(queryset)
+        return await self.fetch(key, [generation_key(table)], lambda: self.load(queryset, adapter), prefetch)
+
+    async def ids(self, queryset, depends: set, prefetch: bool = False) -> list[int]:
+        """Упорядоченный список id для queryset вида values_list('id', flat=True). depends - пары (таблица, колонка)
+        из depends_on для полей, по которым запрос фильтрует и сортирует. Запись помечена поколением строк таблицы,
+        которое меняется при INSERT и DELETE, и поколениями колонок depends, которые меняются при UPDATE этих
+        колонок, в том числе в связанных таблицах. Поэтому изменение других колонок не сбрасывает список: сами
+        строки берутся из кеша объектов"""
+        table = queryset.model._meta.db_table
+        generation_keys = [rows_generation_key(table)] + [column_generation_key(*depend)
+                                                          for depend in sorted(depends)]
+
+        async def load():
+            return json.dumps(list(await queryset)).encode()
+
+        return json.loads(await self.fetch('ids_' + query_digest(queryset), generation_keys, load, prefetch))
+
+    async def prefetch(self, load, *args, **kwargs):
+        """Заранее загружает в кеш данные корутиной load(*args, prefetch=True, **kwargs), обычно следующую
+        страницу списка. Запускается через BackgroundTasks после ответа клиенту. Пропускается, если воркер уже
+        выполняет PREFETCH_BUDGET загрузок или занято больше половины лимита маршрутов, которые идут в БД"""
+        db_read = limiter.limits.get('db_read')
+        if self.prefetching >= PREFETCH_BUDGET or (db_read and db_read.in_flight * 2 >= int(db_read.limit)):
+            metrics.inc('query_cache_prefetch_skipped')
+            return
+
+        self.prefetching += 1
+        try:
+            await load(*args, prefetch=True, **kwargs)
+        except Exception as exc:
+            query_cache_logger.warning('Query cache prefetch failed: %r', exc)
+        finally:
+            self.prefetching -= 1
+
+    @staticmethod
+    async def load(queryset, adapter) -> bytes:
+        """Выполняет запрос и сериализует результат"""
+        return render(adapter, await queryset)
+
+    def report_prefetch(self):
+        """Доля заранее загруженных записей, которые потом прочитали. Запись может загрузить один воркер,
+        а прочитать другой, поэтому точное значение по всем воркерам - сумма query_cache_prefetch_hits,
+        делённая на сумму query_cache_prefetched"""
+        if self.prefetched:
+            metrics.set('query_cache_prefetch_hit_rate', round(self.prefetch_hits / self.prefetched, 3))
+
+    async def start_generations(self, generation_keys: list, generations: list) -> list | None:
+        """Создаёт отсутствующие поколения. Если какое-то из них одновременно создал другой запрос,
+        возвращает None, и результат этого запроса не кешируется"""
+        generations = list(generations)
+        for index, (key, generation) in enumerate(zip(generation_keys, generations)):
+            if generation is None:
+                generations[index] = new_generation()
+                try:
+                    await self.cache.add(key, generations[index], dumps_fn=to_bytes)
+                except ValueError:
+                    return None
+        return generations
+
+    async def invalidate(self, table: str, columns: frozenset | None = None):
+        """Меняет поколения таблицы одним запросом к кешу. columns - изменённые запросом UPDATE колонки из вызова
+        ORM, None - строки добавлены или удалены либо колонки UPDATE неизвестны. У таблиц, строки которых
+        удаляются каскадно вместе с её строками, меняются поколения строк"""
+        if table not in self.dependents:
+            return
+        keys = [generation_key(table)]
+        keys += [rows_generation_key(table)] if columns is None else \
+            [column_generation_key(table, column) for column in columns]
+        if columns is None:
+            for name in self.dependents[table]:
+                keys += [generation_key(name), rows_generation_key(name)]
+        await self.cache.multi_set([(key, new_generation()) for key in keys], dumps_fn=to_bytes)
+        metrics.inc('query_cache_invalidations')
+
+    async def on_write(self, table: str, columns: frozenset | None = None):
+        """Вызывается core.queries после каждого изменяющего запроса и после фиксации транзакции.
+        Недоступный кеш не ломает уже выполненную запись: записи со старым поколением истекут через REDIS_TTL"""
+        try:
+            await self.invalidate(table, columns)
+        except Exception as exc:
+            query_cache_logger.warning('Query cache invalidation failed for %s: %r', table, exc)
+
+
+def query_digest(queryset) -> str:
+    """Хеш SQL запроса. SQL собирается на копии queryset со своим списком присоединённых таблиц: ValuesListQuery
+    в TortoiseORM 0.20 не сбрасывает этот список при повторной сборке запроса, и выполнение queryset после sql()
+    потеряло бы JOIN сортировки по связи, например по category__title"""
+    query = copy(queryset)
+    query._joined_tables = []
+    return hashlib.sha1(query.sql().encode()).hexdigest()
+
+
+def depends_on(model, *fields: str) -> set:
+    """Пары (таблица, колонка) для полей фильтров и сортировки. Знак "-" сортировки отбрасывается,
+    связь заменяется колонкой внешнего ключа: category -> category_id, а поле через связь добавляет
+    и колонку связанной таблицы: category__title -> category_id и (categories, title)"""
+    depends = set()
+    for name in fields:
+        meta = model._meta
+        for part in name.lstrip('-').split('__'):
+            field = meta.fields_map.get(part)
+            source = getattr(field, 'source_field', None) or part
+            depends.add((meta.db_table, meta.fields_db_projection.get(source, source)))
+            related_model = getattr(field, 'related_model', None)
+            if related_model is None:
+                break
+            meta = related_model._meta
+    return depends
+
+
+query_cache = QueryCache(create_cache(serializer=JsonSerializer(), namespace='queries'))
+write_listeners.append(query_cache.on_write)
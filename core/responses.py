@@ -0,0 +1,29 @@
+from pydantic import TypeAdapter
+from pydantic_core import to_json
+from starlette.responses import Response
+
+
+"""Готовые JSON-ответы из кеша. Ответ валидируется через pydantic и сериализуется один раз при промахе кеша,
+а при попадании в кеш его байты отдаются как есть, без повторной валидации через response_model.
+Списки, которые собираются из строк кеша объектов, сериализуются без валидации"""
+
+
+def render(adapter: TypeAdapter, data) -> bytes:
+    """Валидирует данные по схеме ответа и возвращает JSON-тело ответа"""
+    return adapter.dump_json(adapter.validate_python(data))
+
+
+def render_trusted(data) -> bytes:
+    """JSON-тело из строк кеша объектов без валидации. Строки попадают в кеш из БД и уже имеют типы схемы
+    ответа, поэтому при каждом попадании в кеш проверять их через pydantic заново не нужно"""
+    return to_json(data)
+
+
+def columnar(columns: tuple, rows: list) -> dict:
+    """Переводит строки-кортежи в колонки: {колонка: [значения]}. Названия ключей не повторяются в каждой строке"""
+    return dict(zip(columns, map(list, zip(*rows)))) if rows else {column: [] for column in columns}
+
+
+def json_response(body: bytes) -> Response:
+    """Ответ с готовым JSON-телом. FastAPI не валидирует объекты Response через response_model"""
+    return Response(content=body, media_type='application/json')
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+from config import WARM_UP_KEYS, WARM_UP_TIMEOUT
+from core.logger import get_logger
+from core.metrics import metrics
+
+
+"""Замер фаз запуска воркера и прогрев внешних зависимостей"""
+
+
+startup_logger = get_logger('startup_logger')
+
+
+class BootTimer:
+    """Запоминает длительность фаз запуска воркера и пишет их в лог и метрики boot_<фаза>_ms"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = {}
+
+    def phase(self, name: str):
+        """Закрывает фазу name, которая длилась с конца предыдущей фазы"""
+        now = time.perf_counter()
+        self.phases[name] = round((now - self.last) * 1000, 2)
+        metrics.set(f'boot_{name}_ms', self.phases[name])
+        self.last = now
+
+    def finish(self):
+        total = round((self.last - self.started) * 1000, 2)
+        metrics.set('boot_total_ms', total)
+        startup_logger.info('Worker booted in %s ms, phases: %s', total, self.phases)
+
+
+async def warm_up_caches(*caches):
+    """Открывает соединения к кешам до приёма первого запроса. Недоступный кеш не мешает запуску воркера"""
+    for cache in caches:
+        try:
+            await cache.exists('warm_up')
+        except Exception as exc:
+            startup_logger.warning('Cache warm-up failed for %r: %s', cache, exc)
+
+
+async def warm_up_hot_keys(hot_keys):
+    """Загружает в кеш самые запрашиваемые ключи не дольше WARM_UP_TIMEOUT секунд. Ошибка прогрева
+    не мешает запуску воркера: ключи загрузятся из БД при первых запросах"""
+    try:
+        await asyncio.wait_for(hot_keys.warm_up(WARM_UP_KEYS), WARM_UP_TIMEOUT)
+    except Exception as exc:
+        startup_logger.warning('Hot keys warm-up failed: %r', exc)
+
+
+async def build_users_bloom(bloom):
+    """Строит фильтр Блума по username и email из БД. Если построить не удалось, воркер запускается,
+    а все значения проверяются в БД"""
+    try:
+        await bloom.rebuild()
+    except Exception as exc:
+        startup_logger.warning('Users bloom filter build failed: %r', exc)
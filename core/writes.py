@@ -0,0 +1,88 @@
+from tortoise import connections
+from tortoise.transactions import in_transaction
+
+from core.db import QueryParams, db_value
+from core.queries import db_columns, updating
+from users.models import User
+
+
+"""Обновление объекта одним запросом UPDATE ... RETURNING: проверка прав пользователя, запись и чтение
+обновлённой строки выполняются одним запросом к БД вместо отдельных запросов пользователя, обновления и чтения.
+Пакетное создание объектов одним запросом INSERT ... RETURNING, который возвращает id созданных строк"""
+
+
+async def update_returning(model, obj_id: int, values: dict, username: str | None, allow_owner: bool = False,
+                           previous: tuple = ()) -> dict | None:
+    """Обновляет объект obj_id значениями values, увеличивает его version и возвращает новую строку в том же виде,
+    в котором её возвращает .values(). Строка обновляется, только если пользователь username - супер юзер,
+    а при allow_owner - ещё и если он сам является обновляемым пользователем (для модели User).
+    username=None - обновление без проверки прав, когда право на него уже проверено иначе.
+    Если объекта нет или не хватает прав, возвращается None.
+    previous - поля, значения которых до обновления добавляются в результат с ключами previous_<поле>"""
+    connection = connections.get('default')
+    param = QueryParams(connection)
+    postgres = param.postgres
+    meta = model._meta
+    table, pk = meta.db_table, meta.db_pk_column
+
+    assignments = [f'"{meta.fields_db_projection[name]}" = {param(db_value(connection, meta.fields_map[name], value))}'
+                   for name, value in values.items()]
+    updated = set(values)
+    if 'version' in meta.fields_map:
+        assignments.append(f'"version" = "{table}"."version" + 1')
+        updated.add('version')
+
+    where = f'"{table}"."{pk}" = {param(obj_id)}'
+    allowed = '"principal"."is_superuser"'
+    if allow_owner:
+        allowed += f' OR "principal"."id" = "{table}"."{pk}"'
+    guard = (f'EXISTS (SELECT 1 FROM "{User._meta.db_table}" AS "principal" '
+             f'WHERE "principal"."username" = {param(username)} AND ({allowed}))') if username is not None else '1 = 1'
+    returning = [f'"{table}"."{column}"' for column in meta.fields_db_projection.values()]
+
+    with updating(db_columns(model, updated)):
+        if previous and postgres:
+            """В postgres присоединённая через FROM строка "previous" видна в состоянии до обновления,
+            поэтому прежние значения возвращаются тем же запросом"""
+            returning += [f'"previous"."{meta.fields_db_projection[name]}" AS "previous_{name}"' for name in previous]
+            sql = (f'UPDATE "{table}" SET {", ".join(assignments)} FROM "{table}" AS "previous" '
+                   f'WHERE {where} AND "previous"."{pk}" = "{table}"."{pk}" AND {guard} '
+                   f'RETURNING {", ".join(returning)}')
+            _, rows = await connection.execute_query(sql, param)
+            old = rows[0] if rows else None
+        else:
+            sql = (f'UPDATE "{table}" SET {", ".join(assignments)} WHERE {where} AND {guard} '
+                   f'RETURNING {", ".join(returning)}')
+            if previous:
+                """RETURNING в sqlite видит только новые значения, поэтому прежние читаются в той же транзакции"""
+                async with in_transaction() as transaction:
+                    old = await model.filter(pk=obj_id).using_db(transaction).first().values(*previous)
+                    _, rows = await transaction.execute_query(sql, param)
+            else:
+                _, rows = await connection.execute_query(sql, param)
+                old = None
+
+    if not rows:
+        return None
+    row = {name: meta.fields_map[name].to_python_value(rows[0][column])
+           for name, column in meta.fields_db_projection.items()}
+    for name in previous:
+        row[f'previous_{name}'] = old[f'previous_{name}'] if postgres else old[name]
+    return row
+
+
+async def insert_returning(model, rows: list) -> list[int]:
+    """Создаёт объекты из словарей полей rows одним запросом и возвращает их id. В отличие от поиска последних id
+    после bulk_create, это id именно этих строк, даже если одновременно объекты создают другие запросы"""
+    connection = connections.get('default')
+    param = QueryParams(connection)
+    meta = model._meta
+    names = [name for name in meta.fields_db_projection if name != meta.pk_attr]
+    objects = [model(**row) for row in rows]  # Значения по умолчанию подставляются так же, как в bulk_create
+
+    columns = ', '.join(f'"{meta.fields_db_projection[name]}"' for name in names)
+    values = ', '.join('(' + ', '.join(param(db_value(connection, meta.fields_map[name], getattr(obj, name), obj))
+                                       for name in names) + ')' for obj in objects)
+    _, result = await connection.execute_query(
+        f'INSERT INTO "{meta.db_table}" ({columns}) VALUES {values} RETURNING "{meta.db_pk_column}"', param)
+    return [row[meta.db_pk_column] for row in result]
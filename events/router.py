@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+from fastapi import APIRouter, Query, WebSocket
+from fastapi.responses import StreamingResponse
+from starlette import status
+from starlette.exceptions import HTTPException
+
+from config import EVENTS_HEARTBEAT_SECONDS
+from core.batch import parse_ids
+from core.events import event_bus
+
+
+"""Инициализация роутера"""
+events_router = APIRouter(prefix='/events', tags=['events'])
+
+
+def parse_categories(categories: str | None) -> set | None:
+    """Фильтр по категориям из query-параметра вида "1,2,3". None - события всех категорий"""
+    return set(parse_ids(categories)) if categories else None
+
+
+@events_router.get('/stream')
+async def stream_events(categories: str = Query(None, description='id категорий через запятую: 1,2,3')):
+
+    """Эта функция отдаёт ленту изменений объектов Example и категорий в формате Server-Sent Events,
+    чтобы клиентам не нужно было опрашивать списки. Каждое событие имеет вид:
+        event: example.updated
+        data: {
+            "entity": "example",
+            "action": "updated",
+            "id": 0,
+            "category_id": 0,
+            "previous_category_id": 0,
+            "data": {...}
+        }
+    action - created, updated, deleted или bulk_created. Параметр categories оставляет только события указанных
+    категорий. Если клиент не успевает читать события, он получает событие stream.overflow и должен перечитать
+    данные. Раз в EVENTS_HEARTBEAT_SECONDS отправляется пустое сообщение, чтобы соединение не закрывали прокси"""
+
+    category_ids = parse_categories(categories)
+
+    async def event_stream():
+        async with event_bus.subscribe(category_ids) as subscription:
+            yield ': connected\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), EVENTS_HEARTBEAT_SECONDS)
+                except TimeoutError:
+                    yield ': ping\n\n'
+                    continue
+                yield f'event: {event["entity"]}.{event["action"]}\ndata: {json.dumps(event)}\n\n'
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@events_router.websocket('/ws')
+async def events_websocket(websocket: WebSocket, categories: str = None):
+
+    """Та же лента изменений, что и /events/stream, через WebSocket. Каждое событие отправляется отдельным
+    JSON-сообщением. Если параметр categories некорректен, соединение закрывается с кодом 1008"""
+
+    try:
+        category_ids = parse_categories(categories)
+    except HTTPException as exc:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=exc.detail)
+        return
+
+    await websocket.accept()
+    async with event_bus.subscribe(category_ids) as subscription:
+        receiver = asyncio.create_task(websocket.receive())  # Завершится, когда клиент отключится
+        getter = asyncio.create_task(subscription.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait({receiver, getter}, return_when=asyncio.FIRST_COMPLETED)
+                if receiver in done:
+                    if receiver.result()['type'] == 'websocket.disconnect':
+                        return
+                    receiver = asyncio.create_task(websocket.receive())  # Сообщения клиента не используются
+                if getter in done:
+                    await websocket.send_json(getter.result())
+                    getter = asyncio.create_task(subscription.get())
+        finally:
+            receiver.cancel()
+            getter.cancel()
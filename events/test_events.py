@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+from asgi_lifespan import LifespanManager
+from httpx import AsyncClient, ASGITransport
+
+from core.events import event_bus
+from main import app
+
+
+"""Файл с тестами"""
+
+
+@pytest.fixture(scope="module")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="module")
+async def client():
+    async with LifespanManager(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://localhost:10000/api/v1") as c:
+            yield c
+
+
+@pytest.mark.anyio
+async def test_example_events(client: AsyncClient):
+    get_admin_jwt_token = await client.post('/users/login', json={
+        "username": "Riwick",
+        "password": "string"
+    })
+    assert get_admin_jwt_token.status_code == 200
+    admin_jwt_token = get_admin_jwt_token.json().get('access_token')
+    admin_jwt_type = get_admin_jwt_token.json().get('token_type')
+
+    async with event_bus.subscribe({1}) as subscription, event_bus.subscribe({-1}) as other_subscription:
+        response = await client.post('/examples/', json={
+            "title": "string",
+            "age": 1,
+            "price": 1,
+            "description": "string",
+            "category_id": 1
+        }, headers={'Authorization': f'{admin_jwt_type.capitalize()} {admin_jwt_token}'})
+        assert response.status_code == 200
+
+        event = await asyncio.wait_for(subscription.get(), 5)
+        assert event['entity'] == 'example'
+        assert event['action'] == 'created'
+        assert event['id'] == response.json()['id']
+        assert event['data']['category_id'] == 1
+        assert other_subscription.queue.empty()  # События чужих категорий не доставляются
+
+    fail_response = await client.get('/events/stream?categories=a')
+    assert fail_response.status_code == 422
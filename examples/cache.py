@@ -1,8 +1,8 @@
-from aiocache import RedisCache
 from aiocache.serializers import JsonSerializer
 
-from config import REDIS_HOST, REDIS_PORT, REDIS_TTL
+from core.cache import create_cache
 
-"""Настройки кеша через редис. Используется 1 база данных. Время хранения кеша равно 60 секундам"""
+"""Настройки кеша. Бэкенд задаётся CACHE_BACKEND, ключи хранятся с префиксом examples. Время хранения кеша
+задаётся REDIS_TTL"""
 
-cache = RedisCache(serializer=JsonSerializer(), endpoint=REDIS_HOST, port=REDIS_PORT, db=1, ttl=REDIS_TTL)
+cache = create_cache(serializer=JsonSerializer(), namespace='examples')
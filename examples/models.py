@@ -15,6 +15,7 @@ class ExampleModel(models.Model):
     description = fields.CharField(max_length=2000, null=True)
     category: fields.ForeignKeyRelation[Category] = fields.ForeignKeyField(
         'models.Category', on_delete=fields.OnDelete.CASCADE)
+    version = fields.IntField(default=1)  # Увеличивается при каждом обновлении, нужен для записи в кеш
 
     class Meta:
         table = 'Example'
@@ -1,14 +1,27 @@
-from typing import List
+from typing import List, Literal
 
-from fastapi import APIRouter, Query, Depends
+from fastapi import APIRouter, Query, Depends, BackgroundTasks
 
 from starlette import status
 from starlette.exceptions import HTTPException
 
 from examples.models import ExampleModel
-from examples.schemas import ListExamplePydantic, CreateExamplePydantic, Status
+from examples.schemas import (ListExamplePydantic, CreateExamplePydantic, Status, BatchExamplePydantic,
+                              ColumnarExamplePydantic)
 from examples.cache import cache
 
+from categories.stats import record_added, record_removed, record_updated
+from core.events import event_bus
+from config import BULK_MAX_ITEMS, PREFETCH_BUDGET
+
+from core.batch import parse_ids, load_many, batch_response
+from core.cache import is_tombstone
+from core.db import model_row
+from core.hotkeys import hot_keys
+from core.querycache import query_cache, depends_on
+from core.responses import json_response, render_trusted, columnar
+from core.writes import insert_returning, update_returning
+
 from users.auth import verify_token
 from users.models import User
 from users.router import oauth2_scheme
@@ -17,10 +30,14 @@ from users.router import oauth2_scheme
 """Инициализация роутера"""
 example_model_router = APIRouter(prefix='/examples', tags=['examples'])
 
+EXAMPLE_COLUMNS = tuple(ColumnarExamplePydantic.model_fields)  # Колонки ответа get_examples в обоих форматах
+query_cache.register(ExampleModel)  # Списки id сбрасываются при изменении их строк и колонок фильтров и сортировки
+
 
-@example_model_router.get('/', response_model=List[ListExamplePydantic])
-async def get_examples(offset: int = Query(0, ge=0), limit: int = Query(10, ge=1),
-                       order_by: str = Query('id'),
+@example_model_router.get('/', response_model=List[ListExamplePydantic] | ColumnarExamplePydantic)
+async def get_examples(background_tasks: BackgroundTasks,
+                       offset: int = Query(0, ge=0), limit: int = Query(10, ge=1), order_by: str = Query('id'),
+                       format: Literal['rows', 'columnar'] = Query('rows'),
                        title: str = Query(None), price: float = Query(None, ge=1),
                        category_id: int = Query(None, ge=1), example_id: int = Query(None, ge=1)):
 
@@ -38,11 +55,15 @@ async def get_examples(offset: int = Query(0, ge=0), limit: int = Query(10, ge=1
     ]
     Она поддерживает пагинацию через offset и limit, сортировку через order_by(по умолчанию стоит сортировка по id)
     и фильтры. Они идут после order_by в параметрах функции и представляют собой query-запросы.
-    В случае если нет ни одного объекта, выводится пустой список []"""
-
-    cached_examples = await cache.get('examples')  # Пытаемся взять данные из кеша
-    if cached_examples:
-        return cached_examples
+    В случае если нет ни одного объекта, выводится пустой список []
+    С format=columnar ответ выводится по колонкам, и названия полей не повторяются в каждом объекте:
+    {
+        "id": [0, 1],
+        "title": ["string", "string"],
+        ...
+    }
+    Для каждого SQL-запроса кешируется только упорядоченный список id, а строки берутся из кеша объектов,
+    поэтому изменение объекта не сбрасывает закешированные страницы, если не меняет их состав или порядок"""
 
     filters = {}
     if title:
@@ -57,15 +78,74 @@ async def get_examples(offset: int = Query(0, ge=0), limit: int = Query(10, ge=1
     if filters:
         """Получение результата с фильтрами через распаковку словаря **filters"""
 
-        examples = await ExampleModel.filter(**filters).offset(offset).limit(limit).all().order_by(order_by).values()
-        await cache.set('examples', examples)  # Запись в кеш с фильтрами
+        examples = ExampleModel.filter(**filters).offset(offset).limit(limit).all().order_by(order_by)
 
     else:
         """Получение результата с без фильтров"""
-        examples = await ExampleModel.filter().offset(offset).limit(limit).all().order_by(order_by).values()
-        await cache.set('examples', examples)  # Запись в кеш без фильтров
+        examples = ExampleModel.filter().offset(offset).limit(limit).all().order_by(order_by)
+    next_page = ExampleModel.filter(**filters).offset(offset + limit).limit(limit).all().order_by(order_by)
+    depends = depends_on(ExampleModel, *filters, order_by)  # Колонки, изменение которых меняет состав страницы
+
+    if PREFETCH_BUDGET:
+        # Клиенты обычно запрашивают следующую страницу сразу после текущей, поэтому она загружается в кеш заранее
+        background_tasks.add_task(query_cache.prefetch, load_page, next_page, depends)
+
+    rows = await load_page(examples, depends)
+    if format == 'columnar':
+        """Колоночный формат: значения строк раскладываются по колонкам. Строки берутся из кеша объектов
+        словарями, поэтому колонки собираются из них, а не из кортежей values_list: запрос кортежей шёл бы в БД
+        мимо кеша объектов при каждом промахе списка"""
+        return json_response(render_trusted(columnar(EXAMPLE_COLUMNS, [tuple(row[column] for column in EXAMPLE_COLUMNS)
+                                                                       for row in rows])))
+    # Строки из кеша объектов не валидируются заново, из них только убирается служебная колонка version
+    return json_response(render_trusted([{column: row[column] for column in EXAMPLE_COLUMNS} for row in rows]))
+
+
+async def load_page(examples, depends: set, prefetch: bool = False) -> list[dict]:
+    """Строки страницы get_examples. Кеш запросов хранит только упорядоченный список id страницы, а строки
+    берутся из кеша объектов example_<id> одним MGET, и из БД догружаются только недостающие. Поэтому изменение
+    объекта перезаписывает только его ключ, а списки страниц переживают изменения колонок, которых нет в depends"""
+    ids = await query_cache.ids(examples.values_list('id', flat=True), depends, prefetch)
+    found = await load_many(cache, ExampleModel, ids, 'example')
+    return [found[example_id] for example_id in ids if example_id in found]
+
+
+async def warm_up_cache(keys: list):
+    """Прогрев кеша при запуске воркера: самые запрашиваемые объекты загружаются одним запросом к БД,
+    а первая страница get_examples - если её ещё нет в кеше"""
+    example_ids = [int(key.removeprefix('example_')) for key in keys if key.startswith('example_')]
+    if example_ids:
+        await load_many(cache, ExampleModel, example_ids, 'example')
+    await load_page(ExampleModel.filter().offset(0).limit(10).all().order_by('id'), depends_on(ExampleModel, 'id'))
 
-    return examples
+
+hot_keys.register(cache.namespace, warm_up_cache)
+
+
+@example_model_router.get('/batch', response_model=List[BatchExamplePydantic])
+async def get_examples_batch(ids: str = Query(..., description='id объектов через запятую: 1,2,3')):
+
+    """Эта функция выводит несколько объектов класса Example по списку id в порядке запроса в формате:
+    [
+        {
+            "id": 0,
+            "found": true,
+            "item": {
+                "id": 0,
+                "title": "string",
+                "age": 0,
+                "price": 0,
+                "description": "string",
+                "category_id": 0
+            }
+        }
+    ]
+    Все id читаются из кеша одним запросом, недостающие берутся из БД одним запросом и записываются в кеш.
+    Для несуществующих объектов found равен false, а item - null"""
+
+    example_ids = parse_ids(ids)
+    found = await load_many(cache, ExampleModel, example_ids, 'example')
+    return batch_response(example_ids, found)
 
 
 @example_model_router.get('/{example_id}', response_model=ListExamplePydantic)
@@ -80,24 +160,30 @@ async def get_example(example_id: int):
         "description": "string",
         "category_id": 0
     }
-    Если объект не существует, пробрасывается ошибка 404"""
+    Если объект не существует, пробрасывается ошибка 404. Отсутствие объекта тоже кешируется на короткое время"""
 
+    hot_keys.record(cache.namespace, f'example_{example_id}')  # Учёт обращения для прогрева кеша новых воркеров
     cached_item = await cache.get(f'example_{example_id}')  # Попытка получения кеша
+    if cached_item and is_tombstone(cached_item):
+        """Объекта нет, и это уже известно по кешу"""
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Example {example_id} not found')
     if cached_item:
         return cached_item
 
     example_obj = await ExampleModel.filter(id=example_id).first().values()  # Получение объекта
     if example_obj:
-        if not cached_item:
-            await cache.set(f'example_{example_id}', example_obj)  # Сохранение в кеш, если его нету
+        # Сохранение в кеш, если там нет более новой версии, записанной обновлением
+        await cache.set_if_newer([(f'example_{example_id}', example_obj, example_obj['version'])])
         return example_obj
     else:
         """В случае если объект не найден пробрасывается 404 ошибка"""
+        await cache.bury(f'example_{example_id}')  # Метка отсутствия, чтобы повторные запросы не шли в БД
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Example {example_id} not found')
 
 
 @example_model_router.post('/', response_model=ListExamplePydantic)
-async def create_example(data: CreateExamplePydantic, token: str = Depends(oauth2_scheme)):
+async def create_example(data: CreateExamplePydantic, background_tasks: BackgroundTasks,
+                         token: str = Depends(oauth2_scheme)):
 
     """Эта функция отвечает за создание объекта класса Example. Её могут пользоваться только супер юзеры, в противном
     случае будет проброшена ошибка 403 Forbidden. Валидация пользователя происходит через JWT-токен и его параметр sub,
@@ -110,14 +196,19 @@ async def create_example(data: CreateExamplePydantic, token: str = Depends(oauth
         "description": "string",
         "category_id": 0
     }
-    Данные для создания отправляются в теле запроса и валидируются через pydantic"""
+    Данные для создания отправляются в теле запроса и валидируются через pydantic.
+    Статистика категории обновляется через BackgroundTasks после отправки ответа"""
 
     payload = verify_token(token)
     user = await User.get(username=payload.get('sub'))  # Получаем пользователя из БД через токен
     if user.is_superuser:
 
         example_obj = await ExampleModel.create(**data.model_dump())  # Создаём объект
-        await cache.delete('examples')  # Удаляем кеш, который создавали в функции get_examples для его обновления
+        # Записываем объект в кеш. Кеш списков get_examples сбрасывается сам при записи в таблицу
+        await cache.write_through({f'example_{example_obj.id}': model_row(example_obj)})
+        background_tasks.add_task(record_added, [model_row(example_obj)])
+        background_tasks.add_task(event_bus.publish, 'example', 'created', model_row(example_obj),
+                                  category_id=example_obj.category_id)
         return example_obj
 
     else:
@@ -125,8 +216,45 @@ async def create_example(data: CreateExamplePydantic, token: str = Depends(oauth
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You have not enough permissions')
 
 
+@example_model_router.post('/bulk', response_model=Status)
+async def create_examples_bulk(data: List[CreateExamplePydantic], background_tasks: BackgroundTasks,
+                               token: str = Depends(oauth2_scheme)):
+
+    """Эта функция отвечает за пакетное создание объектов класса Example одним запросом к БД. Её могут пользоваться
+    только супер юзеры, в противном случае будет проброшена ошибка 403 Forbidden. В одном запросе можно создать
+    не больше BULK_MAX_ITEMS объектов. После создания возвращается ответ в формате:
+    {
+        "status_code": 200,
+        "message": "string",
+        "details": "string"
+    }
+    Статистика категорий обновляется одним запросом через BackgroundTasks после отправки ответа"""
+
+    if len(data) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f'No more than {BULK_MAX_ITEMS} examples per request')
+
+    payload = verify_token(token)
+    if not await User.filter(username=payload.get('sub'), is_superuser=True).exists():
+        """Если пользователь не является супер юзером, то пробрасывается ошибка 403"""
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You have not enough permissions')
+
+    rows = [item.model_dump() for item in data]
+    created_ids = await insert_returning(ExampleModel, rows)  # Все объекты одним запросом
+    # Метки отсутствия удаляются ровно для созданных id одним запросом к кешу
+    await cache.invalidate(*(f'example_{example_id}' for example_id in created_ids))
+    background_tasks.add_task(record_added, rows)
+    for category_id in {row['category_id'] for row in rows}:  # Одно событие на категорию вместо события на объект
+        background_tasks.add_task(event_bus.publish, 'example', 'bulk_created',
+                                  {'count': sum(row['category_id'] == category_id for row in rows)},
+                                  category_id=category_id)
+
+    return Status(message=f'{len(rows)} examples created')
+
+
 @example_model_router.put('/{example_id}', response_model=ListExamplePydantic)
-async def update_example(example_id: int, data: CreateExamplePydantic, token: str = Depends(oauth2_scheme)):
+async def update_example(example_id: int, data: CreateExamplePydantic, background_tasks: BackgroundTasks,
+                         token: str = Depends(oauth2_scheme)):
 
     """Эта функция отвечает за обновление объекта модели Example по его id. Использовать функцию могут только
     супер юзеры, в противном случае будет проброшена ошибка 403 Forbidden. Валидация пользователя происходит через
@@ -139,33 +267,35 @@ async def update_example(example_id: int, data: CreateExamplePydantic, token: st
         "description": "string",
         "category_id": 0
     }
-    Данные для обновления валидируются через pydantic """
+    Данные для обновления валидируются через pydantic. Статистика категорий обновляется через BackgroundTasks
+    после отправки ответа"""
 
     payload = verify_token(token)
-    user = await User.get(username=payload.get('sub'))  # Получаем пользователя из БД через токен
-    if user.is_superuser:
-
-        example_obj = await ExampleModel.filter(id=example_id).update(**data.model_dump())  # Пытаемся обновить объект
-        if example_obj:  # int
-            """Если объект обновлен, то мы берем его из БД, сохраняем в кеш и отдаем пользователю"""
-            example_obj = await ExampleModel.filter(id=example_id).first().values()
+    # Проверка прав пользователя из токена, обновление и получение обновленного объекта вместе с прежними ценой
+    # и категорией одним запросом к БД
+    example_obj = await update_returning(ExampleModel, example_id, data.model_dump(), payload.get('sub'),
+                                         previous=('price', 'category_id'))
+    if example_obj:
+        """Если объект обновлен, то сохраняем его в кеш и отдаем пользователю"""
+        previous = {'price': example_obj.pop('previous_price'), 'category_id': example_obj.pop('previous_category_id')}
+        background_tasks.add_task(record_updated, previous, example_obj)
+        background_tasks.add_task(event_bus.publish, 'example', 'updated', example_obj,
+                                  category_id=example_obj['category_id'],
+                                  previous_category_id=previous['category_id'])
 
-            cached_example = cache.get(f'example_{example_id}')  # Получаем кеш и удаляем его, если он есть
-            if cached_example:
-                await cache.delete(f'example_{example_id}')  # Удаляем кеш самого объекта
-            await cache.delete('examples')  # Удаляем кеш, который создавали в функции get_examples для его обновления
+        await cache.write_through({f'example_{example_id}': example_obj})  # Записываем новую версию объекта в кеш
 
-            return example_obj
-        else:
-            """Если объект не был обновлен, то пробрасываем ошибку 404"""
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Example {example_id} not found')
-    else:
+        return example_obj
+    elif not await User.filter(username=payload.get('sub'), is_superuser=True).exists():
         """Если пользователь не является супер юзером, то пробрасываем ошибку 403"""
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You have not enough permissions')
+    else:
+        """Если объект не был обновлен, то пробрасываем ошибку 404"""
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Example {example_id} not found')
 
 
 @example_model_router.delete('/{example_id}', response_model=Status)
-async def delete_example(example_id: int, token: str = Depends(oauth2_scheme)):
+async def delete_example(example_id: int, background_tasks: BackgroundTasks, token: str = Depends(oauth2_scheme)):
 
     """Эта функция отвечает за удаление объекта модели Example по его id. Использовать функцию могут только
     супер юзеры, в противном случае будет проброшена ошибка 403 Forbidden. Валидация пользователя происходит через
@@ -176,21 +306,22 @@ async def delete_example(example_id: int, token: str = Depends(oauth2_scheme)):
         "message": "string",
         "details": "string"
     }
-    """
+    Статистика категории обновляется через BackgroundTasks после отправки ответа"""
 
     payload = verify_token(token)
     user = await User.get(username=payload.get('sub'))  # Получаем юзера из БД
     if user.is_superuser:
 
+        example_obj = await ExampleModel.filter(id=example_id).first().values('price', 'category_id')
         deleted_count = await ExampleModel.filter(id=example_id).delete()  # Пытаемся удалить объект
         if not deleted_count:
             """Если объект не был удален, то пробрасываем ошибку 404"""
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Example {example_id} not found')
+        background_tasks.add_task(record_removed, example_obj)
+        background_tasks.add_task(event_bus.publish, 'example', 'deleted', {'id': example_id},
+                                  category_id=example_obj['category_id'])
 
-        cached_example = cache.get(f'example_{example_id}')  # Получаем кеш и удаляем его, если он есть
-        if cached_example:
-            await cache.delete(f'example_{example_id}')  # Удаляем кеш самого объекта
-        await cache.delete('examples')  # Удаляем кеш, который создавали в функции get_examples для его обновления
+        await cache.invalidate(f'example_{example_id}')  # Удаляем кеш самого объекта
 
         """Если объект был удален, то возвращаем ответ"""
         return Status(message=f'Example {example_id} deleted')
@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic import BaseModel, Field
 
 
@@ -11,6 +13,23 @@ class ListExamplePydantic(BaseModel):
     category_id: int
 
 
+class ColumnarExamplePydantic(BaseModel):
+    """Схема списка объектов класса Example в колоночном формате: значения каждого поля одним списком"""
+    id: List[int]
+    title: List[str]
+    age: List[int]
+    price: List[float]
+    description: List[str]
+    category_id: List[int]
+
+
+class BatchExamplePydantic(BaseModel):
+    """Схема элемента ответа пакетного получения объектов класса Example. Если объекта нет, found равен False"""
+    id: int
+    found: bool
+    item: ListExamplePydantic | None = None
+
+
 class CreateExamplePydantic(BaseModel):
     """Схема по которой создаются объекты класса Example"""
     title: str
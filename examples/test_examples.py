@@ -1,7 +1,10 @@
 import pytest
 from asgi_lifespan import LifespanManager
 from httpx import AsyncClient, ASGITransport
+from tortoise.transactions import in_transaction
 
+from categories.models import Category
+from core.metrics import metrics
 from examples.models import ExampleModel
 from main import app
 
@@ -35,6 +38,9 @@ async def test_get_example(client: AsyncClient):
     }
     fail_response = await client.get('/examples/1')
     assert fail_response.status_code == 404
+    cached_fail_response = await client.get('/examples/1')  # Отсутствие объекта берётся из кеша
+    assert cached_fail_response.status_code == 404
+    assert cached_fail_response.headers['X-DB-Query-Count'] == '0'
 
     cached_response = await client.get('/examples/2')
     assert cached_response.status_code == 200
@@ -48,6 +54,34 @@ async def test_get_example(client: AsyncClient):
     }
 
 
+@pytest.mark.anyio
+async def test_get_examples_batch(client: AsyncClient):
+    response = await client.get('/examples/batch?ids=2,1')
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "id": 2,
+            "found": True,
+            "item": {
+                "id": 2,
+                "title": "string",
+                "age": 1,
+                "price": 1,
+                "description": "string",
+                "category_id": 1
+            }
+        },
+        {
+            "id": 1,
+            "found": False,
+            "item": None
+        }
+    ]
+
+    fail_response = await client.get('/examples/batch?ids=a,b')
+    assert fail_response.status_code == 422
+
+
 @pytest.mark.anyio
 async def test_get_examples(client: AsyncClient):
     response = await client.get('/examples/')
@@ -87,6 +121,18 @@ async def test_get_examples(client: AsyncClient):
         }
     ]
 
+    cached_response = await client.get('/examples/')  # Список id страницы и строки из кеша
+    assert cached_response.status_code == 200
+    assert cached_response.headers['content-type'] == 'application/json'
+    assert cached_response.headers['X-DB-Query-Count'] == '0'
+    assert cached_response.content == response.content
+
+    first_page = await client.get('/examples/?limit=2')
+    assert [example['id'] for example in first_page.json()] == [2, 5]
+    next_page = await client.get('/examples/?limit=2&offset=2')  # Загружена в кеш после первой страницы
+    assert [example['id'] for example in next_page.json()] == [7, 8]
+    assert next_page.headers['X-DB-Query-Count'] == '0'
+
 
 @pytest.mark.anyio
 async def test_filters(client: AsyncClient):
@@ -103,6 +149,19 @@ async def test_filters(client: AsyncClient):
     filter_response = await client.get('/examples/?offset=0&limit=10&order_by=id&category_id=2')
     assert filter_response.status_code == 200
     assert filter_response.json() == []
+    cached_filter_response = await client.get('/examples/?offset=0&limit=10&order_by=id&category_id=2')
+    assert cached_filter_response.json() == []  # Каждый фильтр кешируется под своим ключом
+    assert cached_filter_response.headers['X-DB-Query-Count'] == '0'
+    columnar_response = await client.get('/examples/?offset=0&limit=10&order_by=id&example_id=2&format=columnar')
+    assert columnar_response.status_code == 200
+    assert columnar_response.json() == {
+        "id": [2],
+        "title": ["string"],
+        "age": [1],
+        "price": [1],
+        "description": ["string"],
+        "category_id": [1]
+    }
     filter_response = await client.get('/examples/?offset=0&limit=10&order_by=id&price=1')
     assert filter_response.status_code == 200
     assert filter_response.json() == [{
@@ -165,6 +224,31 @@ async def test_ordering(client: AsyncClient):
         }]
 
 
+@pytest.mark.anyio
+async def test_related_ordering_cache(client: AsyncClient):
+    url = '/examples/?offset=0&limit=10&order_by=category__title'
+    response = await client.get(url)
+    assert response.status_code == 200
+    assert (await client.get(url)).headers['X-DB-Query-Count'] == '0'
+
+    # Изменённые колонки берутся из вызова ORM, поэтому FROM и WHERE в значении им не мешают
+    example = await ExampleModel.get(id=2)
+    await ExampleModel.filter(id=2).update(description='string FROM "Example" WHERE "id" = 2')
+    assert (await client.get(url)).headers['X-DB-Query-Count'] == '0'  # Описание не меняет состав страницы
+    await ExampleModel.filter(id=2).update(description=example.description)
+
+    category = await Category.get(id=1)
+    await Category.filter(id=1).update(title=f'{category.title} 1')  # Название категории меняет порядок страницы
+    assert (await client.get(url)).headers['X-DB-Query-Count'] == '1'
+
+    invalidations = metrics.snapshot()['counters'].get('query_cache_invalidations', 0)
+    async with in_transaction() as transaction:
+        await Category.filter(id=1).using_db(transaction).update(title=category.title)
+        assert metrics.snapshot()['counters']['query_cache_invalidations'] == invalidations + 1
+    # После фиксации поколения меняются ещё раз: страницу, закешированную до фиксации, больше не прочитают
+    assert metrics.snapshot()['counters']['query_cache_invalidations'] == invalidations + 2
+
+
 @pytest.mark.anyio
 async def test_create_example(client: AsyncClient):
     get_admin_jwt_token = await client.post('/users/login', json={
@@ -215,6 +299,7 @@ async def test_update_example(client: AsyncClient):
     }
     examples = await ExampleModel.filter().all()
     last_example_id = examples[-1].id
+    await client.get('/examples/?limit=100')  # Список id страницы попадает в кеш
     response = await client.put(f'/examples/{last_example_id}', json=example_data,
                                 headers={'Authorization': f'{admin_jwt_type.capitalize()} {admin_jwt_token}'})
     assert response.status_code == 200
@@ -226,6 +311,19 @@ async def test_update_example(client: AsyncClient):
         "description": "string 1",
         "category_id": 1
     }
+    # Проверка прав, обновление и чтение объекта - один запрос UPDATE ... RETURNING (раньше было 3 запроса)
+    assert response.headers['X-DB-Query-Count'] == '1'
+
+    cached_response = await client.get(f'/examples/{last_example_id}')  # Новая версия уже записана в кеш
+    assert cached_response.json() == response.json()
+    assert cached_response.headers['X-DB-Query-Count'] == '0'
+
+    list_response = await client.get('/examples/?title=Example 1')  # Список сброшен: изменилась колонка фильтра
+    assert list_response.json() == [response.json()]
+    # Список без фильтров не зависит от изменённых колонок, а новая версия строки берётся из кеша объектов
+    page_response = await client.get('/examples/?limit=100')
+    assert page_response.json()[-1] == response.json()
+    assert page_response.headers['X-DB-Query-Count'] == '0'
 
     fail_response = await client.put(f'/examples/-1', json=example_data,
                                      headers={'Authorization': f'{admin_jwt_type.capitalize()} {admin_jwt_token}'})
@@ -244,6 +342,42 @@ async def test_update_example(client: AsyncClient):
     assert fail_response.status_code == 403
 
 
+@pytest.mark.anyio
+async def test_create_examples_bulk(client: AsyncClient):
+    get_admin_jwt_token = await client.post('/users/login', json={
+        "username": "Riwick",
+        "password": "string"
+    })
+    assert get_admin_jwt_token.status_code == 200
+    admin_jwt_token = get_admin_jwt_token.json().get('access_token')
+    admin_jwt_type = get_admin_jwt_token.json().get('token_type')
+    examples_data = [{
+        "title": f"Bulk {i}",
+        "age": 1,
+        "price": 1,
+        "description": "string",
+        "category_id": 1
+    } for i in range(2)]
+    examples_count = await ExampleModel.filter().count()
+    response = await client.post('/examples/bulk', json=examples_data,
+                                 headers={'Authorization': f'{admin_jwt_type.capitalize()} {admin_jwt_token}'})
+    assert response.status_code == 200
+    assert response.json()['message'] == '2 examples created'
+    assert await ExampleModel.filter().count() == examples_count + 2
+
+    get_user_jwt_token = await client.post('/users/login', json={
+        "username": "string",
+        "password": "string"
+    })
+    assert get_user_jwt_token.status_code == 200
+    user_jwt_token = get_user_jwt_token.json().get('access_token')
+    user_jwt_type = get_user_jwt_token.json().get('token_type')
+
+    fail_response = await client.post('/examples/bulk', json=examples_data,
+                                      headers={'Authorization': f'{user_jwt_type.capitalize()} {user_jwt_token}'})
+    assert fail_response.status_code == 403
+
+
 @pytest.mark.anyio
 async def test_delete_example(client: AsyncClient):
     get_admin_jwt_token = await client.post('/users/login', json={
@@ -278,3 +412,17 @@ async def test_delete_example(client: AsyncClient):
     fail_response = await client.delete('/examples/-1',
                                         headers={'Authorization': f'{user_jwt_type.capitalize()} {user_jwt_token}'})
     assert fail_response.status_code == 403
+
+
+@pytest.mark.anyio
+async def test_query_accounting_headers(client: AsyncClient):
+    response = await client.get('/examples/-2')  # Объекта нет ни в кеше, ни в БД: один SELECT
+    assert response.status_code == 404
+    assert response.headers['X-DB-Query-Count'] == '1'
+    assert float(response.headers['X-DB-Time-Ms']) > 0
+    assert 'X-DB-N-Plus-One' not in response.headers
+
+    cached_response = await client.get('/examples/-2')  # Отсутствие объекта берётся из кеша, БД не вызывается
+    assert cached_response.status_code == 404
+    assert cached_response.headers['X-DB-Query-Count'] == '0'
+    assert cached_response.headers['X-DB-Time-Ms'] == '0.00'
@@ -0,0 +1,21 @@
+from tortoise import Tortoise, run_async
+
+from categories.stats import reconcile
+from core.db import TORTOISE_ORM, apply_schema
+
+
+"""Создание схемы БД и добавление новых колонок в существующие таблицы шагами core.db.MIGRATIONS.
+Запускается один раз на деплой командой "python migrate.py" до старта воркеров,
+которые в режиме STARTUP_MODE=verify только проверяют версию схемы"""
+
+
+async def migrate():
+    await Tortoise.init(config=TORTOISE_ORM)
+    version = await apply_schema()
+    print(f'Database schema is up to date, version {version}')
+    await reconcile()  # Заполняет статистику категорий для уже существующих объектов
+    print('Category stats are reconciled')
+
+
+if __name__ == '__main__':
+    run_async(migrate())
@@ -0,0 +1,70 @@
+import argparse
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from config import CONFIRM_BACKEND, WEB_BIND, WEB_WORKERS
+
+
+"""Запуск приложения в production: "python serve.py". Приложение импортируется один раз в мастер-процессе
+gunicorn до fork (preload), поэтому воркеры делят память с импортированным кодом и стартуют быстрее.
+Количество воркеров по умолчанию равно числу CPU, доступных контейнеру. Каждый воркер перед приёмом запросов
+прогревает кеш, а готовность воркера отдаёт /api/v1/ready"""
+
+
+def available_cpus() -> int:
+    """CPU, доступные процессу: учитываются привязка к ядрам и квота cgroup v2 (cpu.max) в контейнере"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as file:
+            quota, period = file.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(int(quota) // int(period), 1))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+class Server(BaseApplication):
+    """Gunicorn с настройками из кода вместо аргументов командной строки"""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Запуск RestAPI-FastAPI через gunicorn')
+    parser.add_argument('--bind', default=WEB_BIND)
+    parser.add_argument('--workers', type=int, default=WEB_WORKERS, help='0 - по числу доступных CPU')
+    args = parser.parse_args()
+
+    """Воркеры асинхронные, поэтому одного воркера на CPU достаточно, чтобы занять все ядра"""
+    workers = args.workers or available_cpus()
+    if workers > 1 and CONFIRM_BACKEND != 'redis':
+        """Коды подтверждения в памяти видны только выдавшему их воркеру, и подтверждение почты
+        на другом воркере не находило бы код"""
+        parser.error(f'CONFIRM_BACKEND={CONFIRM_BACKEND} keeps confirmation codes per worker, '
+                     'use CONFIRM_BACKEND=redis or --workers=1')
+    os.environ['WEB_CONCURRENCY'] = str(workers)  # Воркеры узнают, что они не одни, например фильтр Блума
+    Server({
+        'bind': args.bind,
+        'workers': workers,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'preload_app': True,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
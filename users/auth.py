@@ -1,4 +1,5 @@
 import jwt
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 
@@ -13,9 +14,15 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 360  # Время жизни токенов
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Токены, уже проверенные в текущем запросе: токен -> payload. Запросы пакета /api/v1/batch не проверяют токен заново
+verified_tokens: ContextVar[dict | None] = ContextVar('verified_tokens', default=None)
+
 
 def verify_token(token: str):
     """Эта функция отвечает за валидацию токенов"""
+    verified = verified_tokens.get()
+    if verified is not None and token in verified:
+        return verified[token]
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         return payload
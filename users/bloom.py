@@ -0,0 +1,158 @@
+import hashlib
+import math
+import os
+
+from tortoise.expressions import Q
+
+from config import BLOOM_BACKEND, BLOOM_CAPACITY, BLOOM_ERROR_RATE, CACHE_BREAKER_RESET_SECONDS
+from core.cache import UNAVAILABLE, get_redis_client, redis_call
+from core.logger import get_logger
+from core.metrics import metrics
+from users.models import User
+
+
+"""Фильтр Блума по занятым username и email. Отрицательный ответ фильтра точный: значение свободно, и проверять
+его в БД не нужно. Положительный ответ может быть ложным, поэтому он проверяется запросом к БД. Фильтр
+строится из таблицы User при запуске воркера и дополняется при регистрации и изменении пользователей. Удалённые
+значения из фильтра не убираются и только дают лишние проверки в БД, а уникальность по-прежнему гарантирует БД.
+С BLOOM_BACKEND=redis битовый массив хранится в Redis и общий для всех воркеров, с memory - в памяти воркера.
+Фильтр в памяти не видит значений, добавленных другими воркерами, и отвечал бы, что они свободны, поэтому
+при нескольких воркерах он не строится, и все значения проверяются в БД"""
+
+
+bloom_logger = get_logger('bloom_logger')
+
+BLOOM_KEY = 'users_bloom'  # Префикс ключа битового массива в Redis
+
+
+def filter_size(capacity: int, error_rate: float) -> tuple[int, int]:
+    """Количество бит и хеш-функций фильтра на capacity значений с долей ложных срабатываний error_rate"""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+class BloomFilter:
+    """Фильтр Блума с битовым массивом в памяти или в Redis. Порядок бит совпадает с SETBIT/GETBIT Redis"""
+
+    def __init__(self, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE,
+                 backend: str = BLOOM_BACKEND):
+        self.bits, self.hashes = filter_size(capacity, error_rate)
+        self.backend = backend
+        self.array = bytearray(math.ceil(self.bits / 8))
+        self.ready = False  # Пока фильтр не построен, все значения считаются возможно занятыми
+        # Массивы фильтров с другими размерами, например после изменения BLOOM_CAPACITY, хранятся под другими ключами
+        self.key = f'{BLOOM_KEY}:{self.bits}:{self.hashes}'
+
+    def positions(self, value: str) -> list[int]:
+        """Номера бит значения: k хеш-функций из двух половин одного хеша (двойное хеширование)"""
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8]), int.from_bytes(digest[8:]) | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def set_local(self, value: str):
+        for position in self.positions(value):
+            self.array[position >> 3] |= 0x80 >> (position & 7)
+
+    async def might_contain(self, value: str) -> bool:
+        """False - значения точно нет. Если фильтр не построен или Redis недоступен, возвращает True,
+        и значение проверяется в БД"""
+        if not self.ready:
+            return True
+        positions = self.positions(value)
+        if self.backend == 'redis':
+            async def check():
+                async with get_redis_client().pipeline(transaction=False) as pipe:
+                    for position in positions:
+                        pipe.getbit(self.key, position)
+                    return await pipe.execute()
+
+            bits = await redis_call(check)
+            if bits is UNAVAILABLE:
+                return True
+            found = all(bits)
+        else:
+            found = all(self.array[position >> 3] & (0x80 >> (position & 7)) for position in positions)
+        metrics.inc('users_bloom_possible_hits' if found else 'users_bloom_negatives')
+        return found
+
+    async def add(self, *values: str):
+        """Добавляет значения в фильтр. Ошибка Redis не мешает запросу: значение проверится в БД при
+        следующем построении фильтра, а повторную регистрацию всё равно не пропустит уникальный индекс"""
+        if self.backend != 'redis':
+            for value in values:
+                self.set_local(value)
+            return
+
+        async def update():
+            async with get_redis_client().pipeline(transaction=False) as pipe:
+                for value in values:
+                    for position in self.positions(value):
+                        pipe.setbit(self.key, position, 1)
+                await pipe.execute()
+
+        await redis_call(update)
+
+    async def rebuild(self):
+        """Строит фильтр из всех username и email таблицы User. В Redis построенный массив объединяется с общим
+        через BITOP OR: биты, которые другие воркеры установили во время построения, не затираются"""
+        # WEB_CONCURRENCY задаёт serve.py уже после импорта config, поэтому значение читается при запуске воркера
+        if self.backend != 'redis' and int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+            bloom_logger.warning('Bloom filter with BLOOM_BACKEND=%s is disabled for several workers', self.backend)
+            return
+
+        self.array = bytearray(math.ceil(self.bits / 8))
+        rows = await User.all().values_list('username', 'email')
+        for username, email in rows:
+            self.set_local(username_value(username))
+            self.set_local(email_value(email))
+        if self.backend == 'redis':
+            built_key = f'{self.key}:build:{os.getpid()}'
+
+            async def merge():
+                async with get_redis_client().pipeline(transaction=True) as pipe:
+                    pipe.set(built_key, bytes(self.array))
+                    pipe.bitop('OR', self.key, self.key, built_key)
+                    pipe.delete(built_key)
+                    await pipe.execute()
+
+            # Массив фильтра передаётся целиком, поэтому ждать дольше обычной операции с Redis
+            if await redis_call(merge, timeout=CACHE_BREAKER_RESET_SECONDS) is UNAVAILABLE:
+                bloom_logger.warning('Bloom filter is not built: Redis is unavailable')
+                return
+            self.array = bytearray()  # Дальше используется только массив в Redis
+        self.ready = True
+        metrics.set('users_bloom_values', len(rows) * 2)
+
+
+def username_value(username: str) -> str:
+    return f'username:{username}'
+
+
+def email_value(email: str) -> str:
+    return f'email:{email}'
+
+
+users_bloom = BloomFilter()
+
+
+async def taken(username: str | None = None, email: str | None = None) -> dict:
+    """Проверяет, заняты ли username и email, и возвращает {поле: занято ли} для переданных полей.
+    В БД идёт один запрос и только по значениям, которые фильтр не исключил"""
+    result = {}
+    candidates = {}
+    for field, value, key in (('username', username, username_value), ('email', email, email_value)):
+        if value is not None:
+            result[field] = False
+            if await users_bloom.might_contain(key(value)):
+                candidates[field] = value
+    if not candidates:
+        return result
+
+    for row in await User.filter(Q(**candidates, join_type='OR')).values(*candidates):
+        for field, value in candidates.items():
+            if row[field] == value:
+                result[field] = True
+    false_positives = sum(not result[field] for field in candidates)
+    if false_positives:
+        metrics.inc('users_bloom_false_positives', false_positives)
+    return result
@@ -1,10 +1,9 @@
-from aiocache import RedisCache
-
-from config import REDIS_HOST, REDIS_PORT, REDIS_TTL
+from core.cache import create_cache
 from users.serializers import JsonSerializer
 
 
-"""Настройки кеша через редис. Используется 3 база данных. Время хранения кеша равно 60 секундам"""
+"""Настройки кеша. Бэкенд задаётся CACHE_BACKEND, ключи хранятся с префиксом users. Время хранения кеша
+задаётся REDIS_TTL"""
 
 
-cache = RedisCache(serializer=JsonSerializer(), endpoint=REDIS_HOST, port=REDIS_PORT, db=3, ttl=REDIS_TTL)
+cache = create_cache(serializer=JsonSerializer(), namespace='users')
@@ -0,0 +1,48 @@
+import secrets
+
+from config import CONFIRM_BACKEND, CONFIRM_CODE_TTL, CONFIRM_RESEND_SECONDS
+from core.cache import create_cache
+from users.serializers import JsonSerializer
+
+
+"""Коды подтверждения почты. Коды случайные и хранятся не в таблице User, а в хранилище ключ-значение
+с истечением через CONFIRM_CODE_TTL секунд: подтверждение - это одно чтение по ключу вместо поиска по таблице.
+Ключи хранилища:
+    code_<код> - id пользователя;
+    user_<id> - действующий код пользователя, чтобы при повторной отправке старый код перестал работать;
+    resend_<id> - метка повторной отправки, пока она есть, письмо повторно не отправляется.
+С CONFIRM_BACKEND=memory коды хранятся в памяти воркера, поэтому serve.py не запускается с таким хранилищем
+и несколькими воркерами"""
+
+
+# Коды есть только в хранилище, поэтому при недоступном Redis операции завершаются ошибкой, а не промахом
+store = create_cache(serializer=JsonSerializer(), namespace='confirm', backend=CONFIRM_BACKEND, degrade=False)
+
+
+async def issue_code(user_id: int) -> str:
+    """Создаёт новый код подтверждения пользователя и отменяет предыдущий"""
+    code = secrets.token_urlsafe(16)
+    previous = await store.get(f'user_{user_id}')
+    await store.multi_set([(f'code_{code}', user_id), (f'user_{user_id}', code)], ttl=CONFIRM_CODE_TTL)
+    if previous:
+        await store.delete(f'code_{previous}')
+    return code
+
+
+async def allow_resend(user_id: int) -> bool:
+    """Разрешает повторную отправку письма не чаще одного раза в CONFIRM_RESEND_SECONDS секунд"""
+    try:
+        await store.add(f'resend_{user_id}', 1, ttl=CONFIRM_RESEND_SECONDS)
+    except ValueError:
+        return False
+    return True
+
+
+async def redeem_code(code: str) -> int | None:
+    """Возвращает id пользователя по коду и удаляет код, чтобы его нельзя было использовать повторно.
+    Если код неверный или истёк, возвращает None"""
+    user_id = await store.pop(f'code_{code}')  # Одновременные запросы с одним кодом получат id только один раз
+    if user_id is None:
+        return None
+    await store.delete(f'user_{user_id}')
+    return user_id
@@ -0,0 +1,7 @@
+from core.logger import get_logger
+
+
+"""Конфигурация логгера. Вывод идёт через общую неблокирующую очередь из core.logger"""
+
+
+users_logger = get_logger('users_logger')
@@ -13,8 +13,9 @@ class User(models.Model):
     date_joined = fields.DatetimeField(auto_now_add=True)
     is_active = fields.BooleanField(default=True)  # Активен ли его аккаунт(можно ли на него зайти)
 
-    confirm_code = fields.TextField()
+    confirm_code = fields.TextField(default='')  # Не используется: коды подтверждения хранятся в users.confirmations
     confirmed = fields.BooleanField(default=False)  # Подтвердил ли пользователь почту
+    version = fields.IntField(default=1)  # Увеличивается при каждом обновлении, нужен для записи в кеш
 
     class Meta:
         table = 'User'
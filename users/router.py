@@ -1,22 +1,39 @@
-import hashlib
+import math
 from typing import List
 
 from fastapi import APIRouter, HTTPException, Depends, Query, BackgroundTasks
 from fastapi.security import OAuth2PasswordBearer
+from pydantic import TypeAdapter
 from starlette import status
 from starlette.exceptions import HTTPException
 
 from examples.schemas import Status
 
 from users.auth import create_access_token, verify_token, pwd_context
-from users.schemas import UserCreateSchema, UserListSchema, UserUpdateSchema, UserLoginSchema, UserProfileSchema
+from users.schemas import (UserCreateSchema, UserListSchema, UserUpdateSchema, UserLoginSchema, UserProfileSchema,
+                           UserBatchSchema, UserAvailabilitySchema)
 from users.models import User
 from users.send_email import send_email
 from users.cache import cache
+from users.confirmations import issue_code, allow_resend, redeem_code
+from users.bloom import users_bloom, taken, username_value, email_value
+from users.logger import users_logger
+
+from config import CONFIRM_RESEND_SECONDS, PREFETCH_BUDGET, CACHE_BREAKER_RESET_SECONDS
+
+from core.batch import parse_ids, load_many, batch_response
+from core.cache import is_tombstone, CacheUnavailable
+from core.db import model_row
+from core.querycache import query_cache
+from core.responses import json_response
+from core.writes import update_returning
 
 """Инициализация роутера"""
 users_router = APIRouter(prefix='/users', tags=['users'])
 
+users_adapter = TypeAdapter(List[UserListSchema])  # Схема ответа get_users для сериализации при промахе
+query_cache.register(User)  # Кеш списков сбрасывается при любом изменении таблицы пользователей
+
 
 @users_router.post("/register", response_model=UserListSchema)
 async def register(data: UserCreateSchema, background_tasks: BackgroundTasks):
@@ -28,20 +45,33 @@ async def register(data: UserCreateSchema, background_tasks: BackgroundTasks):
         "username": "string",
         "password": "string",
         "email": "user@example.com"
-    }"""
+    }
+    Занятые username и email отсекаются фильтром Блума и одним запросом к БД до дорогого хеширования пароля.
+    Если хранилище кодов недоступно, пользователь всё равно создаётся, а письмо отправляется через
+    /resend-confirmation"""
+
+    if any((await taken(data.username, data.email)).values()):
+        """Если такой пользователь уже зарегистрирован, то пробрасывается ошибка 422 UNPROCESSABLE_ENTITY """
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="User with this username or email has already registered")
 
     try:
-        user = await User.create(username=data.username, email=data.email, password=pwd_context.hash(data.password),
-                                 confirm_code=hashlib.sha256(data.email.encode())
-                                 .hexdigest()[:6])  # попытка создания пользователя
+        # попытка создания пользователя. Уникальные индексы защищают от одновременной регистрации
+        user = await User.create(username=data.username, email=data.email, password=pwd_context.hash(data.password))
     except:
         """Если такой пользователь уже зарегистрирован, то пробрасывается ошибка 422 UNPROCESSABLE_ENTITY """
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="User with this username or email has already registered")
     if user:
         """Если пользователь был успешно создан, то создается таска на отправку ему email и возвращаются его данные"""
-        background_tasks.add_task(send_email, data.email, user.confirm_code)
-        await cache.delete('users')
+        try:
+            confirm_code = await issue_code(user.id)  # Случайный код с ограниченным сроком действия
+            background_tasks.add_task(send_email, data.email, confirm_code)
+        except CacheUnavailable as exc:
+            """Пользователь уже создан, поэтому регистрация не отменяется: код придёт через /resend-confirmation"""
+            users_logger.warning('Confirmation code for user %s was not issued: %r', user.id, exc)
+        await cache.write_through({f'user_{user.id}': model_row(user)})
+        await users_bloom.add(username_value(user.username), email_value(user.email))
         return user
     else:
         """Если что-то пошло не так"""
@@ -51,6 +81,13 @@ async def register(data: UserCreateSchema, background_tasks: BackgroundTasks):
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+def confirmations_unavailable() -> HTTPException:
+    """Хранилище кодов подтверждения недоступно. Запрос можно повторить, когда Redis восстановится"""
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail='Email confirmation is temporarily unavailable',
+                         headers={'Retry-After': str(math.ceil(CACHE_BREAKER_RESET_SECONDS))})
+
+
 @users_router.post('/confirm-email/{confirm_code}', response_model=UserListSchema)
 async def confirm_email(confirm_code: str):
     """После отправки email пользователю необходимо ввести код в качестве query-параметра, чтобы подтвердить
@@ -59,13 +96,19 @@ async def confirm_email(confirm_code: str):
         "id": 0,
         "username": "string",
         "date_joined": "2024-04-04T09:31:05.137Z"
-    }"""
+    }
+    Код действует CONFIRM_CODE_TTL секунд и может быть использован один раз. Если хранилище кодов недоступно,
+    пробрасывается ошибка 503 с заголовком Retry-After"""
 
-    user = await User.get(confirm_code=confirm_code)  # Пытаемся получить пользователя по его коду подтверждения
+    try:
+        user_id = await redeem_code(confirm_code)  # Получаем id пользователя по коду из хранилища кодов
+    except CacheUnavailable:
+        raise confirmations_unavailable()
+    # Изменяем значение поля confirmed на True и получаем пользователя одним запросом к БД
+    user = await update_returning(User, user_id, {'confirmed': True}, None) if user_id else None
     if user:
         """Если мы получили пользователя"""
-        user.confirmed = True
-        await user.save()  # Изменяем значение поля confirmed на True и отдаем пользователя
+        await cache.write_through({f'user_{user_id}': user})  # Записываем новую версию пользователя в кеш
         return user
     else:
         """Если срок действия токена вышел или он отдан некорректно, то пробрасываем 404 ошибку"""
@@ -73,6 +116,39 @@ async def confirm_email(confirm_code: str):
                             detail='User not found or confirmation code is invalid')
 
 
+@users_router.post('/resend-confirmation', response_model=Status)
+async def resend_confirmation(background_tasks: BackgroundTasks, token: str = Depends(oauth2_scheme)):
+    """Эта функция повторно отправляет письмо с новым кодом подтверждения, предыдущий код перестаёт действовать.
+    Пользователь определяется через JWT-токен и его параметр sub. Письмо можно отправлять не чаще одного раза
+    в CONFIRM_RESEND_SECONDS секунд, иначе пробрасывается ошибка 429 с заголовком Retry-After. Если хранилище
+    кодов недоступно, пробрасывается ошибка 503. В случае успеха возвращается ответ в формате:
+    {
+        "status_code": 200,
+        "message": "string",
+        "details": "string"
+    }"""
+
+    payload = verify_token(token)
+    user = await User.filter(username=payload.get('sub')).first().values('id', 'email', 'confirmed')
+    if not user:
+        """Если пользователь из токена не существует"""
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+    if user['confirmed']:
+        """Если почта уже подтверждена"""
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Email is already confirmed')
+    try:
+        if not await allow_resend(user['id']):
+            """Если письмо уже отправлялось недавно"""
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                detail='Confirmation email was sent recently',
+                                headers={'Retry-After': str(CONFIRM_RESEND_SECONDS)})
+        confirm_code = await issue_code(user['id'])
+    except CacheUnavailable:
+        raise confirmations_unavailable()
+    background_tasks.add_task(send_email, user['email'], confirm_code)
+    return Status(message='Confirmation email sent')
+
+
 @users_router.post("/login")
 async def login_for_access_token(form_data: UserLoginSchema):
     """В этой функции происходит создание JWT-токенов и отправка их юзерам. Если введенные данные
@@ -128,7 +204,8 @@ async def get_profile(token: str = Depends(oauth2_scheme)):
         user_obj = await User.filter(username=payload.get('sub')).first().values()  # Пытаемся получить юзера
         if user_obj:
             """Если пользователь есть"""
-            await cache.set(f'user_profile_{payload.get('sub')}', user_obj)  # Записываем кеш
+            # Записываем кеш, если там нет более новой версии, записанной обновлением
+            await cache.set_if_newer([(f'user_profile_{payload.get('sub')}', user_obj, user_obj['version'])])
 
             return user_obj
         else:
@@ -140,8 +217,8 @@ async def get_profile(token: str = Depends(oauth2_scheme)):
 
 
 @users_router.get('/', response_model=List[UserListSchema])
-async def get_users(offset: int = Query(0, ge=0), limit: int = Query(10, ge=1),
-                    order_by: str = Query('id'),
+async def get_users(background_tasks: BackgroundTasks,
+                    offset: int = Query(0, ge=0), limit: int = Query(10, ge=1), order_by: str = Query('id'),
                     username: str = Query(None), user_id: int = Query(None)):
     """Эта функция выводит всех пользователей по 10 штук(можно задать своё значение, изменив limit)
         в формате:
@@ -154,11 +231,9 @@ async def get_users(offset: int = Query(0, ge=0), limit: int = Query(10, ge=1),
         ]
         Она поддерживает пагинацию через offset и limit, сортировку через order_by(по умолчанию стоит сортировка по id)
         и фильтры. Они идут после order_by в параметрах функции и представляют собой query-запросы.
-        В случае если нет ни одного объекта, выводится пустой список []"""
-
-    cached_users = await cache.get('users')  # Пытаемся взять данные из кеша
-    if cached_users:
-        return cached_users
+        В случае если нет ни одного объекта, выводится пустой список []
+        Готовое JSON-тело ответа кешируется отдельно для каждого SQL-запроса и при попадании отдаётся
+        без валидации и сериализации"""
 
     filters = {}
     if username:
@@ -168,14 +243,54 @@ async def get_users(offset: int = Query(0, ge=0), limit: int = Query(10, ge=1),
 
     if filters:
         """Получение результата с фильтрами через распаковку словаря **filters"""
-        users = await User.filter(**filters).offset(offset).limit(limit).all().order_by(order_by).values()
-        await cache.set('users', users)  # Запись результата в кеш
+        users = User.filter(**filters).offset(offset).limit(limit).all().order_by(order_by).values()
     else:
         """Получение результата без фильтров"""
-        users = await User.filter().offset(offset).limit(limit).all().order_by(order_by).values()
-        await cache.set('users', users)  # Запись результата в кеш
+        users = User.filter().offset(offset).limit(limit).all().order_by(order_by).values()
+
+    if PREFETCH_BUDGET:
+        # Клиенты обычно запрашивают следующую страницу сразу после текущей, поэтому она загружается в кеш заранее
+        next_page = User.filter(**filters).offset(offset + limit).limit(limit).all().order_by(order_by).values()
+        background_tasks.add_task(query_cache.prefetch, query_cache.body, next_page, users_adapter)
+
+    # Ответ из кеша запросов или из БД с валидацией и сериализацией при промахе
+    return json_response(await query_cache.body(users, users_adapter))
+
+
+@users_router.get('/batch', response_model=List[UserBatchSchema])
+async def get_users_batch(ids: str = Query(..., description='id пользователей через запятую: 1,2,3')):
+    """Эта функция выводит нескольких пользователей по списку id в порядке запроса в формате:
+    [
+        {
+            "id": 0,
+            "found": true,
+            "item": {
+                "id": 0,
+                "username": "string",
+                "date_joined": "2024-04-04T10:07:23.991Z"
+            }
+        }
+    ]
+    Все id читаются из кеша одним запросом, недостающие берутся из БД одним запросом и записываются в кеш.
+    Для несуществующих пользователей found равен false, а item - null"""
 
-    return users
+    user_ids = parse_ids(ids)
+    found = await load_many(cache, User, user_ids, 'user')
+    return batch_response(user_ids, found)
+
+
+@users_router.get('/available', response_model=UserAvailabilitySchema)
+async def check_availability(username: str = Query(None), email: str = Query(None)):
+    """Эта функция проверяет, свободны ли username и email для регистрации, и выводит результат в формате:
+    {
+        "username": true,
+        "email": false
+    }
+    Непереданные параметры выводятся как null. Значения, которых точно нет в фильтре Блума, не проверяются в БД"""
+
+    if username is None and email is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Pass username or email')
+    return {field: not is_taken for field, is_taken in (await taken(username, email)).items()}
 
 
 @users_router.get('/{user_id}', response_model=UserListSchema)
@@ -185,18 +300,25 @@ async def get_user(user_id: int):
         "id": 0,
         "title": "string"
     }
-    Если пользователь не существует, пробрасывается ошибка 404"""
+    Если пользователь не существует, пробрасывается ошибка 404. Отсутствие пользователя тоже кешируется
+    на короткое время"""
 
     cached_user = await cache.get(f'user_{user_id}')  # Попытка получения кеша
+    if cached_user and is_tombstone(cached_user):
+        """Пользователя нет, и это уже известно по кешу"""
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'User {user_id} not found')
     if cached_user:
         return cached_user  # Если кеш есть, то возвращаем его
 
     user_obj = await User.filter(id=user_id).first().values()  # Получение пользователя
     if user_obj:
         """В случае если пользователь найден"""
-        await cache.set(f'user_{user_id}', user_obj)  # Сохранение в кеш, если его нету
+        # Сохранение в кеш, если там нет более новой версии, записанной обновлением
+        await cache.set_if_newer([(f'user_{user_id}', user_obj, user_obj['version'])])
+        return user_obj
     else:
         """В случае если категория не найдена пробрасывается 404 ошибка"""
+        await cache.bury(f'user_{user_id}')  # Метка отсутствия, чтобы повторные запросы не шли в БД
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'User {user_id} not found')
 
 
@@ -216,34 +338,33 @@ async def update_user(user_id: int, data: UserUpdateSchema, token: str = Depends
     Данные для обновления валидируются через pydantic"""
 
     payload = verify_token(token)  # Проверяем токен
-    query_user = await (User.filter(username=payload.get('sub')).
-                        first().only('is_superuser'))  # Получаем пользователя по токену
-    user_obj = await User.filter(id=user_id).first().only('username')  # Получаем обновляемого пользователя
-
-    if user_obj:
-        if query_user.is_superuser or user_obj.username == payload.get('sub'):  # Проверка прав доступа
-            updated_count = await user_obj.update_from_dict(**data.model_dump())
-
-            if updated_count:
-                updated_user = await User.get(id=user_id).values()  # Получаем обновленного пользователя
-
-                cached_example = cache.get(f'user_{user_id}')  # Получаем кеш и удаляем его, если он есть
-                if cached_example:
-                    await cache.delete(f'user_{user_id}')  # Удаляем кеш самого объекта
-                await cache.delete(f'profile_{updated_user.get('username')}')  # Удаляем кеш профиля
-
-                """Если объект был обновлен, то возвращаем ответ"""
-                return updated_user
-            else:
-                """Если не получилось обновить пользователя"""
-                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                                    detail='Your input data is invalid')
-        else:
-            """Если обновить пользователя пытается не супер юзер и не сам пользователь"""
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You have not enough permissions')
-    else:
+    # Проверка прав доступа (супер юзер или сам пользователь), обновление и получение обновленного пользователя
+    # вместе с его прежним username одним запросом к БД
+    updated_user = await update_returning(User, user_id, data.model_dump(), payload.get('sub'), allow_owner=True,
+                                          previous=('username',))
+
+    if updated_user:
+        previous_username = updated_user.pop('previous_username')
+
+        # Записываем новую версию пользователя и его профиля в кеш, удаляем кеш профиля
+        # под старым username за один запрос к кешу
+        invalidate = []
+        if previous_username != updated_user['username']:
+            invalidate.append(f'user_profile_{previous_username}')
+        # Новые значения уникальных полей сразу видны в проверке занятости, в том числе email, если его изменили
+        await users_bloom.add(username_value(updated_user['username']), email_value(updated_user['email']))
+        await cache.write_through({f'user_{user_id}': updated_user,
+                                   f'user_profile_{updated_user['username']}': updated_user},
+                                  invalidate=invalidate)
+
+        """Если объект был обновлен, то возвращаем ответ"""
+        return updated_user
+    elif not await User.filter(id=user_id).exists():
         """Если пользователь не найден"""
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'User {user_id} not found')
+    else:
+        """Если обновить пользователя пытается не супер юзер и не сам пользователь"""
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='You have not enough permissions')
 
 
 @users_router.delete('/{user_id}', response_model=Status)
@@ -268,10 +389,7 @@ async def delete_user(user_id: int, token: str = Depends(oauth2_scheme)):
             """Если удаляемый пользователь не был удален"""
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'User {user_id} not found')
 
-        cached_user = await cache.get(f'user_{user_id}')  # Получаем кеш и удаляем его, если он есть
-        if cached_user:
-            await cache.delete(f'user_{user_id}')
-        await cache.delete('users')  # Удаляем кеш, который создавали в функции get_categories для его обновления
+        await cache.invalidate(f'user_{user_id}')  # Удаляем кеш пользователя
 
         """Если объект был удален, то возвращаем ответ"""
         return Status(message=f'User {user_id} deleted')
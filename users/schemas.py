@@ -23,6 +23,13 @@ class UserListSchema(BaseModel):
     date_joined: datetime.datetime | str
 
 
+class UserBatchSchema(BaseModel):
+    """Схема элемента ответа пакетного получения пользователей. Если пользователя нет, found равен False"""
+    id: int
+    found: bool
+    item: UserListSchema | None = None
+
+
 class UserProfileSchema(BaseModel):
     """Схема по которой пользователю выводиться информация о себе"""
     id: int
@@ -33,6 +40,12 @@ class UserProfileSchema(BaseModel):
     email: EmailStr
 
 
+class UserAvailabilitySchema(BaseModel):
+    """Схема ответа проверки username и email: true - свободен, null - не проверялся"""
+    username: bool | None = None
+    email: bool | None = None
+
+
 class UserUpdateSchema(BaseModel):
     """Схема по которой происходит обновление пользователя"""
     username: str
@@ -1,8 +1,12 @@
+import asyncio
+
 import pytest
 from asgi_lifespan import LifespanManager
 from httpx import AsyncClient, ASGITransport
 
+from core.cache import CacheUnavailable
 from main import app
+from users.confirmations import issue_code, redeem_code
 from users.models import User
 
 
@@ -44,6 +48,29 @@ async def test_get_user(client: AsyncClient):
     assert fail_response.status_code == 404
 
 
+@pytest.mark.anyio
+async def test_get_users_batch(client: AsyncClient):
+    user_2 = await User.get(id=2)
+    response = await client.get('/users/batch?ids=2,-1')
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "id": 2,
+            "found": True,
+            "item": {
+                "id": 2,
+                "username": 'Riwick',
+                "date_joined": user_2.date_joined.isoformat().replace('+00:00', 'Z')
+            }
+        },
+        {
+            "id": -1,
+            "found": False,
+            "item": None
+        }
+    ]
+
+
 @pytest.mark.anyio
 async def test_get_users(client: AsyncClient):
     user_2 = await User.get(id=2)
@@ -184,6 +211,64 @@ async def test_register(client: AsyncClient):
     assert fail_response.status_code == 422
 
 
+@pytest.mark.anyio
+async def test_check_availability(client: AsyncClient):
+    response = await client.get('/users/available?username=string 123&email=free@example.com')
+    assert response.status_code == 200
+    assert response.json() == {"username": False, "email": True}  # Зарегистрированный в test_register username
+
+    free_response = await client.get('/users/available?username=free username')
+    assert free_response.json() == {"username": True, "email": None}
+    assert free_response.headers['X-DB-Query-Count'] == '0'  # Фильтр исключил значение без запроса к БД
+
+    fail_response = await client.get('/users/available')
+    assert fail_response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_confirm_email(client: AsyncClient):
+    user = await User.get(username='string 123')
+    confirm_code = await issue_code(user.id)
+
+    response = await client.post(f'/users/confirm-email/{confirm_code}')
+    assert response.status_code == 200
+    assert response.json()['id'] == user.id
+    assert response.headers['X-DB-Query-Count'] == '1'  # Только UPDATE ... RETURNING
+    assert (await User.get(id=user.id)).confirmed
+
+    fail_response = await client.post(f'/users/confirm-email/{confirm_code}')  # Код одноразовый
+    assert fail_response.status_code == 404
+
+    confirm_code = await issue_code(user.id)
+    # Одновременные запросы с одним кодом: код получает только один из них
+    assert sorted(await asyncio.gather(redeem_code(confirm_code), redeem_code(confirm_code)),
+                  key=lambda user_id: user_id or 0) == [None, user.id]
+
+
+@pytest.mark.anyio
+async def test_register_without_confirmation_store(client: AsyncClient, monkeypatch):
+    async def unavailable(user_id: int):
+        raise CacheUnavailable('Redis is unavailable for confirm')
+
+    monkeypatch.setattr('users.router.issue_code', unavailable)
+    response = await client.post('/users/register', json={
+        "username": "string 456",
+        "password": "string",
+        "email": "user456@example.com"
+    })
+    assert response.status_code == 200  # Пользователь создан, код отправится через /resend-confirmation
+    assert await User.exists(username='string 456')
+
+    monkeypatch.setattr('users.router.allow_resend', unavailable)
+    login_response = await client.post('/users/login', json={"username": "string 456", "password": "string"})
+    resend_response = await client.post('/users/resend-confirmation', headers={
+        'Authorization': f'Bearer {login_response.json()["access_token"]}'
+    })
+    assert resend_response.status_code == 503
+    assert 'Retry-After' in resend_response.headers
+    await User.filter(username='string 456').delete()
+
+
 @pytest.mark.anyio
 async def test_bad_login(client: AsyncClient):
     invalid_username = await client.post('/users/login', json={
@@ -223,6 +308,9 @@ async def test_update_user(client: AsyncClient):
         "username": "STRING",
         "date_joined": last_user.date_joined.isoformat().replace('+00:00', 'Z')
     }
+    # Проверка прав, обновление, чтение пользователя и его прежнего username - один запрос UPDATE ... RETURNING
+    # (раньше было 4 запроса)
+    assert response.headers['X-DB-Query-Count'] == '1'
 
     fail_response = await client.put('/users/-1', json=example_data,
                                      headers={'Authorization': f'{admin_jwt_type.capitalize()} {admin_jwt_token}'})